@@ -0,0 +1,69 @@
+#!/usr/bin/env python
+""" Benchmarks conductor.file_io.write_grid_to_gsa_file against the original
+  csv.writer based writer on a synthetic DEM grid, checking that the default
+  output is byte-identical.
+
+  Usage: python benchmarks/bench_gsa_writer.py [--num-rows N] [--num-cols N]
+"""
+
+import argparse
+import csv
+import filecmp
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from conductor.file_io import write_grid_to_gsa_file
+
+def write_grid_to_gsa_file_csv(grid, outfilename, num_cols_dem, num_rows_dem,\
+    dem_xmin, dem_xmax, dem_ymin, dem_ymax):
+  """ Reference implementation: the original csv.writer based writer """
+  zmin = np.min(grid)
+  zmax = np.max(grid)
+  header_rows = [['DSAA'], [num_cols_dem, num_rows_dem], [dem_xmin, dem_xmax],\
+    [dem_ymin, dem_ymax], [zmin, zmax]]
+  with open(outfilename, 'w') as csvfile:
+    writer = csv.writer(csvfile, delimiter=' ')
+    for header_row in header_rows:
+      writer.writerow(header_row)
+    for row in grid:
+      writer.writerow(row)
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__,\
+    formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--num-rows', type=int, default=2000)
+  parser.add_argument('--num-cols', type=int, default=3000)
+  args = parser.parse_args()
+
+  grid = 2000 + 1000 * np.random.rand(args.num_rows, args.num_cols)
+  extents = (0, args.num_cols - 1, 0, args.num_rows - 1)
+  with tempfile.TemporaryDirectory() as tmpdir:
+    old_file = os.path.join(tmpdir, 'old.gsa')
+    new_file = os.path.join(tmpdir, 'new.gsa')
+    timings = []
+    start = time.perf_counter()
+    write_grid_to_gsa_file_csv(grid, old_file, args.num_cols, args.num_rows,\
+      *extents)
+    timings.append(('csv.writer', time.perf_counter() - start))
+    start = time.perf_counter()
+    write_grid_to_gsa_file(grid, new_file, args.num_cols, args.num_rows,\
+      *extents)
+    timings.append(('bulk, shortest repr', time.perf_counter() - start))
+    assert filecmp.cmp(old_file, new_file, shallow=False)
+    for precision in [3, 1]:
+      start = time.perf_counter()
+      write_grid_to_gsa_file(grid, new_file, args.num_cols, args.num_rows,\
+        *extents, precision=precision)
+      timings.append(('bulk, precision={}'.format(precision),\
+        time.perf_counter() - start))
+
+  print('{} x {} grid'.format(args.num_rows, args.num_cols))
+  for name, timing in timings:
+    print('{:22s} {:8.2f} s  ({:.1f}x)'.format(name, timing,\
+      timings[0][1] / timing))
+
+if __name__ == '__main__':
+  main()
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+""" Benchmarks conductor.cells.update_area_fracs on a large synthetic domain,
+  serially and sharded over process pools of increasing size, checking that
+  all of them produce identical cells.
+
+  Usage: python benchmarks/bench_parallel_state_update.py [--num-cells N]
+    [--cell-size N] [--workers 1 2 4 ...]
+"""
+
+import argparse
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from copy import deepcopy
+import time
+
+import numpy as np
+
+from conductor.cells import Band, Cell, CellPixelIndex, HydroResponseUnit,\
+  HruStateStore, bin_bands_and_glaciers, update_area_fracs, update_glacier_mask
+
+NUM_SNOW_BANDS = 5
+VEG_TYPES = [11, 12, 13]
+
+def synthetic_domain(num_cells, cell_size, seed=0):
+  """ Returns cells on a row of square cell_size x cell_size pixel cells with
+    random surface elevations spanning 5 bands, their cell ID map and areas,
+    and a bed DEM under glaciers up to 30m thick on part of each cell
+  """
+  rng = np.random.RandomState(seed)
+  cell_ids = [str(10000 + i) for i in range(num_cells)]
+  cellid_map = np.repeat(np.array(cell_ids, dtype=float), cell_size)\
+    [np.newaxis, :].repeat(cell_size, axis=0)
+  surf_dem = 2000 + 490 * rng.rand(cell_size, num_cells * cell_size)
+  thickness = np.where(rng.rand(*surf_dem.shape) < 0.4,\
+    30 * rng.rand(*surf_dem.shape), 0)
+  bed_dem = surf_dem - thickness
+  cell_areas = { cell_id: cell_size * cell_size for cell_id in cell_ids }
+
+  hru_store = HruStateStore()
+  cells = OrderedDict()
+  for cell_id in cell_ids:
+    bands = [Band(2000 + 100 * i) for i in range(NUM_SNOW_BANDS)]
+    cells[cell_id] = Cell(bands, hru_store)
+  # Split each band's non-glacier area between open ground and vegetation
+  glacier_mask = update_glacier_mask(surf_dem, bed_dem, *surf_dem.shape, 2.0)
+  band_areas, glacier_areas = bin_bands_and_glaciers(cells, cell_areas,\
+    cellid_map, NUM_SNOW_BANDS, surf_dem, glacier_mask)
+  for cell_id, cell in cells.items():
+    for band_id, band in enumerate(cell.bands):
+      area = cell_areas[cell_id]
+      non_glacier = (band_areas[cell_id][band_id]\
+        - glacier_areas[cell_id][band_id]) / area
+      band.hrus[Band.glacier_id] = HydroResponseUnit(\
+        glacier_areas[cell_id][band_id] / area, Band.glacier_root_zone_parms,\
+        band_id, Band.glacier_id, hru_store)
+      band.hrus[Band.open_ground_id] = HydroResponseUnit(non_glacier / 2,\
+        Band.open_ground_root_zone_parms, band_id, Band.open_ground_id,\
+        hru_store)
+      for veg_type in VEG_TYPES:
+        band.hrus[veg_type] = HydroResponseUnit(\
+          non_glacier / 2 / len(VEG_TYPES), [0.1] * 6, band_id, veg_type,\
+          hru_store)
+      for hru in band.hrus.values():
+        hru.hru_state.variables['SNOW_SWQ'] = rng.rand()
+        hru.hru_state.variables['LAYER_MOIST'] = rng.rand(1, Cell.Nlayers)
+    cell.update_cell_state()
+  return cells, cellid_map, cell_areas, surf_dem, bed_dem
+
+def snapshot(cells):
+  return [(band.median_elev, [(veg_type, hru.area_frac,\
+    [np.asarray(value).tolist() for value in hru.hru_state.variables.values()])\
+    for veg_type, hru in band.hrus.items()])\
+    for cell in cells.values() for band in cell.bands]
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__,\
+    formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--num-cells', type=int, default=4000)
+  parser.add_argument('--cell-size', type=int, default=16)
+  parser.add_argument('--workers', type=int, nargs='+', default=[2, 4, 8])
+  args = parser.parse_args()
+
+  cells, cellid_map, cell_areas, surf_dem, bed_dem =\
+    synthetic_domain(args.num_cells, args.cell_size)
+  pixel_index = CellPixelIndex.from_cell_mask(cellid_map, list(cells.keys()))
+  # Glaciers thicken by up to 60m, changing most bands of most cells
+  rng = np.random.RandomState(1)
+  new_surf_dem = np.minimum(surf_dem + 60 * rng.rand(*surf_dem.shape), 2499)
+  glacier_mask = update_glacier_mask(new_surf_dem, bed_dem,\
+    *new_surf_dem.shape, 2.0)
+
+  def run(executor=None, num_shards=None):
+    run_cells = deepcopy(cells)
+    start = time.perf_counter()
+    update_area_fracs(run_cells, cell_areas, cellid_map, NUM_SNOW_BANDS,\
+      new_surf_dem, glacier_mask, pixel_index, executor, num_shards)
+    return time.perf_counter() - start, snapshot(run_cells)
+
+  print('{} cells of {} pixels, {} HRUs'.format(args.num_cells,\
+    args.cell_size ** 2, args.num_cells * NUM_SNOW_BANDS\
+    * (2 + len(VEG_TYPES))))
+  serial_time, expected = run()
+  print('{:10s} {:8.2f} s'.format('serial', serial_time))
+  for num_workers in args.workers:
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+      # warm up the worker processes
+      list(executor.map(abs, range(num_workers)))
+      timing, result = run(executor, num_workers)
+    assert result == expected, 'results differ with {} workers'\
+      .format(num_workers)
+    print('{:10s} {:8.2f} s  ({:.1f}x)'.format(\
+      '{} workers'.format(num_workers), timing, serial_time / timing))
+
+if __name__ == '__main__':
+  main()
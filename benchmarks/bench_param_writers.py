@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+""" Benchmarks conductor.snbparams.save_snb_parms and
+  conductor.vegparams.save_veg_parms against the original csv.writer based
+  writers on a large synthetic domain, checking that the output is
+  byte-identical. Both are timed writing out all cells (no line cache).
+
+  Usage: python benchmarks/bench_param_writers.py [--num-cells N]
+    [--num-bands N] [--repeat N]
+"""
+
+import argparse
+from collections import OrderedDict
+import csv
+import filecmp
+import os
+import random
+import tempfile
+import time
+
+import numpy as np
+
+from conductor.cells import Band, Cell, HydroResponseUnit, HruState,\
+  HruStateStore
+from conductor.snbparams import save_snb_parms
+from conductor.vegparams import save_veg_parms
+
+VEG_TYPES = list(range(11, 20))
+
+def save_snb_parms_csv(cells, filename):
+  """ Reference implementation: the original csv.writer based writer """
+  with open(filename, 'w') as f:
+    writer = csv.writer(f, delimiter=' ')
+    for cell_id, cell in cells.items():
+      area_fracs = []
+      elevations = []
+      for band in cell.bands:
+        area_fracs.append(band.area_frac)
+        if band.num_hrus > 0:
+          elevations.append(band.median_elev)
+        else:
+          elevations.append(0)
+      line = [cell_id] + area_fracs + elevations + [1]*cell.num_bands
+      writer.writerow(line)
+
+def save_veg_parms_csv(cells, filename):
+  """ Reference implementation: the original csv.writer based writer """
+  with open(filename, 'w') as f:
+    writer = csv.writer(f, delimiter=' ')
+    for cell_id, cell in cells.items():
+      writer.writerow( [ cell_id, sum([band.num_hrus for band in cell.bands]) ] )
+      for band_id, band in enumerate(cell.bands):
+        for veg_type, hru in band.hrus.items():
+          line = [veg_type, hru.area_frac] + hru.root_zone_parms + [ band_id ]
+          writer.writerow(line)
+
+def synthetic_cells(num_cells, num_bands, seed=0):
+  """ Returns num_cells cells of num_bands bands each, some of them empty
+    placeholders, holding random HRUs with random area fractions. Median
+    elevations are a mix of ints (as read from the Snow Band File) and
+    np.float64 (as computed from the DEM).
+  """
+  rng = random.Random(seed)
+  # The HRU states are not written out, so they all share one slot
+  hru_store = HruStateStore()
+  hru_state = HruState(0, VEG_TYPES[0], hru_store)
+  cells = OrderedDict()
+  for cell_num in range(num_cells):
+    bands = []
+    for band_id in range(num_bands):
+      median_elev = 2000 + 100 * band_id + rng.randint(0, 99)
+      if rng.random() < 0.5:
+        median_elev = np.float64(median_elev + rng.random())
+      band = Band(median_elev)
+      if 0 < band_id < num_bands - 1:
+        for veg_type in rng.sample(VEG_TYPES, rng.randint(1, 4)):
+          band.hrus[veg_type] = HydroResponseUnit(rng.random() / num_bands,\
+            [0.10, 0.60, 0.50, 0.30, 1.00, 0.10], band_id, veg_type,\
+            hru_store, hru_state)
+      bands.append(band)
+    cells[str(100000 + cell_num)] = Cell(bands, hru_store)
+  return cells
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__,\
+    formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--num-cells', type=int, default=50000)
+  parser.add_argument('--num-bands', type=int, default=15)
+  parser.add_argument('--repeat', type=int, default=3)
+  args = parser.parse_args()
+
+  cells = synthetic_cells(args.num_cells, args.num_bands)
+  num_hrus = sum(band.num_hrus for cell in cells.values()\
+    for band in cell.bands)
+  print('{} cells, {} bands, {} HRUs'.format(len(cells),\
+    len(cells) * args.num_bands, num_hrus))
+  with tempfile.TemporaryDirectory() as tmpdir:
+    for name, old_writer, new_writer in [\
+        ('snow band file', save_snb_parms_csv, save_snb_parms),\
+        ('vegetation parameter file', save_veg_parms_csv, save_veg_parms)]:
+      old_file = os.path.join(tmpdir, 'old.txt')
+      new_file = os.path.join(tmpdir, 'new.txt')
+      timings = []
+      for label, writer, filename in [('csv.writer', old_writer, old_file),\
+          ('array-native', new_writer, new_file)]:
+        best = float('inf')
+        for _ in range(args.repeat):
+          start = time.perf_counter()
+          writer(cells, filename)
+          best = min(best, time.perf_counter() - start)
+        timings.append((label, best))
+      assert filecmp.cmp(old_file, new_file, shallow=False),\
+        '{} output differs'.format(name)
+      print(name)
+      for label, timing in timings:
+        print('  {:>14s} {:6.2f} s ({:.1f}x)'.format(label, timing,\
+          timings[0][1] / timing))
+
+if __name__ == '__main__':
+  main()
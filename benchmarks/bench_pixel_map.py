@@ -0,0 +1,97 @@
+#!/usr/bin/env python
+""" Benchmarks conductor.file_io.get_rgm_pixel_mapping against the original
+  line-by-line loader on a synthetic RGM pixel to VIC cell mapping file, and
+  checks that both produce identical outputs.
+
+  Usage: python benchmarks/bench_pixel_map.py [--num-rows N] [--num-cols N]
+"""
+
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from conductor.file_io import get_rgm_pixel_mapping
+
+def get_rgm_pixel_mapping_by_line(pixel_map_file):
+  """ Reference implementation: the original line-by-line loader """
+  cell_areas = {}
+  headers = {}
+  with open(pixel_map_file, 'r') as f:
+    for _ in range(2):
+      key, value = f.readline().split(None, 1)
+      headers[key] = value
+    nx = int(headers['NCOLS'])
+    ny = int(headers['NROWS'])
+    cell_id_map = np.empty((ny, nx))
+    cell_id_map.fill(np.nan)
+    _ = f.readline()
+    for line in f:
+      _, i, j, _, _, cell_id = line.split()
+      i, j = int(i), int(j)
+      if cell_id != 'NA':
+        cell_id_map[i,j] = cell_id
+      if cell_id in cell_areas:
+        cell_areas[cell_id] += 1
+      else:
+        cell_areas[cell_id] = 1
+  with np.errstate(invalid='ignore'):
+    vic_cell_mask = np.ma.masked_array(np.int32(cell_id_map))
+  vic_cell_mask[np.where(np.isnan(cell_id_map))] = np.ma.masked
+
+  return vic_cell_mask, cell_areas, nx, ny
+
+def write_synthetic_map(fname, num_rows, num_cols, cell_size=200):
+  """ Writes a column-major mapping file with square VIC cells of
+    cell_size x cell_size pixels and a 10% NA border
+  """
+  rows, cols = np.meshgrid(np.arange(num_rows), np.arange(num_cols),\
+    indexing='ij')
+  rows, cols = rows.T.ravel(), cols.T.ravel()
+  cell_ids = (rows // cell_size) * 1000 + cols // cell_size + 10000
+  border = (rows < num_rows // 20) | (rows >= num_rows - num_rows // 20)
+  with open(fname, 'w') as f:
+    f.write('NCOLS {}\nNROWS {}\n'.format(num_cols, num_rows))
+    f.write('"PIXEL_ID" "ROW" "COL" "BAND" "ELEV" "CELL_ID"\n')
+    block = 1000000
+    for start in range(0, len(rows), block):
+      stop = min(start + block, len(rows))
+      ids = cell_ids[start:stop].astype(str).astype(object)
+      ids[border[start:stop]] = 'NA'
+      lines = ['{} {} {} 0 {} {}\n'.format(n + 1, r, c, 2000 + r % 500, i)\
+        for n, r, c, i in zip(range(start, stop), rows[start:stop],\
+          cols[start:stop], ids)]
+      f.writelines(lines)
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__,\
+    formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--num-rows', type=int, default=2500)
+  parser.add_argument('--num-cols', type=int, default=4000)
+  args = parser.parse_args()
+
+  with tempfile.TemporaryDirectory() as tmpdir:
+    fname = os.path.join(tmpdir, 'rgm_vic_map_synthetic.txt')
+    print('Writing synthetic {} x {} ({} line) map...'.format(args.num_rows,\
+      args.num_cols, args.num_rows * args.num_cols))
+    write_synthetic_map(fname, args.num_rows, args.num_cols)
+
+    start = time.perf_counter()
+    old = get_rgm_pixel_mapping_by_line(fname)
+    old_time = time.perf_counter() - start
+    start = time.perf_counter()
+    new = get_rgm_pixel_mapping(fname)
+    new_time = time.perf_counter() - start
+
+  assert np.array_equal(np.ma.getmaskarray(old[0]), np.ma.getmaskarray(new[0]))
+  assert np.array_equal(old[0].compressed(), new[0].compressed())
+  assert list(old[1].items()) == list(new[1].items())
+  assert old[2:] == new[2:]
+  print('line-by-line loader: {:8.2f} s'.format(old_time))
+  print('bulk loader:         {:8.2f} s  ({:.1f}x)'.format(new_time,\
+    old_time / new_time))
+
+if __name__ == '__main__':
+  main()
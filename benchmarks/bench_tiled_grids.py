@@ -0,0 +1,124 @@
+#!/usr/bin/env python
+""" Benchmarks the peak memory of the DEM-wide operations of the conductor
+  (bed DEM reconciliation, glacier mask update, mass balance gridding and
+  band binning) on memory-mapped synthetic grids, processed in a single
+  whole-grid tile and in tiles of decreasing size, checking that all tile
+  sizes give identical results. Peak memory is that of the heap allocations
+  made during the operations (as traced by tracemalloc, which numpy reports
+  its arrays to), so it excludes the memory-mapped grids themselves.
+
+  Usage: python benchmarks/bench_tiled_grids.py [--num-rows N] [--num-cols N]
+    [--cell-size N] [--tile-pixels N N ...]
+"""
+
+import argparse
+from collections import OrderedDict
+import os
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+
+from conductor.cells import Band, Cell, CellPixelIndex, HruStateStore,\
+  reconcile_bed_dem, update_glacier_mask, bin_bands_and_glaciers
+from conductor.file_io import mass_balances_to_rgm_grid
+from conductor.grids import new_grid, memmap_grid
+
+NUM_SNOW_BANDS = 5
+
+def synthetic_grids(num_rows, num_cols, cell_size, seed=0):
+  """ Returns the cells, cell ID mask, surface DEM and bed DEM of a domain of
+    square cell_size x cell_size pixel cells (all but the first row of cells
+    lying in the VIC domain), with surface elevations spanning 5 bands
+  """
+  rng = np.random.RandomState(seed)
+  rows = np.arange(num_rows) // cell_size
+  cols = np.arange(num_cols) // cell_size
+  num_cell_cols = cols[-1] + 1
+  cell_nums = 10000 + rows[:, np.newaxis] * num_cell_cols + cols
+  vic_cell_mask = np.ma.masked_array(cell_nums.astype(np.int32),
+                                     mask=(rows < 1)[:, np.newaxis]\
+                                     .repeat(num_cols, axis=1))
+  cells = OrderedDict((str(cell_num), Cell([Band(2000 + 100 * i)
+    for i in range(NUM_SNOW_BANDS)], HruStateStore()))
+    for cell_num in np.unique(vic_cell_mask.compressed()))
+  surf_dem = 2000 + 490 * rng.rand(num_rows, num_cols)
+  # Bed up to 30m under the surface, and above it in a few places
+  bed_dem = surf_dem - 30 * rng.rand(num_rows, num_cols) + 1
+  return cells, vic_cell_mask, surf_dem, bed_dem
+
+def main():
+  parser = argparse.ArgumentParser(description=__doc__,\
+    formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument('--num-rows', type=int, default=4000)
+  parser.add_argument('--num-cols', type=int, default=4000)
+  parser.add_argument('--cell-size', type=int, default=100)
+  parser.add_argument('--tile-pixels', type=int, nargs='+',
+                      default=[2**22, 2**20, 2**18])
+  args = parser.parse_args()
+
+  num_rows, num_cols = args.num_rows, args.num_cols
+  cells, vic_cell_mask, surf_dem, bed_dem = synthetic_grids(num_rows,\
+    num_cols, args.cell_size)
+  pixel_index = CellPixelIndex.from_cell_mask(vic_cell_mask,\
+    list(cells.keys()))
+  cell_areas = { cell_id: pixel_index.num_cell_pixels(cell_id)
+                 for cell_id in cells }
+  gmb_polys = { cell_id: [-10.0, 0.005, 0.000001] for cell_id in cells }
+
+  with tempfile.TemporaryDirectory() as tmpdir:
+    def path(name):
+      return os.path.join(tmpdir, name)
+
+    def run(tile_pixels):
+      """ Runs all operations on fresh memory-mapped copies of the DEMs,
+        returning the time taken, peak traced memory and the results
+      """
+      run_surf_dem = memmap_grid(surf_dem, path('surf_dem.dat'))
+      run_bed_dem = memmap_grid(bed_dem, path('bed_dem.dat'))
+      glacier_mask = new_grid((num_rows, num_cols),\
+        filename=path('glacier_mask.dat'))
+      mass_balance_grid = new_grid((num_rows, num_cols),\
+        filename=path('mass_balance_grid.dat'))
+      tracemalloc.start()
+      start = time.perf_counter()
+      num_adjusted = reconcile_bed_dem(run_surf_dem, run_bed_dem, num_rows,\
+        num_cols, tile_pixels)
+      update_glacier_mask(run_surf_dem, run_bed_dem, num_rows, num_cols,\
+        2.0, glacier_mask, tile_pixels)
+      mass_balances_to_rgm_grid(gmb_polys, vic_cell_mask, run_surf_dem,\
+        run_bed_dem, num_rows, num_cols, pixel_index, mass_balance_grid,\
+        tile_pixels)
+      band_areas, glacier_areas = bin_bands_and_glaciers(cells, cell_areas,\
+        vic_cell_mask, NUM_SNOW_BANDS, run_surf_dem, glacier_mask,\
+        pixel_index, tile_pixels)
+      timing = time.perf_counter() - start
+      _, peak = tracemalloc.get_traced_memory()
+      tracemalloc.stop()
+      median_elevs = [band.median_elev for cell in cells.values()\
+        for band in cell.bands]
+      return timing, peak, (num_adjusted, np.array(glacier_mask),\
+        np.array(mass_balance_grid), band_areas, glacier_areas, median_elevs)
+
+    grid_mb = num_rows * num_cols * 8 / 2**20
+    print('{} x {} grid ({:.0f} MB per float64 grid), {} cells'.format(\
+      num_rows, num_cols, grid_mb, len(cells)))
+    print('{:>22s} {:>8s} {:>14s}'.format('tile pixels', 'time', 'peak memory'))
+    expected = None
+    for tile_pixels in [num_rows * num_cols] + args.tile_pixels:
+      timing, peak, results = run(tile_pixels)
+      if expected is None:
+        expected = results
+      else:
+        assert all(np.array_equal(result, expected_result) if\
+          isinstance(result, np.ndarray) else result == expected_result\
+          for result, expected_result in zip(results, expected)),\
+          'results differ with {} pixel tiles'.format(tile_pixels)
+      label = '{} (whole grid)'.format(tile_pixels)\
+        if tile_pixels == num_rows * num_cols else str(tile_pixels)
+      print('{:>22s} {:6.2f} s {:10.0f} MB'.format(label, timing,\
+        peak / 2**20))
+
+if __name__ == '__main__':
+  main()
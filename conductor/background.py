@@ -0,0 +1,93 @@
+"""background.py
+
+  This module provides a worker that runs the non-critical tasks of the
+  hydro-conductor (writing trace files, removing temporary files) in a
+  background thread, so that the main loop can go on to the next model run
+  while they complete.
+"""
+
+__all__ = ['BackgroundWorker']
+
+import logging
+import queue
+import threading
+
+class BackgroundWorker(object):
+  """Runs tasks in submission order in a background thread. At most
+    max_pending tasks are queued, submit() blocking while the queue is full,
+    and with max_pending=0 tasks are run synchronously by submit() instead.
+    An exception (of any kind, e.g. SystemExit) raised by a task is re-raised
+    by the next call to submit() or flush(), and the tasks queued after it
+    are dropped.
+  """
+  def __init__(self, max_pending=2):
+    self.error = None
+    # (incremented each time an error is re-raised, so that tasks queued
+    # before that are dropped even once the error has been cleared)
+    self.generation = 0
+    self.lock = threading.Lock()
+    self.thread = None
+    if max_pending > 0:
+      self.tasks = queue.Queue(maxsize=max_pending)
+      # (a daemon thread, so that an exit of the main thread with tasks
+      # pending isn't held up; shutdown() should be called before exiting)
+      self.thread = threading.Thread(target=self._run,\
+        name='BackgroundWorker', daemon=True)
+      self.thread.start()
+
+  def _run(self):
+    while True:
+      task = self.tasks.get()
+      try:
+        if task is None:
+          return
+        func, args, generation = task
+        with self.lock:
+          dropped = self.error is not None or generation != self.generation
+        if not dropped:
+          func(*args)
+      except BaseException as e:
+        # (including e.g. SystemExit, which would otherwise end the thread
+        # and leave submit() and flush() waiting on the queue for good)
+        logging.error('Background task %s failed: %s',\
+          getattr(func, '__name__', repr(func)), e)
+        with self.lock:
+          self.error = e
+      finally:
+        self.tasks.task_done()
+
+  def _raise_error(self):
+    with self.lock:
+      error = self.error
+      if error is not None:
+        self.error = None
+        self.generation += 1
+    if error is not None:
+      raise error
+
+  def submit(self, func, *args):
+    """ Queues func(*args) to be run in the background """
+    self._raise_error()
+    if self.thread is None:
+      func(*args)
+    else:
+      with self.lock:
+        generation = self.generation
+      self.tasks.put((func, args, generation))
+
+  def flush(self):
+    """ Waits for all tasks submitted so far to complete """
+    if self.thread is not None:
+      self.tasks.join()
+    self._raise_error()
+
+  def shutdown(self):
+    """ Completes all submitted tasks and stops the background thread. Safe
+      to call more than once.
+    """
+    if self.thread is None:
+      return
+    self.tasks.put(None)
+    self.thread.join()
+    self.thread = None
+    self._raise_error()
@@ -0,0 +1,201 @@
+"""cache.py
+
+  This module provides a binary sidecar cache for the large text inputs of the
+  hydro-conductor (the RGM pixel to VIC cell map, the DEMs and the glacier
+  mask), so that repeated runs and restarts can skip the text parsing.
+
+  Each cache entry is an .npz file holding the loaded values along with the
+  size, modification time and SHA-1 content hash of the source file it was
+  loaded from, and the loader it was loaded by (its qualified name, cache
+  version and arguments). An entry is used as is if the size and modification time of
+  the source still match; if only the modification time differs the content
+  hash is checked (and the entry refreshed), and otherwise the source is
+  parsed again and the entry rewritten.
+
+  It also provides a writer for the text files the hydro-conductor writes out
+  anew on every iteration (the VIC parameter files), which reuses the last
+  file written when the new contents hash the same.
+"""
+
+__all__ = ['load_cached', 'file_sha1', 'ReusingTextWriter']
+
+import functools
+import hashlib
+import logging
+import os
+import shutil
+
+import numpy as np
+
+# Version of the cache entry layout, bumped whenever it changes
+CACHE_VERSION = 2
+
+def file_sha1(fname, block_size=2**20):
+  """ Returns the hex SHA-1 digest of the contents of file fname """
+  sha1 = hashlib.sha1()
+  with open(fname, 'rb') as f:
+    for block in iter(lambda: f.read(block_size), b''):
+      sha1.update(block)
+  return sha1.hexdigest()
+
+def _pack(values):
+  """ Flattens a tuple of ndarrays, masked arrays, ordered dicts of scalars
+    and scalars into a dict of arrays that np.savez can store
+  """
+  arrays = {}
+  for i, value in enumerate(values):
+    if isinstance(value, np.ma.MaskedArray):
+      arrays['ma_{}_data'.format(i)] = np.ma.getdata(value)
+      arrays['ma_{}_mask'.format(i)] = np.ma.getmaskarray(value)
+    elif isinstance(value, np.ndarray):
+      arrays['nd_{}'.format(i)] = value
+    elif isinstance(value, dict):
+      arrays['dict_{}_keys'.format(i)] = np.array(list(value.keys()), str)
+      arrays['dict_{}_values'.format(i)] = np.array(list(value.values()))
+    else:
+      arrays['scalar_{}'.format(i)] = np.array(value)
+  return arrays
+
+def _unpack(arrays, num_values):
+  """ Inverse of _pack() """
+  values = []
+  for i in range(num_values):
+    if 'ma_{}_data'.format(i) in arrays:
+      values.append(np.ma.masked_array(arrays['ma_{}_data'.format(i)],\
+        mask=arrays['ma_{}_mask'.format(i)]))
+    elif 'nd_{}'.format(i) in arrays:
+      values.append(arrays['nd_{}'.format(i)])
+    elif 'dict_{}_keys'.format(i) in arrays:
+      values.append(dict(zip(arrays['dict_{}_keys'.format(i)].tolist(),\
+        arrays['dict_{}_values'.format(i)].tolist())))
+    else:
+      values.append(arrays['scalar_{}'.format(i)].item())
+  return tuple(values)
+
+def _loader_key(loader, loader_kwargs):
+  """ Returns a string identifying loader by its qualified name, its
+    cache_version attribute (0 if it has none) and the arguments it is given
+    (those of a functools.partial included)
+  """
+  args = ()
+  kwargs = dict(loader_kwargs)
+  while isinstance(loader, functools.partial):
+    args = loader.args + args
+    kwargs = dict(loader.keywords, **kwargs)
+    loader = loader.func
+  qualname = getattr(loader, '__qualname__', type(loader).__qualname__)
+  return '{}.{} v{} args={!r} kwargs={!r}'.format(loader.__module__,\
+    qualname, getattr(loader, 'cache_version', 0), args,\
+    sorted(kwargs.items()))
+
+def _cache_filename(source_file, cache_dir, name, loader_key):
+  """ Returns the cache entry path for source_file as loaded by the loader
+    identified by loader_key and registered under name
+  """
+  key_hash = hashlib.sha1('{}\n{}'.format(os.path.abspath(source_file),\
+    loader_key).encode()).hexdigest()
+  return os.path.join(cache_dir, '{}_{}.npz'.format(name, key_hash[:16]))
+
+def _write_entry(cache_file, loader_key, source_stat, source_sha1, values,\
+  single):
+  """ Writes a cache entry atomically (via a temporary file) """
+  arrays = _pack((values,) if single else values)
+  arrays['meta_version'] = np.array(CACHE_VERSION)
+  arrays['meta_loader'] = np.array(loader_key)
+  arrays['meta_size'] = np.array(source_stat.st_size)
+  arrays['meta_mtime_ns'] = np.array(source_stat.st_mtime_ns)
+  arrays['meta_sha1'] = np.array(source_sha1)
+  arrays['meta_num_values'] = np.array(1 if single else len(values))
+  arrays['meta_single'] = np.array(single)
+  temp_file = cache_file + '.tmp'
+  with open(temp_file, 'wb') as f:
+    np.savez(f, **arrays)
+  os.replace(temp_file, cache_file)
+
+def load_cached(source_file, loader, cache_dir, name, **loader_kwargs):
+  """ Returns loader(source_file, **loader_kwargs), reading it from the cache
+    entry for source_file in cache_dir (namespaced by name) when that entry
+    is still valid, and (re)writing the entry otherwise. The loader may
+    return a single ndarray, or a tuple of ndarrays, masked arrays, dicts of
+    scalars and scalars.
+    Entries are only used by the same loader, as told by its qualified name
+    and arguments. A loader can declare a cache_version attribute, to be
+    bumped whenever what it returns for the same file changes, so that the
+    entries written by its earlier versions aren't used.
+  """
+  os.makedirs(cache_dir, exist_ok=True)
+  loader_key = _loader_key(loader, loader_kwargs)
+  cache_file = _cache_filename(source_file, cache_dir, name, loader_key)
+  source_stat = os.stat(source_file)
+  source_sha1 = None
+  if os.path.isfile(cache_file):
+    try:
+      with np.load(cache_file) as entry:
+        arrays = dict(entry)
+      if int(arrays['meta_version']) != CACHE_VERSION \
+        or str(arrays['meta_loader']) != loader_key \
+        or int(arrays['meta_size']) != source_stat.st_size:
+        raise KeyError('stale entry')
+      mtime_matches = \
+        int(arrays['meta_mtime_ns']) == source_stat.st_mtime_ns
+      if not mtime_matches:
+        source_sha1 = file_sha1(source_file)
+        if source_sha1 != str(arrays['meta_sha1']):
+          raise KeyError('stale entry')
+      values = _unpack(arrays, int(arrays['meta_num_values']))
+      single = bool(arrays['meta_single'])
+      if single:
+        values = values[0]
+      if not mtime_matches:
+        # Contents unchanged (e.g. the file was touched or copied)
+        _write_entry(cache_file, loader_key, source_stat, source_sha1,\
+          values, single)
+      logging.debug('Loaded %s from cache entry %s', source_file, cache_file)
+      return values
+    except (KeyError, ValueError, OSError) as e:
+      logging.debug('Cache entry %s for %s not used (%s)', cache_file,\
+        source_file, e)
+  values = loader(source_file, **loader_kwargs)
+  if source_sha1 is None:
+    source_sha1 = file_sha1(source_file)
+  _write_entry(cache_file, loader_key, source_stat, source_sha1, values,\
+    not isinstance(values, tuple))
+  return values
+
+class ReusingTextWriter(object):
+  """Writes successive versions of a text file (e.g. the VIC parameter file
+    of each year), skipping the write when the contents are the same as
+    those last written, as told by their SHA-1 hash. The last file is then
+    reused: hard-linked to the new file name if link is True (or copied,
+    where hard links aren't supported), and otherwise referred to under its
+    own name.
+  """
+  def __init__(self, link=False):
+    self.link = link
+    self.sha1 = None
+    self.filename = None
+
+  def write(self, text, filename):
+    """ Writes text to filename unless the last file written holds the same
+      text, and returns the name of the file holding text
+    """
+    sha1 = hashlib.sha1(text.encode()).hexdigest()
+    if sha1 == self.sha1 and os.path.isfile(self.filename):
+      if not self.link or filename == self.filename:
+        logging.debug('Contents of %s unchanged, reusing %s', filename,\
+          self.filename)
+        return self.filename
+      if os.path.lexists(filename):
+        os.remove(filename)
+      try:
+        os.link(self.filename, filename)
+        logging.debug('Contents of %s unchanged, hard-linked to %s',\
+          filename, self.filename)
+      except OSError:
+        shutil.copyfile(self.filename, filename)
+      return filename
+    with open(filename, 'w') as f:
+      f.write(text)
+    self.sha1 = sha1
+    self.filename = filename
+    return filename
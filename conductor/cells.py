@@ -7,11 +7,14 @@
 """
 
 from collections import OrderedDict
+from collections.abc import MutableMapping
 from copy import deepcopy
 from math import ceil
 import numpy as np
-import itertools
 import logging
+import os
+
+from conductor.grids import TILE_PIXELS, row_tiles
 
 # Some global constants. These are set in the VIC header snow.h.
 # TODO: Maybe they should be passed in via command line parameter or state file?
@@ -21,6 +24,10 @@ CH_ICE = 2100E+03
 # TODO: this is probably redundant since we use 1/cell_areas[cell_id]
 # for determining the minimum possible non-zero area fraction
 ZERO_AREA_FRAC_TOL = 0.00001
+# Relative tolerance under which surface DEM pixel elevations are considered
+# unchanged, covering the float32 rounding of DEMs exchanged with the RGM as
+# DSBB grids
+ELEVATION_RTOL = np.finfo(np.float32).eps
 
 # This is necessary pre-Python 3.5, after which point use math.isclose()
 def isclose(a, b, rel_tol=1e-09, abs_tol=0.0):
@@ -36,12 +43,16 @@ class Cell(object):
   dist = 1
   NglacMassBalanceEqnTerms = 3
 
-  def __init__(self, bands):
+  def __init__(self, bands, hru_store):
     self.bands = bands
     self.cell_state = CellState()
+    # The HruStateStore in which the states of the cell's HRUs are held
+    self.hru_store = hru_store
 
   def __eq__(self, other):
-    return (self.__class__ == other.__class__ and self.__dict__ == other.__dict__)
+    # (HRU states are compared by value, wherever they are stored)
+    return (self.__class__ == other.__class__ and self.bands == other.bands \
+      and self.cell_state == other.cell_state)
 
   def update_cell_state(self):
     self.cell_state.variables['VEG_TYPE_NUM'] = sum([i.num_hrus for i in self.bands])
@@ -141,20 +152,23 @@ class Band(object):
     return sum([hru.area_frac for veg_type, hru in self.hrus.items()\
       if veg_type == self.open_ground_id])
 
-  def create_hru(self, band_id, veg_type, area_frac):
-    """Creates a new HRU of provided veg_type and area_frac
+  def create_hru(self, band_id, veg_type, area_frac, hru_store):
+    """Creates a new HRU of provided veg_type and area_frac, with its state
+      in hru_store
     """
     # Append new hru to existing dict of HRUs for this band
     if veg_type == self.glacier_id:
       self.hrus[veg_type] = HydroResponseUnit(area_frac,\
-        self.glacier_root_zone_parms, band_id, veg_type)
+        self.glacier_root_zone_parms, band_id, veg_type, hru_store)
     elif veg_type == self.open_ground_id:
       self.hrus[veg_type] = HydroResponseUnit(area_frac,\
-        self.open_ground_root_zone_parms, band_id, veg_type)
+        self.open_ground_root_zone_parms, band_id, veg_type, hru_store)
 
   def delete_hru(self, veg_type):
-    """Deletes an HRU of veg_type within the Band
+    """Deletes an HRU of veg_type within the Band, releasing its slot in the
+      HRU state store
     """
+    self.hrus[veg_type].hru_state.release()
     del self.hrus[veg_type]
 
   def __del__(self):
@@ -173,10 +187,14 @@ class HydroResponseUnit(object):
   """Class capturing vegetation parameters at the single vegetation
     tile (HRU) level (of which there can be many per band).
   """
-  def __init__(self, area_frac, root_zone_parms, band_id, veg_type):
+  def __init__(self, area_frac, root_zone_parms, band_id, veg_type,
+               hru_store, hru_state=None):
     self.area_frac = area_frac
     self.root_zone_parms = root_zone_parms
-    self.hru_state = HruState(band_id, veg_type)
+    # (hru_state, if given, is a state already allocated in hru_store)
+    if hru_state is None:
+      hru_state = HruState(band_id, veg_type, hru_store)
+    self.hru_state = hru_state
   def __repr__(self):
     return '{}({}, {})'.format(self.__class__.__name__,
                    self.area_frac, self.root_zone_parms)
@@ -189,68 +207,456 @@ class HydroResponseUnit(object):
   def __ne__(self, other):
     return not self.__eq__(other)
 
+def default_hru_state_values(band_id, veg_type):
+  """ Returns the initial values of the VIC HRU state variables for a new HRU,
+    as an OrderedDict in state update order
+  """
+  # variables is an OrderedDict because there is temporal dependence in the
+  # state update among some of them when update_hru_state() is called
+  return OrderedDict([
+    # HRU state variables with dimensions (lat, lon, hru)
+    ('HRU_BAND_INDEX', band_id),
+    ('HRU_VEG_INDEX', veg_type),
+    # These two have dimensions (lat, lon, hru, dist, Nlayers)
+    ('LAYER_ICE_CONTENT', Cell.dist * [[0]*Cell.Nlayers]),
+    ('LAYER_MOIST', Cell.dist * [[0]*Cell.Nlayers]),
+    # HRU_VEG_VAR_WDEW has dimensions (lat, lon, hru, dist)
+    ('HRU_VEG_VAR_WDEW' , [0]),
+    # HRU state variables with dimensions (lat, lon, hru)
+    ('SNOW_SWQ', 0),
+    ('SNOW_DEPTH', 0),
+    ('SNOW_DENSITY', 0),
+    ('SNOW_CANOPY', 0),
+    ('SNOW_PACK_WATER', 0),
+    ('SNOW_SURF_WATER', 0),
+    ('GLAC_WATER_STORAGE', 0),
+    ('GLAC_CUM_MASS_BALANCE', 0),
+    # HRU state variables with dimensions (lat, lon, hru, Nnodes)
+    ('ENERGY_T', [0]*Cell.Nnodes),
+    ('ENERGY_T_FBCOUNT', [0]*Cell.Nnodes),
+    # HRU state variables with dimensions (lat, lon, hru)
+    ('ENERGY_TFOLIAGE', 0),
+    ('GLAC_SURF_TEMP', 0),
+    ('SNOW_SURF_TEMP', 0),
+    ('SNOW_COLD_CONTENT', 0),
+    ('SNOW_PACK_TEMP', 0),
+    ('SNOW_ALBEDO', 0),
+    ('SNOW_LAST_SNOW', 0),
+    ('SNOW_MELTING', 0),
+    ('ENERGY_TFOLIAGE_FBCOUNT', 0),
+    ('ENERGY_TCANOPY_FBCOUNT', 0),
+    ('ENERGY_TSURF_FBCOUNT', 0),
+    ('GLAC_SURF_TEMP_FBCOUNT', 0),
+    ('SNOW_SURF_TEMP_FBCOUNT', 0),
+    # remaining state variables from the "miscellaneous" list (lat, lon, hru)
+    ('GLAC_SURF_TEMP_FBFLAG', 0),
+    ('GLAC_VAPOR_FLUX', 0),
+    ('SNOW_CANOPY_ALBEDO', 0),
+    ('SNOW_SURFACE_FLUX', 0),
+    ('SNOW_SURF_TEMP_FBFLAG', 0),
+    ('SNOW_TMP_INT_STORAGE', 0),
+    ('SNOW_VAPOR_FLUX', 0)
+  ])
+
+class HruStateStore(object):
+  """Structure-of-arrays store of the VIC HRU state variables of many HRUs.
+    Each state variable (column) is held in float64 NumPy arrays (blocks) of
+    shape (block_size, ...), and each HRU owns one row (slot) across all of
+    them. The store grows a block at a time as slots run out, so rows never
+    move, and the array values returned by get() remain views into the
+    store. A column is only reallocated if a value of a different shape is
+    assigned to it (e.g. once Cell.Nlayers is known). Slots released by
+    deleted HRUs are reused.
+    A store is created per domain (or per worker process) and passed
+    explicitly to the cells and HRU states that use it. Copies of a store
+    (copy.deepcopy() or pickle) start out empty, and hold just the states
+    copied along with it.
+  """
+  def __init__(self, block_size=1024):
+    self.variable_names = []
+    self.shapes = {}
+    self.columns = {}
+    self.block_size = max(block_size, 1)
+    self.num_blocks = 0
+    self.num_slots = 0
+    self.free_slots = []
+
+  def __len__(self):
+    """ Number of slots in use """
+    return self.num_slots - len(self.free_slots)
+
+  @property
+  def capacity(self):
+    return self.num_blocks * self.block_size
+
+  def __deepcopy__(self, memo):
+    store = HruStateStore(self.block_size)
+    memo[id(self)] = store
+    return store
+
+  def __getstate__(self):
+    return self.block_size
+
+  def __setstate__(self, block_size):
+    self.__init__(block_size)
+
+  def _add_block(self):
+    for name, blocks in self.columns.items():
+      blocks.append(np.zeros((self.block_size,) + self.shapes[name]))
+    self.num_blocks += 1
+
+  def _fit_column(self, name, shape):
+    """ Returns the blocks of the column of variable name, (re)allocating
+      them if needed to hold values of shape. Scalars are broadcast over
+      array-valued variables (e.g. when zeroing ENERGY_T), as they would be
+      when written to the state file.
+    """
+    if name in self.columns:
+      if shape == () or shape == self.shapes[name]:
+        return self.columns[name]
+    else:
+      self.variable_names.append(name)
+    old_blocks = self.columns.get(name)
+    old_shape = self.shapes.get(name)
+    blocks = [np.zeros((self.block_size,) + shape)\
+      for _ in range(self.num_blocks)]
+    if old_blocks and len(shape) == len(old_shape):
+      # Keep the overlapping part of the existing rows
+      overlap = (slice(None),) + tuple(slice(0, min(a, b)) for a, b\
+        in zip(shape, old_shape))
+      for block, old_block in zip(blocks, old_blocks):
+        block[overlap] = old_block[overlap]
+    self.columns[name] = blocks
+    self.shapes[name] = shape
+    return blocks
+
+  def _block_rows(self, slots):
+    """ Yields (block, selection, rows) for each block holding any of an
+      array of slots, where slots[selection] are held at rows of the block
+    """
+    blocks, rows = np.divmod(slots, self.block_size)
+    if len(blocks) and blocks.min() == blocks.max():
+      yield int(blocks[0]), slice(None), rows
+    else:
+      for block in np.unique(blocks).tolist():
+        selection = blocks == block
+        yield block, selection, rows[selection]
+
+  def allocate(self, values):
+    """ Takes a free slot, sets its state variables from the values mapping,
+      and returns it
+    """
+    slot = int(self.allocate_rows(1)[0])
+    for name, value in values.items():
+      self.set(slot, name, value)
+    return slot
+
+  def allocate_rows(self, num_rows):
+    """ Takes num_rows free slots at once, leaving their state variables
+      zeroed, and returns them as an array
+    """
+    # Free slots are reused in the order allocate() would pop them
+    num_reused = min(num_rows, len(self.free_slots))
+    first_reused = len(self.free_slots) - num_reused
+    slots = self.free_slots[first_reused:][::-1]
+    del self.free_slots[first_reused:]
+    num_new = num_rows - num_reused
+    while self.num_slots + num_new > self.capacity:
+      self._add_block()
+    slots = np.concatenate((np.array(slots, dtype=np.intp),
+      np.arange(self.num_slots, self.num_slots + num_new, dtype=np.intp)))
+    self.num_slots += num_new
+    for block, _, rows in self._block_rows(slots):
+      for blocks in self.columns.values():
+        blocks[block][rows] = 0
+    return slots
+
+  def release(self, slot):
+    """ Returns slot to the pool of free slots """
+    self.free_slots.append(slot)
+
+  def get(self, slot, name):
+    """ Returns the value of state variable name at slot; array values are
+      views into the store
+    """
+    block, row = divmod(slot, self.block_size)
+    return self.columns[name][block][row]
+
+  def set(self, slot, name, value):
+    value = np.asarray(value, dtype=float)
+    block, row = divmod(slot, self.block_size)
+    self._fit_column(name, value.shape)[block][row] = value
+
+  def get_rows(self, slots, name):
+    """ Returns (a copy of) the values of state variable name at an array of
+      slots, one row per slot
+    """
+    slots = np.asarray(slots, dtype=np.intp)
+    blocks = self.columns[name]
+    values = np.empty((len(slots),) + self.shapes[name])
+    for block, selection, rows in self._block_rows(slots):
+      values[selection] = blocks[block][rows]
+    return values
+
+  def set_rows(self, slots, name, values):
+    """ Sets state variable name at an array of slots at once. values holds
+      one row per slot, or one scalar per slot (or in all) for array-valued
+      variables.
+    """
+    slots = np.asarray(slots, dtype=np.intp)
+    values = np.asarray(values, dtype=float)
+    blocks = self._fit_column(name, values.shape[1:])
+    shape = self.shapes[name]
+    if values.ndim == 1:
+      values = values.reshape((-1,) + (1,) * len(shape))
+    values = np.broadcast_to(values, (len(slots),) + shape)
+    for block, selection, rows in self._block_rows(slots):
+      blocks[block][rows] = values[selection]
+
+  def column(self, name):
+    """ Returns (a copy of) the column of state variable name over all slots
+      allocated so far (including any released ones)
+    """
+    return self.get_rows(np.arange(self.num_slots), name)
+
+class HruStateVariables(MutableMapping):
+  """Ordered mapping view of the state variables of one HRU in an
+    HruStateStore. Array-valued variables are returned as views into the
+    store, so that item assignment on them updates the store.
+  """
+  def __init__(self, store, slot):
+    self.store = store
+    self.slot = slot
+
+  def __getitem__(self, name):
+    if name not in self.store.columns:
+      raise KeyError(name)
+    return self.store.get(self.slot, name)
+
+  def __setitem__(self, name, value):
+    self.store.set(self.slot, name, value)
+
+  def __delitem__(self, name):
+    raise TypeError('HRU state variables cannot be deleted')
+
+  def __iter__(self):
+    return iter(self.store.variable_names)
+
+  def __len__(self):
+    return len(self.store.variable_names)
+
 class HruState(object):
-  """Class capturing the set of VIC HRU state variables.
+  """Class capturing the set of VIC HRU state variables. The values are held
+    in the HruStateStore passed in (normally the one of the whole domain) and
+    accessed through the variables mapping.
+    Each HruState owns its slot in the store until its HRU is deleted (by
+    Band.delete_hru(), which moves the state into a private store) or the
+    state is discarded. Copies (copy.deepcopy() or pickle) hold just the
+    copied states: states copied together share one new store holding only
+    them.
   """
-  def __init__(self, band_id, veg_type):
-    # variables is an OrderedDict because there is temporal dependence in the
-    # state update among some of them when update_hru_state() is called
-    self.variables = OrderedDict([
-      # HRU state variables with dimensions (lat, lon, hru)
-      ('HRU_BAND_INDEX', band_id),
-      ('HRU_VEG_INDEX', veg_type),
-      # These two have dimensions (lat, lon, hru, dist, Nlayers)
-      ('LAYER_ICE_CONTENT', Cell.dist * [[0]*Cell.Nlayers]),
-      ('LAYER_MOIST', Cell.dist * [[0]*Cell.Nlayers]),
-      # HRU_VEG_VAR_WDEW has dimensions (lat, lon, hru, dist)
-      ('HRU_VEG_VAR_WDEW' , [0]),
-      # HRU state variables with dimensions (lat, lon, hru)
-      ('SNOW_SWQ', 0),
-      ('SNOW_DEPTH', 0),
-      ('SNOW_DENSITY', 0),
-      ('SNOW_CANOPY', 0),
-      ('SNOW_PACK_WATER', 0),
-      ('SNOW_SURF_WATER', 0),
-      ('GLAC_WATER_STORAGE', 0),
-      ('GLAC_CUM_MASS_BALANCE', 0),
-      # HRU state variables with dimensions (lat, lon, hru, Nnodes)
-      ('ENERGY_T', [0]*Cell.Nnodes),
-      ('ENERGY_T_FBCOUNT', [0]*Cell.Nnodes),
-      # HRU state variables with dimensions (lat, lon, hru)
-      ('ENERGY_TFOLIAGE', 0),
-      ('GLAC_SURF_TEMP', 0),
-      ('SNOW_SURF_TEMP', 0),
-      ('SNOW_COLD_CONTENT', 0),
-      ('SNOW_PACK_TEMP', 0),
-      ('SNOW_ALBEDO', 0),
-      ('SNOW_LAST_SNOW', 0),
-      ('SNOW_MELTING', 0),
-      ('ENERGY_TFOLIAGE_FBCOUNT', 0),
-      ('ENERGY_TCANOPY_FBCOUNT', 0),
-      ('ENERGY_TSURF_FBCOUNT', 0),
-      ('GLAC_SURF_TEMP_FBCOUNT', 0),
-      ('SNOW_SURF_TEMP_FBCOUNT', 0),
-      # remaining state variables from the "miscellaneous" list (lat, lon, hru)
-      ('GLAC_SURF_TEMP_FBFLAG', 0),
-      ('GLAC_VAPOR_FLUX', 0),
-      ('SNOW_CANOPY_ALBEDO', 0),
-      ('SNOW_SURFACE_FLUX', 0),
-      ('SNOW_SURF_TEMP_FBFLAG', 0),
-      ('SNOW_TMP_INT_STORAGE', 0),
-      ('SNOW_VAPOR_FLUX', 0)
-    ])
-    
+  def __init__(self, band_id, veg_type, store):
+    self.store = store
+    self.slot = store.allocate(default_hru_state_values(band_id, veg_type))
+
+  @classmethod
+  def from_slot(cls, store, slot):
+    """ Returns the state held at an already allocated slot of store, taking
+      over ownership of the slot
+    """
+    state = cls.__new__(cls)
+    state.store = store
+    state.slot = slot
+    return state
+
+  @classmethod
+  def new_states(cls, band_ids, veg_types, store):
+    """ Returns the new states of many HRUs at once, given their band IDs and
+      veg types, with the same default values (in the same slots) as
+      creating them one by one would give, but set a whole column at a time
+    """
+    num_states = len(band_ids)
+    if num_states == 0:
+      return []
+    slots = store.allocate_rows(num_states)
+    for name, value in default_hru_state_values(0, 0).items():
+      if name == 'HRU_BAND_INDEX':
+        value = band_ids
+      elif name == 'HRU_VEG_INDEX':
+        value = veg_types
+      else:
+        value = np.asarray(value)
+        value = np.broadcast_to(value, (num_states,) + value.shape)
+      store.set_rows(slots, name, value)
+    return [cls.from_slot(store, slot) for slot in slots.tolist()]
+
+  @property
+  def variables(self):
+    return HruStateVariables(self.store, self.slot)
+
+  def _values(self):
+    """ Returns a copy of the state variable values """
+    return OrderedDict([(name, np.array(value)) for name, value\
+      in self.variables.items()])
+
+  def release(self):
+    """ Frees this HRU's slot in the store. The state keeps its current
+      values in a private single-slot store, so that existing references to
+      it remain valid.
+    """
+    values = self._values()
+    self.store.release(self.slot)
+    self.store = HruStateStore(block_size=1)
+    self.slot = self.store.allocate(values)
+
+  def discard(self):
+    """ Frees this HRU's slot in the store without keeping its values; the
+      state can no longer be used
+    """
+    if self.store is not None:
+      self.store.release(self.slot)
+      self.store = None
+
+  def __deepcopy__(self, memo):
+    # States copied together go in the one (initially empty) copy of the
+    # store they are copied from
+    store = deepcopy(self.store, memo)
+    state = self.from_slot(store, store.allocate(self._values()))
+    memo[id(self)] = state
+    return state
+
+  def __getstate__(self):
+    return self.store, self._values()
+
+  def __setstate__(self, state):
+    self.store, values = state
+    self.slot = self.store.allocate(values)
+
   def __repr__(self):
     return '{} (\n  '.format(self.__class__.__name__) + ' \n  '\
       .join([': '.join([key, str(value)]) \
         for key, value in self.variables.items()]) + '\n)'
 
   def __eq__(self, other):
-    return (self.__class__ == other.__class__ and self.__dict__ == other.__dict__)
+    return (self.__class__ == other.__class__ \
+      and list(self.variables) == list(other.variables) \
+      and all(np.array_equal(value, other.variables[name]) \
+        for name, value in self.variables.items()))
 
   def __ne__(self, other):
     return not self.__eq__(other)
 
+class CellPixelIndex(object):
+  """Class capturing which RGM pixels belong to which VIC cell. It is built
+    once from the VIC cell mask returned by file_io.get_rgm_pixel_mapping()
+    and reused on every time step, so that consumers don't have to re-derive
+    cell membership from the 2D mask. Pixels are held in compressed sparse
+    row (CSR) layout: the flat DEM indices of the pixels belonging to the cell
+    with compact index i are pixel_inds[offsets[i]:offsets[i + 1]].
+  """
+  def __init__(self, cell_ids, offsets, pixel_inds, shape,
+               orphan_pixel_inds=None):
+    # compact cell index <-> cell ID lookup tables
+    self.cell_ids = list(cell_ids)
+    self.cell_idx = { cell_id: idx for idx, cell_id in enumerate(self.cell_ids) }
+    self.offsets = offsets
+    self.pixel_inds = pixel_inds
+    self.shape = tuple(shape)
+    # Pixels within the VIC domain whose cell ID is not among cell_ids
+    if orphan_pixel_inds is None:
+      orphan_pixel_inds = np.empty(0, dtype=np.intp)
+    self.orphan_pixel_inds = orphan_pixel_inds
+    # Compact cell index of each entry of pixel_inds
+    self.pixel_cells = np.repeat(np.arange(self.num_cells),
+                                 np.diff(self.offsets))
+
+  @classmethod
+  def from_cell_mask(cls, vic_cell_mask, cell_ids=None):
+    """Builds the index from a 2D VIC cell mask (masked pixels lie outside of
+      the VIC domain). Compact cell indices follow the order of cell_ids,
+      which defaults to all cell IDs found in the mask, in ascending order.
+    """
+    pixel_map = np.ma.getdata(vic_cell_mask).ravel()
+    domain_inds = np.flatnonzero(~np.ma.getmaskarray(vic_cell_mask))
+    domain_cell_ids = pixel_map[domain_inds]
+    if cell_ids is None:
+      cell_ids = [str(int(cell_id)) for cell_id in np.unique(domain_cell_ids)]
+    num_cells = len(cell_ids)
+
+    found = np.zeros(len(domain_inds), dtype=bool)
+    pixel_cells = np.empty(0, dtype=np.intp)
+    if num_cells:
+      numeric_cell_ids = np.array([int(cell_id) for cell_id in cell_ids])
+      id_order = np.argsort(numeric_cell_ids, kind='stable')
+      sorted_cell_ids = numeric_cell_ids[id_order]
+      positions = np.minimum(np.searchsorted(sorted_cell_ids, domain_cell_ids),
+                             num_cells - 1)
+      found = sorted_cell_ids[positions] == domain_cell_ids
+      pixel_cells = id_order[positions[found]]
+
+    # Group pixels by cell (keeping them in ascending flat index order within
+    # each cell)
+    pixel_order = np.argsort(pixel_cells, kind='stable')
+    pixel_inds = domain_inds[found][pixel_order]
+    offsets = np.concatenate(([0], np.cumsum(np.bincount(pixel_cells,
+                                                        minlength=num_cells))))
+    return cls(cell_ids, offsets, pixel_inds, np.shape(vic_cell_mask),
+               domain_inds[~found])
+
+  @property
+  def num_cells(self):
+    return len(self.cell_ids)
+
+  @property
+  def num_pixels(self):
+    return len(self.pixel_inds)
+
+  def num_cell_pixels(self, cell_id):
+    """Returns the number of pixels (i.e. the pixel-granularity area) of a
+      cell, or 0 for a cell that is not indexed.
+    """
+    if cell_id not in self.cell_idx:
+      return 0
+    idx = self.cell_idx[cell_id]
+    return int(self.offsets[idx + 1] - self.offsets[idx])
+
+  def cell_pixels(self, cell_id):
+    """Returns the flat DEM indices of the pixels belonging to a cell
+    """
+    idx = self.cell_idx[cell_id]
+    return self.pixel_inds[self.offsets[idx]:self.offsets[idx + 1]]
+
+  def gather(self, grid, pixels=slice(None)):
+    """Returns the values of a 2D grid (aligned with the DEM) at all indexed
+      pixels, grouped by cell in compact cell index order, or at the indexed
+      pixels within the slice pixels of them.
+    """
+    return np.ravel(grid)[self.pixel_inds[pixels]]
+
+  def cell_tiles(self, tile_pixels=TILE_PIXELS):
+    """Yields slices over the compact cell indices, each spanning as many
+      whole cells as have up to tile_pixels pixels in total (at least one)
+    """
+    first_cell = 0
+    while first_cell < self.num_cells:
+      last_cell = np.searchsorted(self.offsets,
+        self.offsets[first_cell] + tile_pixels, side='right') - 1
+      last_cell = min(max(last_cell, first_cell + 1), self.num_cells)
+      yield slice(first_cell, last_cell)
+      first_cell = last_cell
+
+  def subset(self, cell_ids):
+    """Returns a new CellPixelIndex restricted to the given cell IDs, with
+      compact cell indices following their order in cell_ids.
+    """
+    idxs = [self.cell_idx[cell_id] for cell_id in cell_ids]
+    counts = np.array([self.offsets[idx + 1] - self.offsets[idx]
+                       for idx in idxs], dtype=self.offsets.dtype)
+    pixel_inds = np.concatenate([self.pixel_inds[self.offsets[idx]:\
+      self.offsets[idx + 1]] for idx in idxs] + [np.empty(0, dtype=np.intp)])
+    offsets = np.concatenate(([0], np.cumsum(counts)))
+    return CellPixelIndex(cell_ids, offsets, pixel_inds, self.shape)
+
 # Following are the state variables split into sets according to their update
 # method specification, as detailed in the VIC State Updating Spec 3.0.
 # Note that the order of variables within the follow lists matters in some
@@ -294,11 +700,13 @@ def apply_custom_root_zone_parms(hru_cell_dict, glacier_root_zone_parms,\
       if open_ground_root_zone_parms and (key[1] == global_parms.open_ground_id):
         hru_cell_dict[cell][key].root_zone_parms = open_ground_root_zone_parms
 
-def merge_cell_input(hru_cell_dict, elevation_cell_dict):
+def merge_cell_input(hru_cell_dict, elevation_cell_dict, hru_store):
   """Utility function to merge the dict of HRUs loaded via
     vegparams.load_veg_parms() with the list of Bands loaded at start-up via
     snbparams.load_snb_parms() into one unified structure capturing all VIC
-    cells' initial properties (but not state).
+    cells' initial properties (but not state). hru_store is the
+    HruStateStore the HRUs were loaded into, in which the cells create their
+    new HRUs.
   """ 
   missing_keys = hru_cell_dict.keys() ^ elevation_cell_dict.keys()
   if missing_keys:
@@ -307,7 +715,7 @@ def merge_cell_input(hru_cell_dict, elevation_cell_dict):
   # initialize new cell container
   cells = OrderedDict()
   for cell_id in elevation_cell_dict:
-    cells[cell_id] = Cell(deepcopy(elevation_cell_dict[cell_id]))
+    cells[cell_id] = Cell(deepcopy(elevation_cell_dict[cell_id]), hru_store)
   # FIXME: this is a little awkward
   for cell_id, hru_dict in hru_cell_dict.items():
     band_ids = { band_id for band_id, _ in hru_dict.keys() }
@@ -320,88 +728,322 @@ def merge_cell_input(hru_cell_dict, elevation_cell_dict):
   return cells
 
 def update_glacier_mask(surf_dem, bed_dem, num_rows_dem, num_cols_dem,
-                        glacier_thickness_threshold):
+                        glacier_thickness_threshold, glacier_mask=None,
+                        tile_pixels=TILE_PIXELS):
   """ Takes output Surface DEM from RGM and uses element-wise differencing 
-    with the Bed DEM to form an updated glacier mask 
+    with the Bed DEM to form an updated glacier mask. The DEMs are processed
+    in row tiles of about tile_pixels pixels, so that they may be np.memmap
+    grids. The mask is written into glacier_mask (e.g. a grids.new_grid()
+    memmap) if given.
   """
-  diffs = surf_dem - bed_dem
-  if np.any(diffs < 0):
-    raise Exception(
-      'update_glacier_mask: Error: Subtraction of Bed DEM from the output \
+  if glacier_mask is None:
+    glacier_mask = np.zeros((num_rows_dem, num_cols_dem))
+  for rows in row_tiles(num_rows_dem, num_cols_dem, tile_pixels):
+    diffs = surf_dem[rows] - bed_dem[rows]
+    if np.any(diffs < 0):
+      raise Exception(
+        'update_glacier_mask: Error: Subtraction of Bed DEM from the output \
       Surface DEM of RGM produced one or more negative values.'
-    )
-
-  glacier_mask = np.zeros((num_rows_dem, num_cols_dem))
-  glacier_mask[diffs > glacier_thickness_threshold] = 1
+      )
+    glacier_mask[rows] = diffs > glacier_thickness_threshold
   return glacier_mask
 
-def bin_bands_and_glaciers(cells, cell_areas, vic_cell_mask, num_snow_bands,
-                    surf_dem, glacier_mask):
-  # Create band area and glacier area bins.
-  # Counting pixels is a proxy for area within each band:
-  band_areas = {}
-  # Counting pixels landing within the glacier mask is a proxy for glacier area:
-  glacier_areas = {}
-
-  for cell_id, cell in cells.items():
-    logging.debug('Binning DEM pixels for cell %s', cell_id)
-    band_areas[cell_id] = [0] * num_snow_bands
-    glacier_areas[cell_id] = [0] * num_snow_bands
-
-    # Select the portion of the DEM that pertains to this cell from which we
-    # will do binning
-    masked_dem = np.ma.masked_array(surf_dem)
-    masked_dem[np.where(vic_cell_mask != float(cell_id))] = np.ma.masked
-    # Create a regular 'flat' np.array of the DEM subset that is within the
-    # VIC cell
-    flat_dem = masked_dem[~masked_dem.mask]
-
-    # Check if any pixels fall outside of valid range of bands
-    if len(np.where(flat_dem < cell.bands[0].lower_bound)[0]) > 0:
+def reconcile_bed_dem(surf_dem, bed_dem, num_rows_dem, num_cols_dem,
+                      tile_pixels=TILE_PIXELS):
+  """ Sets the Bed DEM elevations that lie above the Surface DEM to those of
+    the Surface DEM (in place), in row tiles of about tile_pixels pixels, and
+    returns the number of elevations so adjusted
+  """
+  num_adjusted = 0
+  for rows in row_tiles(num_rows_dem, num_cols_dem, tile_pixels):
+    above = bed_dem[rows] > surf_dem[rows]
+    bed_dem[rows][above] = surf_dem[rows][above]
+    num_adjusted += int(np.count_nonzero(above))
+  return num_adjusted
+
+def _changed_pixels(old_elevs, elevs, old_is_glacier, is_glacier):
+  """ Returns the indices of the pixels (of gathered pixel arrays) whose
+    glacier mask value changed, or whose surface DEM elevation changed by
+    more than ELEVATION_RTOL (relative to the new elevation)
+  """
+  # (written so that NaN elevations count as changed)
+  return np.flatnonzero(~(np.abs(elevs - old_elevs)
+                          <= ELEVATION_RTOL * np.abs(elevs))
+                        | (old_is_glacier != is_glacier))
+
+def _cells_with_pixels(cell_ids, pixel_index, pixels):
+  """ Returns the IDs (in the order of cell_ids) of the cells owning one or
+    more of the given pixels of pixel_index, and of the cells it doesn't
+    index
+  """
+  counts = np.bincount(pixel_index.pixel_cells[pixels],
+                       minlength=pixel_index.num_cells)
+  return [cell_id for cell_id in cell_ids
+          if cell_id not in pixel_index.cell_idx
+          or counts[pixel_index.cell_idx[cell_id]] > 0]
+
+def find_dirty_cells(cells, pixel_index, old_surf_dem, surf_dem,
+                     old_glacier_mask, glacier_mask):
+  """ Returns the IDs (in the order of cells) of the cells having one or more
+    pixels whose surface DEM elevation or glacier mask value differs between
+    the old and new grids. All cells are dirty if there are no old grids.
+  """
+  if old_surf_dem is None or old_glacier_mask is None:
+    return list(cells.keys())
+  changed = _changed_pixels(pixel_index.gather(old_surf_dem),
+    pixel_index.gather(surf_dem), pixel_index.gather(old_glacier_mask) == 1,
+    pixel_index.gather(glacier_mask) == 1)
+  return _cells_with_pixels(cells.keys(), pixel_index, changed)
+
+def _band_bin_bounds(cells):
+  """ Returns the lower bounds of all bands of all cells, and the upper bounds
+    of the top bands of all cells, as arrays in the order of cells
+  """
+  band_bin_bounds = np.array([[band.lower_bound for band in cell.bands]
+                              for cell in cells.values()])
+  upper_bounds = np.array([cell.bands[-1].upper_bound
+                           for cell in cells.values()])
+  return band_bin_bounds, upper_bounds
+
+def _pixel_bin_keys(cells, num_snow_bands, band_bin_bounds, upper_bounds,
+                    pixel_cells, pixel_elevs):
+  """ Returns the combined (cell, band) bin key of each pixel, given the
+    compact cell index (in the order of cells) and elevation of each pixel
+  """
+  num_cells = len(cells)
+  # Check if any pixels fall outside of valid range of bands
+  below = np.bincount(pixel_cells[pixel_elevs < band_bin_bounds[pixel_cells, 0]],
+                      minlength=num_cells)
+  above = np.bincount(pixel_cells[pixel_elevs >= upper_bounds[pixel_cells]],
+                      minlength=num_cells)
+  for cell_idx, (cell_id, cell) in enumerate(cells.items()):
+    if below[cell_idx] > 0:
       raise Exception(
         'One or more DEM pixels lies below the bounds of the lowest '
         'defined elevation band (< {}m) as defined by the Snow Band Parameter File '
         'for cell {}. You may need to add or shift the zero padding to accommodate this.'
         .format(cell.bands[0].lower_bound, cell_id))
-    if len(np.where(flat_dem >= cell.bands[-1].upper_bound)[0]) > 0:
+    if above[cell_idx] > 0:
       raise Exception(
         'One or more DEM pixels lies above the bounds of the highest '
         'defined elevation band (>= {}m) as defined by the Snow Band Parameter File '
         'for cell {}. You may need to add or shift the zero padding to accommodate this.'
         .format(cell.bands[-1].upper_bound, cell_id))
 
-    # Identify the bounds of the band area and glacier area bins for this cell
-    # and update the band median elevations
-    band_bin_bounds = []
-    for band in cell.bands:
-      band_bin_bounds.append(band.lower_bound)
-      band_pixels = flat_dem[np.where((flat_dem >= band.lower_bound) & \
-                                      (flat_dem < band.upper_bound))]
-      if not band_pixels.size:  # if there are no pixels in this band
+  # Band index of each pixel (equivalent to np.digitize() over its own cell's
+  # band bounds), and the combined (cell, band) bin key
+  pixel_bands = np.zeros(len(pixel_elevs), dtype=np.intp)
+  for band_idx in range(1, num_snow_bands):
+    pixel_bands += pixel_elevs >= band_bin_bounds[pixel_cells, band_idx]
+  return pixel_cells * num_snow_bands + pixel_bands
+
+def grouped_median(values, groups, num_groups):
+  """ Returns the median of the values in each of num_groups groups, given
+    the group index of each value, as an array (NaN for empty groups). The
+    values are sorted by (group, value) once, so that each group's median is
+    read off at its offset into the sorted values. Medians are those
+    np.median() would give for each group, down to their dtype.
+  """
+  values = np.asarray(values)
+  groups = np.asarray(groups)
+  num_values = len(values)
+  counts = np.bincount(groups, minlength=num_groups)
+  offsets = np.cumsum(counts) - counts
+  # Sorting by (group, value) as a single integer key made of the group and
+  # the rank of the value is much faster than np.lexsort()
+  value_order = np.argsort(values)
+  keys = groups[value_order].astype(np.int64) * num_values\
+    + np.arange(num_values)
+  keys.sort()
+  sorted_values = values[value_order[keys % max(num_values, 1)]]
+  dtype = values.dtype if np.issubdtype(values.dtype, np.floating)\
+    else np.float64
+  medians = np.full(num_groups, np.nan, dtype=dtype)
+  nonempty = np.flatnonzero(counts)
+  lower = sorted_values[offsets[nonempty] + (counts[nonempty] - 1) // 2]
+  upper = sorted_values[offsets[nonempty] + counts[nonempty] // 2]
+  medians[nonempty] = (lower.astype(dtype) + upper.astype(dtype)) / 2
+  return medians
+
+def bin_bands_and_glaciers(cells, cell_areas, vic_cell_mask, num_snow_bands,
+                    surf_dem, glacier_mask, pixel_index=None,
+                    tile_pixels=TILE_PIXELS):
+  """ Bins the surface DEM pixels of all VIC cells into their elevation bands
+    in a single pass over the DEM, and updates the median elevation of every
+    band. Pixels are grouped by a combined (cell, band) key, so that band
+    areas and glacier areas for a tile of cells of up to tile_pixels pixels
+    come out of one np.bincount each, and band median elevations out of one
+    grouped_median().
+    pixel_index is a CellPixelIndex over the cells (in the same order); it is
+    built from vic_cell_mask if not provided.
+  """
+  cell_ids = list(cells.keys())
+  if pixel_index is None:
+    pixel_index = CellPixelIndex.from_cell_mask(vic_cell_mask, cell_ids)
+  elif pixel_index.cell_ids != cell_ids:
+    pixel_index = pixel_index.subset(cell_ids)
+  band_bin_bounds, upper_bounds = _band_bin_bounds(cells)
+
+  # Cells are binned in tiles of whole cells, each one's pixels being
+  # gathered from the DEM and glacier mask (which may be np.memmap grids)
+  # in turn
+  band_counts = []
+  glacier_counts = []
+  median_elevs = []
+  for cell_tile in pixel_index.cell_tiles(tile_pixels):
+    pixels = slice(pixel_index.offsets[cell_tile.start],
+                   pixel_index.offsets[cell_tile.stop])
+    pixel_elevs = pixel_index.gather(surf_dem, pixels)
+    # (bin keys relative to the first bin of the tile)
+    pixel_keys = _pixel_bin_keys(cells, num_snow_bands, band_bin_bounds,
+      upper_bounds, pixel_index.pixel_cells[pixels], pixel_elevs)\
+      - cell_tile.start * num_snow_bands
+    num_bins = (cell_tile.stop - cell_tile.start) * num_snow_bands
+
+    # Counting pixels is a proxy for area within each band:
+    band_counts.append(np.bincount(pixel_keys, minlength=num_bins))
+    # Counting pixels landing within the glacier mask is a proxy for glacier
+    # area:
+    is_glacier = pixel_index.gather(glacier_mask, pixels) == 1
+    glacier_counts.append(np.bincount(pixel_keys[is_glacier],
+                                      minlength=num_bins))
+    # Median elevations of all bands, from a single sort of the pixels
+    median_elevs.append(grouped_median(pixel_elevs, pixel_keys, num_bins))
+  band_counts = np.concatenate(band_counts + [np.zeros(0, dtype=np.intp)])
+  glacier_counts = np.concatenate(glacier_counts\
+    + [np.zeros(0, dtype=np.intp)])
+  median_elevs = np.concatenate(median_elevs) if median_elevs else []
+
+  band_areas = {}
+  glacier_areas = {}
+  for cell_idx, (cell_id, cell) in enumerate(cells.items()):
+    logging.debug('Binning DEM pixels for cell %s', cell_id)
+    first_key = cell_idx * num_snow_bands
+    band_areas[cell_id] = \
+      band_counts[first_key:first_key + num_snow_bands].tolist()
+    glacier_areas[cell_id] = \
+      glacier_counts[first_key:first_key + num_snow_bands].tolist()
+    for band_idx, band in enumerate(cell.bands):
+      key = first_key + band_idx
+      if band_counts[key] == 0:  # if there are no pixels in this band
         band.median_elev = band.lower_bound
       else:
-        band.median_elev = np.median(band_pixels)
-
-    # Select portion of glacier_mask pertaining to this cell
-    cell_glacier_mask = np.ma.masked_array(glacier_mask)
-    cell_glacier_mask[np.where(vic_cell_mask != float(cell_id))] = np.ma.masked
-    masked_dem.mask = False
-    masked_dem[np.where(cell_glacier_mask != 1)] = np.ma.masked
-    # Create a regular 'flat' np.array of the DEM subset that is unmasked glacier
-    flat_glacier_dem = masked_dem[~masked_dem.mask]
-
-    # Do binning into band_areas[cell][band] and glacier_areas[cell][band]
-    # using data in flat_dem and flat_glacier_dem
-    inds = np.digitize(flat_dem, band_bin_bounds)
-    for idx, count in enumerate(np.bincount(inds - 1)):
-      band_areas[cell_id][idx] = count
-
-    inds = np.digitize(flat_glacier_dem, band_bin_bounds)
-    for idx, count in enumerate(np.bincount(inds - 1)):
-      glacier_areas[cell_id][idx] = count
+        band.median_elev = median_elevs[key]
 
   return band_areas, glacier_areas
 
+class IncrementalBinning(object):
+  """Class keeping the band and glacier pixel counts of every (cell, band)
+    bin of the VIC cells from one time step to the next, so that a new
+    surface DEM and glacier mask are binned by revisiting only the pixels
+    whose elevation or glacier mask value changed. Band bin bounds are fixed
+    when it is built, as band median elevations never leave their bands.
+    Feed each new surface DEM and glacier mask to update(), then use bin()
+    in place of bin_bands_and_glaciers(). If check is True, update() checks
+    the incrementally updated bins against a full rebin of all pixels.
+  """
+  def __init__(self, cells, num_snow_bands, surf_dem, glacier_mask,
+               pixel_index, check=False):
+    self.cell_ids = list(cells.keys())
+    self.cell_idx = { cell_id: idx for idx, cell_id in enumerate(self.cell_ids) }
+    if pixel_index.cell_ids != self.cell_ids:
+      pixel_index = pixel_index.subset(self.cell_ids)
+    self.pixel_index = pixel_index
+    self.num_snow_bands = num_snow_bands
+    self.check = check
+    self.band_bin_bounds, self.upper_bounds = _band_bin_bounds(cells)
+    self.pixel_elevs = pixel_index.gather(surf_dem).astype(np.float64)
+    self.is_glacier = pixel_index.gather(glacier_mask) == 1
+    self.pixel_keys = _pixel_bin_keys(cells, num_snow_bands,
+      self.band_bin_bounds, self.upper_bounds, pixel_index.pixel_cells,
+      self.pixel_elevs)
+    num_bins = len(self.cell_ids) * num_snow_bands
+    self.band_counts = np.bincount(self.pixel_keys, minlength=num_bins)
+    self.glacier_counts = np.bincount(self.pixel_keys[self.is_glacier],
+                                      minlength=num_bins)
+    # Bins whose median elevation is to be (re)computed by bin()
+    self.stale_bins = np.ones(num_bins, dtype=bool)
+
+  def update(self, cells, surf_dem, glacier_mask):
+    """Applies a new surface DEM and glacier mask to the bins of cells (in
+      the same order as the cells the binning was built with). Returns the
+      IDs of the cells having one or more changed pixels, as
+      find_dirty_cells() would for the last surface DEM and glacier mask.
+    """
+    pixel_cells = self.pixel_index.pixel_cells
+    new_elevs = self.pixel_index.gather(surf_dem)
+    new_is_glacier = self.pixel_index.gather(glacier_mask) == 1
+    changed = _changed_pixels(self.pixel_elevs, new_elevs, self.is_glacier,
+                              new_is_glacier)
+    old_keys = self.pixel_keys[changed]
+    new_keys = _pixel_bin_keys(cells, self.num_snow_bands,
+      self.band_bin_bounds, self.upper_bounds, pixel_cells[changed],
+      new_elevs[changed])
+
+    num_bins = len(self.band_counts)
+    self.band_counts += np.bincount(new_keys, minlength=num_bins)\
+      - np.bincount(old_keys, minlength=num_bins)
+    self.glacier_counts += \
+      np.bincount(new_keys[new_is_glacier[changed]], minlength=num_bins)\
+      - np.bincount(old_keys[self.is_glacier[changed]], minlength=num_bins)
+    self.stale_bins[old_keys] = True
+    self.stale_bins[new_keys] = True
+    self.pixel_keys[changed] = new_keys
+    # (pixels within ELEVATION_RTOL of their last elevation keep it, so that
+    # their bins stay those of the elevations binned)
+    self.pixel_elevs[changed] = new_elevs[changed]
+    self.is_glacier = new_is_glacier
+
+    if self.check:
+      pixel_keys = _pixel_bin_keys(cells, self.num_snow_bands,
+        self.band_bin_bounds, self.upper_bounds, pixel_cells,
+        self.pixel_elevs)
+      if not (np.array_equal(pixel_keys, self.pixel_keys)
+          and np.array_equal(np.bincount(pixel_keys, minlength=num_bins),
+                             self.band_counts)
+          and np.array_equal(np.bincount(pixel_keys[new_is_glacier],
+                             minlength=num_bins), self.glacier_counts)):
+        raise Exception(
+          'IncrementalBinning.update: Error: Incrementally updated band and '
+          'glacier pixel counts differ from those of a full rebin.')
+      logging.debug('Incremental binning of %s changed pixels agrees with '
+        'a full rebin.', len(changed))
+
+    return _cells_with_pixels(self.cell_ids, self.pixel_index, changed)
+
+  def bin(self, cells):
+    """Updates the median elevations of the bands of cells (any subset of the
+      cells the binning was built with) whose pixels changed since they were
+      last binned, and returns band_areas and glacier_areas of these cells,
+      as bin_bands_and_glaciers() does.
+    """
+    num_snow_bands = self.num_snow_bands
+    offsets = self.pixel_index.offsets
+    band_areas = {}
+    glacier_areas = {}
+    for cell_id, cell in cells.items():
+      cell_idx = self.cell_idx[cell_id]
+      first_key = cell_idx * num_snow_bands
+      keys = slice(first_key, first_key + num_snow_bands)
+      band_areas[cell_id] = self.band_counts[keys].tolist()
+      glacier_areas[cell_id] = self.glacier_counts[keys].tolist()
+      stale_bands = np.flatnonzero(self.stale_bins[keys]).tolist()
+      if not stale_bands:
+        continue
+      logging.debug('Binning DEM pixels for cell %s', cell_id)
+      pixels = slice(offsets[cell_idx], offsets[cell_idx + 1])
+      median_elevs = grouped_median(self.pixel_elevs[pixels],
+        self.pixel_keys[pixels] - first_key, num_snow_bands)
+      for band_idx in stale_bands:
+        band = cell.bands[band_idx]
+        key = first_key + band_idx
+        if self.band_counts[key] == 0:  # if there are no pixels in this band
+          band.median_elev = band.lower_bound
+        else:
+          band.median_elev = median_elevs[band_idx]
+      self.stale_bins[keys] = False
+    return band_areas, glacier_areas
+
 def digitize_domain(cells, cell_areas, band_areas, glacier_areas):
   ''' Applies digitization of band and HRU area fractions from the
     initial values given in the snow band and vegetation parameter files,
@@ -417,108 +1059,348 @@ def digitize_domain(cells, cell_areas, band_areas, glacier_areas):
         for veg_type, hru in band.hrus.items():
           band.hrus[veg_type].area_frac = band.hrus[veg_type].area_frac * digitizing_scale_factor
 
+def compute_new_area_fracs(cells, cell_areas, band_areas, glacier_areas):
+  """Computes the new band, glacier, open ground and vegetated HRU area
+    fractions of all cells at once from the binned band_areas and
+    glacier_areas returned by bin_bands_and_glaciers(), as arrays indexed by
+    (cell, band) or (cell, band, veg type), with cells in the order of cells
+    and veg types in the order of the returned veg_types. Bands whose band
+    or glacier area fraction have not changed (the changed array) keep
+    zero open ground and vegetated HRU fractions. Bands whose band or glacier
+    area fraction changed by more than one pixel's worth of area (using
+    digitized 1/cell_areas[cell_id] as maximum resolution for checking
+    equality eliminates rounding error) need a state update (the
+    needs_update array). Returns veg_types, changed, needs_update,
+    new_band_area_frac, new_glacier_area_frac, new_open_ground_area_frac,
+    new_hru_area_frac and delta_area_hru.
+  """
+  cell_ids = list(cells.keys())
+  veg_types = sorted({ veg_type for cell in cells.values()
+    for band in cell.bands for veg_type in band.hrus })
+  veg_idx = { veg_type: idx for idx, veg_type in enumerate(veg_types) }
+  num_cells = len(cell_ids)
+  num_bands = max([cell.num_bands for cell in cells.values()] + [0])
+  shape = (num_cells, num_bands)
+
+  # Current HRU area fractions, and which HRUs exist. Band area fractions
+  # are taken from the Bands themselves, so that they are summed exactly as
+  # Band.area_frac does
+  hru_area_frac = np.zeros(shape + (len(veg_types),))
+  has_hru = np.zeros(shape + (len(veg_types),), dtype=bool)
+  band_area_frac = np.zeros(shape)
+  for cell_idx, cell in enumerate(cells.values()):
+    for band_idx, band in enumerate(cell.bands):
+      band_area_frac[cell_idx, band_idx] = band.area_frac
+      for veg_type, hru in band.hrus.items():
+        hru_area_frac[cell_idx, band_idx, veg_idx[veg_type]] = hru.area_frac
+        has_hru[cell_idx, band_idx, veg_idx[veg_type]] = True
+  no_hrus = np.zeros(shape)
+  glacier_area_frac = hru_area_frac[..., veg_idx[Band.glacier_id]] \
+    if Band.glacier_id in veg_idx else no_hrus
+  open_ground_area_frac = hru_area_frac[..., veg_idx[Band.open_ground_id]] \
+    if Band.open_ground_id in veg_idx else no_hrus
+  non_glacier_area_frac = band_area_frac - glacier_area_frac
+
+  areas = np.array([cell_areas[cell_id] for cell_id in cell_ids],
+                   dtype=float).reshape(-1, 1)
+  new_band_area_frac = np.array([band_areas[cell_id] for cell_id in cell_ids],
+                                dtype=float).reshape(shape) / areas
+  new_glacier_area_frac = np.array([glacier_areas[cell_id]
+    for cell_id in cell_ids], dtype=float).reshape(shape) / areas
+  new_glacier_area_frac[np.abs(new_glacier_area_frac) <= ZERO_AREA_FRAC_TOL] = 0
+
+  def differs(new_area_frac, area_frac):
+    # Elementwise negation of isclose(new_area_frac, area_frac,
+    # abs_tol=1/cell_areas[cell_id])
+    return np.abs(new_area_frac - area_frac) > np.maximum(1e-09 * np.maximum(
+      np.abs(new_area_frac), np.abs(area_frac)), 1 / areas)
+  needs_update = differs(new_glacier_area_frac, glacier_area_frac) \
+    | differs(new_band_area_frac, band_area_frac)
+
+  # We need to update HRU area fractions if either the glacier HRU area
+  # fraction has changed for a band, or the band's total area fraction has
+  # changed
+  changed = (new_glacier_area_frac != glacier_area_frac) \
+    | (new_band_area_frac != band_area_frac)
+  new_non_glacier_area_frac = new_band_area_frac - new_glacier_area_frac
+  new_residual_area_frac = new_non_glacier_area_frac - non_glacier_area_frac
+  new_open_ground_area_frac = np.where(changed,
+    np.maximum(0, open_ground_area_frac + new_residual_area_frac), 0)
+  new_open_ground_area_frac[np.abs(new_open_ground_area_frac)
+                            <= ZERO_AREA_FRAC_TOL] = 0
+  # Use old proportions of vegetated areas for scaling their area fractions,
+  # by the change in the sum of vegetated area fractions
+  veg_scaling_divisor = non_glacier_area_frac - open_ground_area_frac
+  delta_area_vegetated = np.minimum(0, open_ground_area_frac
+                                    + new_residual_area_frac)
+
+  is_vegetated = np.array([veg_type != Band.glacier_id
+    and veg_type != Band.open_ground_id for veg_type in veg_types], dtype=bool)
+  is_vegetated_hru = has_hru & is_vegetated & changed[..., np.newaxis]
+  delta_area_hru = np.zeros(hru_area_frac.shape)
+  with np.errstate(divide='ignore', invalid='ignore'):
+    delta_area_hru[is_vegetated_hru] = (delta_area_vegetated[..., np.newaxis]
+      * (hru_area_frac / veg_scaling_divisor[..., np.newaxis]))[is_vegetated_hru]
+  new_hru_area_frac = np.where(is_vegetated_hru,
+                               hru_area_frac + delta_area_hru, 0)
+  new_hru_area_frac[np.abs(new_hru_area_frac) <= ZERO_AREA_FRAC_TOL] = 0
+
+  return veg_types, changed, needs_update, new_band_area_frac,\
+    new_glacier_area_frac, new_open_ground_area_frac, new_hru_area_frac,\
+    delta_area_hru
+
 def update_area_fracs(cells, cell_areas, vic_cell_mask, num_snow_bands,
-  surf_dem, glacier_mask):
+  surf_dem, glacier_mask, pixel_index=None, executor=None, num_shards=None,
+  dirty_cells=None, binning=None):
   """Applies the updated RGM DEM and glacier mask and calculates and updates
     all HRU area fractions for all elevation bands within the VIC cells.
     Determines the HRU state update case based upon changes in HRU area
     fractions since the last time step, as per Algorithm Specification --
     VIC State Updating (Version 3.0.0), and calls update_hru_state().
+    New area fractions are computed for the whole domain at once by
+    compute_new_area_fracs(); the per-band state update is only carried out
+    for the bands whose area fractions have changed.
+    If a process-based concurrent.futures executor is given, the cells
+    needing a state update are split into num_shards shards (default: one per
+    CPU), which are updated in its worker processes. Cells are shipped to and
+    from the workers as flat arrays by pack_cells() and unpack_cells(), and
+    the results are identical to those of the serial update.
+    If dirty_cells (as returned by find_dirty_cells()) is given, only those
+    cells are binned and updated. The other cells' pixels are unchanged since
+    the last update, so binning them again would not change them.
+    If an IncrementalBinning (already updated with surf_dem and
+    glacier_mask) is given, the cells are binned by it.
   """
-  def reverse_enumerate(iterable):
-    """
-    Enumerate over an iterable in reverse order while retaining proper indexes
-    """
-    return itertools.zip_longest(reversed(range(len(iterable))), reversed(iterable))
-
-  band_areas, glacier_areas = bin_bands_and_glaciers(cells, cell_areas, vic_cell_mask,
-                                num_snow_bands, surf_dem, glacier_mask)
-
-  for cell_id, cell in cells.items():
-    # Initialise temporary band-level area fractions used
-    # in computations below
-    new_band_area_frac = [0] * cell.num_bands
-    new_glacier_area_frac = [0] * cell.num_bands
-    new_non_glacier_area_frac = [0] * cell.num_bands
-    new_open_ground_area_frac = [0] * cell.num_bands
-    veg_scaling_divisor = [0] * cell.num_bands
-    delta_area_vegetated = [0] * cell.num_bands
-    delta_area_hru = {}
-    new_hru_area_frac = {}
-
-    ### Update all Band area fractions for this cell
-    # This must be done for all bands before the HRU area
-    # fractions and state update steps
-    for band_id, band in reverse_enumerate(cell.bands):
-      # Update total area fraction for this Band
-      new_band_area_frac[band_id] = band_areas[cell_id][band_id]/cell_areas[cell_id]
-      # Update glacier HRU area fraction for this Band
-      new_glacier_area_frac[band_id] = glacier_areas[cell_id][band_id]/cell_areas[cell_id]
-      if isclose(new_glacier_area_frac[band_id], 0, abs_tol=ZERO_AREA_FRAC_TOL):
-        new_glacier_area_frac[band_id] = 0
-
-      # We need to update HRU area fractions if either
-      # the glacier HRU area fraction has changed for this band, or
-      # the band's total area fraction has changed
-      if (new_glacier_area_frac[band_id] != band.area_frac_glacier)\
-        or (new_band_area_frac[band_id] != band.area_frac):
-        # Calculate new non-glacier area fraction for this band
-        new_non_glacier_area_frac[band_id] = new_band_area_frac[band_id]\
-                                             - new_glacier_area_frac[band_id]
-        # Calculate new_residual area fraction
-        new_residual_area_frac = new_non_glacier_area_frac[band_id]\
-                                 - band.area_frac_non_glacier
-        # Calculate new open ground area fraction
-        new_open_ground_area_frac[band_id] = np.max([0, (band.area_frac_open_ground
-          + new_residual_area_frac)])
-        if isclose(new_open_ground_area_frac[band_id], 0, abs_tol=ZERO_AREA_FRAC_TOL):
-          new_open_ground_area_frac[band_id] = 0
-        # Use old proportions of vegetated areas for scaling their area
-        # fractions in this iteration
-        veg_scaling_divisor[band_id] = band.area_frac_non_glacier\
-          - band.area_frac_open_ground
-        # Calculate the change in sum of vegetated area fractions
-        delta_area_vegetated[band_id] = np.min([0, (band.area_frac_open_ground
-          + new_residual_area_frac)])
-
-        for veg_type, hru in band.hrus.items():
-          if veg_type is not Band.glacier_id and veg_type is not Band.open_ground_id:
-            # Calculate change in HRU area fraction & update
-            delta_area_hru[str(veg_type)] = delta_area_vegetated[band_id] * \
-              (band.hrus[veg_type].area_frac / veg_scaling_divisor[band_id])
-            if str(band_id) not in new_hru_area_frac:
-              new_hru_area_frac[str(band_id)] = {}
-            new_hru_area_frac[str(band_id)][str(veg_type)] = \
-              band.hrus[veg_type].area_frac + delta_area_hru[str(veg_type)]
-            if isclose(new_hru_area_frac[str(band_id)][str(veg_type)], 0, abs_tol=ZERO_AREA_FRAC_TOL):
-              new_hru_area_frac[str(band_id)][str(veg_type)] = 0
-
-    # Update all HRU states for each band, then apply new HRU area
-    # fractions calculated above.
-    for band_id, band in reverse_enumerate(cell.bands):
-      if not isclose(new_glacier_area_frac[band_id], band.area_frac_glacier, abs_tol=1 / cell_areas[cell_id]) \
-        or not isclose(new_band_area_frac[band_id], band.area_frac, abs_tol=1 / cell_areas[cell_id]):
-        update_band_state(cell, band, band_id, new_band_area_frac,
-          new_glacier_area_frac, new_open_ground_area_frac, new_hru_area_frac,
-          delta_area_hru)
-      else:
-        logging.debug('No changes in band or glacier area fractions were found for '
-          'cell %s band %s, thus no state update applied.', cell_id, band_id)
+  if dirty_cells is not None:
+    cells = OrderedDict((cell_id, cells[cell_id]) for cell_id in dirty_cells)
+    if not cells:
+      logging.debug('No DEM pixels changed, thus no state update applied.')
+      return
+  if binning is None:
+    band_areas, glacier_areas = bin_bands_and_glaciers(cells, cell_areas,
+      vic_cell_mask, num_snow_bands, surf_dem, glacier_mask, pixel_index)
+  else:
+    band_areas, glacier_areas = binning.bin(cells)
+
+  veg_types, changed, needs_update, new_band_area_fracs,\
+    new_glacier_area_fracs, new_open_ground_area_fracs, new_hru_area_fracs,\
+    delta_area_hrus = \
+    compute_new_area_fracs(cells, cell_areas, band_areas, glacier_areas)
+  # Per-cell rows of these are what _update_cell_area_fracs() consumes
+  area_frac_arrays = (changed, new_band_area_fracs,
+    new_glacier_area_fracs, new_open_ground_area_fracs, new_hru_area_fracs,
+    delta_area_hrus)
+
+  cell_ids = list(cells.keys())
+  update_cell_idxs = np.flatnonzero(np.any(needs_update, axis=1))
+  if executor is None or len(update_cell_idxs) < 2:
+    veg_idx = { veg_type: idx for idx, veg_type in enumerate(veg_types) }
+    for cell_idx in update_cell_idxs:
+      cell_id = cell_ids[cell_idx]
+      _update_cell_area_fracs(cell_id, cells[cell_id], cell_areas[cell_id],
+        veg_idx, *[array[cell_idx] for array in area_frac_arrays])
+  else:
+    if num_shards is None:
+      num_shards = os.cpu_count() or 1
+    shards = np.array_split(update_cell_idxs,
+                            max(1, min(num_shards, len(update_cell_idxs))))
+    update_cell_areas = np.array([cell_areas[cell_id] for cell_id in cell_ids],
+                                 dtype=float)
+    futures = [executor.submit(update_cells_area_fracs_packed, _run_parms(),
+      pack_cells(OrderedDict((cell_ids[cell_idx], cells[cell_ids[cell_idx]])
+                             for cell_idx in shard)),
+      veg_types, update_cell_areas[shard],
+      *[array[shard] for array in area_frac_arrays])
+      for shard in shards]
+    # Results are applied in shard order, whatever order they complete in
+    for future in futures:
+      unpack_cells(future.result(), cells)
+
+  for cell_idx, (cell_id, cell) in enumerate(cells.items()):
+    if not np.any(needs_update[cell_idx]):
+      logging.debug('No changes in band or glacier area fractions were found '
+        'for cell %s, thus no state update applied.', cell_id)
     # Update cell-level state variables
     cell.update_cell_state()
 
-    # TODO: replace test below with one that checks that all band HRU area fracs add to 1
-    # Sanity check that glacier + non-glacier area fractions add up to Band's total area fraction, within tolerance
-    # sum_test = new_glacier_area_frac[band_id] + new_non_glacier_area_frac[band_id]
-    # if sum_test != new_band_area_frac[band_id]:
-    #   raise Exception(
-    #       'cell {}, band {}: glacier area fraction {} + '
-    #       'non-glacier area fraction {} = {} is not equal to '
-    #       'the band area fraction of {}'
-    #       .format(cell_id, band_id, new_glacier_area_frac,
-    #           new_non_glacier_area_frac[band_id], sum_test,
-    #           new_band_area_frac)
-    #   )
+def _update_cell_area_fracs(cell_id, cell, cell_area, veg_idx, changed,
+  new_band_area_fracs, new_glacier_area_fracs, new_open_ground_area_fracs,
+  new_hru_area_fracs, delta_area_hrus):
+  """Carries out the state update of the bands of one cell, given the
+    cell's rows of the arrays returned by compute_new_area_fracs() (other than
+    needs_update). Whether a band needs a state update is checked band by
+    band, top to bottom, against the band as left by the update of the bands
+    above it: CASE 5a/5b create HRUs in the band below, which may thereby
+    come to need an update, or no longer need one.
+  """
+  # Band-level area fractions and the vegetated HRU area fractions of
+  # changed bands, as consumed by update_band_state()
+  new_band_area_frac = new_band_area_fracs.tolist()
+  new_glacier_area_frac = new_glacier_area_fracs.tolist()
+  new_open_ground_area_frac = new_open_ground_area_fracs.tolist()
+  new_hru_area_frac = {}
+  delta_area_hru = {}
+  # Iterating over bands top to bottom, so that delta_area_hru ends up
+  # holding the values of the lowest changed band for each veg type
+  for band_id in reversed(np.flatnonzero(changed).tolist()):
+    for veg_type in cell.bands[band_id].hrus:
+      if veg_type != Band.glacier_id and veg_type != Band.open_ground_id:
+        idx = veg_idx[veg_type]
+        delta_area_hru[str(veg_type)] = float(delta_area_hrus[band_id, idx])
+        new_hru_area_frac.setdefault(str(band_id), {})[str(veg_type)] = \
+          float(new_hru_area_fracs[band_id, idx])
+  # Update all HRU states for each band, then apply new HRU area
+  # fractions calculated above.
+  for band_id in reversed(range(cell.num_bands)):
+    band = cell.bands[band_id]
+    if not isclose(new_glacier_area_frac[band_id], band.area_frac_glacier,\
+        abs_tol=1 / cell_area) or not isclose(new_band_area_frac[band_id],\
+        band.area_frac, abs_tol=1 / cell_area):
+      update_band_state(cell, band, band_id, new_band_area_frac,
+        new_glacier_area_frac, new_open_ground_area_frac, new_hru_area_frac,
+        delta_area_hru)
+
+def update_cells_area_fracs_packed(run_parms, packed_cells, veg_types,
+  cell_areas, *area_frac_arrays):
+  """Worker process side of a parallel update_area_fracs(): unpacks a shard
+    of cells, applies the state update to all of them given their
+    cell_areas and their rows of the arrays returned by
+    compute_new_area_fracs() (other than needs_update), and returns them
+    packed.
+    run_parms (from _run_parms()) carries the parent's per-run Cell and Band
+    attributes, which a spawned worker would not otherwise have.
+  """
+  for cls, attrs in ((Cell, run_parms['Cell']), (Band, run_parms['Band'])):
+    for name, value in attrs.items():
+      setattr(cls, name, value)
+  # A fresh store holds just this shard's HRU states
+  cells = unpack_cells(packed_cells, hru_store=HruStateStore())
+  veg_idx = { veg_type: idx for idx, veg_type in enumerate(veg_types) }
+  for cell_idx, (cell_id, cell) in enumerate(cells.items()):
+    _update_cell_area_fracs(cell_id, cell, float(cell_areas[cell_idx]),
+      veg_idx, *[array[cell_idx] for array in area_frac_arrays])
+  return pack_cells(cells)
+
+def _run_parms():
+  """ Returns the per-run Cell and Band class attributes """
+  return {
+    'Cell': { name: getattr(Cell, name) for name in
+      ('Nlayers', 'Nnodes', 'dist', 'NglacMassBalanceEqnTerms') },
+    'Band': { name: getattr(Band, name) for name in
+      ('glacier_id', 'glacier_root_zone_parms', 'open_ground_id',
+       'open_ground_root_zone_parms', 'band_size') }
+  }
+
+def pack_cells(cells):
+  """Packs the band median elevations, HRUs and HRU states of an OrderedDict
+    of cells into a dict of flat arrays (one entry per HRU, in cell, band and
+    HRU order), which is much cheaper to pickle than the cells themselves.
+    Cell states are not included.
+  """
+  hrus = []
+  hru_cells = []
+  hru_bands = []
+  hru_veg_types = []
+  for cell_idx, cell in enumerate(cells.values()):
+    for band_id, band in enumerate(cell.bands):
+      for veg_type, hru in band.hrus.items():
+        hrus.append(hru)
+        hru_cells.append(cell_idx)
+        hru_bands.append(band_id)
+        hru_veg_types.append(veg_type)
+
+  states = OrderedDict()
+  stores = { id(hru.hru_state.store): hru.hru_state.store for hru in hrus }
+  if len(stores) == 1:
+    store = next(iter(stores.values()))
+    slots = np.array([hru.hru_state.slot for hru in hrus], dtype=np.intp)
+    for var in store.variable_names:
+      states[var] = store.get_rows(slots, var)
+  elif hrus:
+    for var in hrus[0].hru_state.variables:
+      states[var] = np.array([hru.hru_state.variables[var] for hru in hrus])
+
+  return {
+    'cell_ids': list(cells.keys()),
+    # kept as lists, since median elevations of empty bands are (and are
+    # written out as) ints
+    'median_elevs': [[band.median_elev for band in cell.bands]
+                     for cell in cells.values()],
+    'hru_cell': np.array(hru_cells, dtype=np.intp),
+    'hru_band': np.array(hru_bands, dtype=np.intp),
+    'hru_veg_type': np.array(hru_veg_types, dtype=np.intp),
+    'hru_area_frac': np.array([hru.area_frac for hru in hrus], dtype=float),
+    'hru_root_zone_parms': np.array([hru.root_zone_parms for hru in hrus],
+                                    dtype=float),
+    'hru_states': states
+  }
+
+def unpack_cells(packed, cells=None, hru_store=None):
+  """Applies cells packed by pack_cells() to the matching cells of an
+    OrderedDict of cells, reusing their existing HRUs, creating new ones (in
+    each cell's hru_store) and releasing the state store slots of the ones
+    no longer present. If cells is None, new cells (with default cell states)
+    are created, holding their HRU states in hru_store (a new one by
+    default). Returns the cells.
+  """
+  if cells is None:
+    if hru_store is None:
+      hru_store = HruStateStore()
+    cells = OrderedDict((cell_id, Cell([Band(median_elev)
+      for median_elev in median_elevs], hru_store)) for cell_id, median_elevs
+      in zip(packed['cell_ids'], packed['median_elevs']))
+  cell_stores = [cells[cell_id].hru_store for cell_id in packed['cell_ids']]
+  bands = [cells[cell_id].bands for cell_id in packed['cell_ids']]
+  for cell_bands, median_elevs in zip(bands, packed['median_elevs']):
+    for band, median_elev in zip(cell_bands, median_elevs):
+      band.median_elev = median_elev
+
+  # Rebuild each band's dict of HRUs in packed order. New HRUs get their
+  # slots in one go per store; their state is written below.
+  hru_records = list(zip(packed['hru_cell'].tolist(),
+    packed['hru_band'].tolist(), packed['hru_veg_type'].tolist(),
+    packed['hru_area_frac'].tolist(), packed['hru_root_zone_parms'].tolist()))
+  num_new_hrus = OrderedDict()
+  for cell_idx, band_id, veg_type, _, _ in hru_records:
+    if veg_type not in bands[cell_idx][band_id].hrus:
+      store = cell_stores[cell_idx]
+      num_new_hrus[store] = num_new_hrus.get(store, 0) + 1
+  new_slots = { store: iter(store.allocate_rows(num_hrus).tolist())
+    for store, num_hrus in num_new_hrus.items() }
+  new_hrus = {}
+  hrus = []
+  for cell_idx, band_id, veg_type, area_frac, root_zone_parms in hru_records:
+    band = bands[cell_idx][band_id]
+    hru = band.hrus.get(veg_type)
+    if hru is None:
+      store = cell_stores[cell_idx]
+      hru = HydroResponseUnit(area_frac, root_zone_parms, band_id, veg_type,
+        store, HruState.from_slot(store, next(new_slots[store])))
+    else:
+      hru.area_frac = area_frac
+      hru.root_zone_parms = root_zone_parms
+    new_hrus.setdefault((cell_idx, band_id), {})[veg_type] = hru
+    hrus.append(hru)
+  for cell_idx, cell_bands in enumerate(bands):
+    for band_id, band in enumerate(cell_bands):
+      band_hrus = new_hrus.get((cell_idx, band_id), {})
+      for veg_type, hru in band.hrus.items():
+        if veg_type not in band_hrus:
+          # (dropped HRUs don't keep their state, unlike with delete_hru())
+          hru.hru_state.discard()
+      band.hrus = band_hrus
+
+  # Write the HRU states, one column at a time per store
+  hru_idxs_by_store = OrderedDict()
+  for hru_idx, hru in enumerate(hrus):
+    hru_idxs_by_store.setdefault(id(hru.hru_state.store),\
+      (hru.hru_state.store, []))[1].append(hru_idx)
+  for store, hru_idxs in hru_idxs_by_store.values():
+    slots = np.array([hrus[hru_idx].hru_state.slot for hru_idx in hru_idxs],
+                     dtype=np.intp)
+    for var, values in packed['hru_states'].items():
+      store.set_rows(slots, var, values[hru_idxs])
+  return cells
 
 def update_band_state(cell, band, band_id, new_band_area_frac,
             new_glacier_area_frac, new_open_ground_area_frac, new_hru_area_frac,
@@ -560,7 +1442,8 @@ def update_band_state(cell, band, band_id, new_band_area_frac,
     logging.debug('State update CASE 1 identified. New glacier appeared. '
       'Creating GLACIER HRU with area fraction %s',
       new_glacier_area_frac[band_id])
-    band.create_hru(band_id, Band.glacier_id, new_glacier_area_frac[band_id])
+    band.create_hru(band_id, Band.glacier_id, new_glacier_area_frac[band_id],
+                    cell.hru_store)
     new_area_fracs = {}
     update_hru_state(None, None, '1', **new_area_fracs)
   elif new_glacier_area_frac[band_id] == band.area_frac_glacier:
@@ -594,7 +1477,8 @@ def update_band_state(cell, band, band_id, new_band_area_frac,
     }
     # if there's not already an open ground HRU in this band, create one
     if Band.open_ground_id not in band.hrus:
-      band.create_hru(band_id, Band.open_ground_id, new_open_ground_area_frac[band_id])
+      band.create_hru(band_id, Band.open_ground_id,
+                      new_open_ground_area_frac[band_id], cell.hru_store)
     update_hru_state(
       band.hrus[Band.glacier_id],
       band.hrus[Band.open_ground_id],
@@ -618,7 +1502,8 @@ def update_band_state(cell, band, band_id, new_band_area_frac,
         'Creating GLACIER HRU with area fraction %s', band_id - 1,
         new_glacier_area_frac[band_id - 1])
       cell.bands[band_id - 1].create_hru(band_id - 1, Band.glacier_id, \
-                                         new_glacier_area_frac[band_id - 1])
+                                         new_glacier_area_frac[band_id - 1],
+                                         cell.hru_store)
     new_area_fracs = {
       'new_glacier_area_frac': new_glacier_area_frac[band_id - 1]
     }
@@ -644,7 +1529,8 @@ def update_band_state(cell, band, band_id, new_band_area_frac,
         'Creating OPEN GROUND HRU with area fraction %s.', band_id - 1,
         new_open_ground_area_frac[band_id - 1])
       cell.bands[band_id - 1].create_hru(band_id - 1, Band.open_ground_id, \
-                                         new_open_ground_area_frac[band_id - 1])
+                                         new_open_ground_area_frac[band_id - 1],
+                                         cell.hru_store)
     new_area_fracs = {
       'new_open_ground_area_frac': new_open_ground_area_frac[band_id - 1]
     }
@@ -714,7 +1600,7 @@ def update_band_state(cell, band, band_id, new_band_area_frac,
       'exposed. Creating OPEN GROUND HRU with area fraction %s.',
       new_open_ground_area_frac[band_id])
     band.create_hru(band_id, Band.open_ground_id,
-                    new_open_ground_area_frac[band_id])
+                    new_open_ground_area_frac[band_id], cell.hru_store)
     new_area_fracs = {}
     update_hru_state(None, None, '1', **new_area_fracs)
   elif new_open_ground_area_frac[band_id] == band.area_frac_open_ground:
@@ -773,7 +1659,8 @@ def update_band_state(cell, band, band_id, new_band_area_frac,
         'Creating GLACIER HRU with area_frac %s.',
         band_id - 1, new_glacier_area_frac[band_id - 1])
       cell.bands[band_id - 1].create_hru(band_id - 1, Band.glacier_id, \
-                                         new_glacier_area_frac[band_id - 1])
+                                         new_glacier_area_frac[band_id - 1],
+                                         cell.hru_store)
     new_area_fracs = {
       'new_glacier_area_frac': new_glacier_area_frac[band_id - 1]
     }
@@ -801,7 +1688,8 @@ def update_band_state(cell, band, band_id, new_band_area_frac,
         'Creating OPEN GROUND HRU with area fraction %s.', band_id - 1,
         new_open_ground_area_frac[band_id - 1])
       cell.bands[band_id - 1].create_hru(band_id - 1, Band.open_ground_id,
-                                      new_open_ground_area_frac[band_id - 1])
+                                      new_open_ground_area_frac[band_id - 1],
+                                      cell.hru_store)
     new_area_fracs = {
       'new_open_ground_area_frac': new_open_ground_area_frac[band_id - 1]
     }
@@ -861,7 +1749,19 @@ def update_band_state(cell, band, band_id, new_band_area_frac,
     band.hrus[Band.open_ground_id].area_frac = new_open_ground_area_frac[band_id]
 
   ### Update area fractions and states for all remaining non-glacier and
-  # non-open ground HRUs in this band
+  # non-open ground HRUs in this band. Their state updates are gathered by
+  # case and carried out a case at a time by update_hru_states() (which
+  # gives the same results as calling update_hru_state() on each in turn),
+  # before their new area fractions are applied.
+  veg_state_updates = OrderedDict()
+  def update_veg_hru_state(source_hru, dest_hru, case, **new_area_fracs):
+    new_area_frac, = new_area_fracs.values()
+    source_hrus, dest_hrus, case_area_fracs = veg_state_updates.setdefault(
+      case, ([], [], []))
+    source_hrus.append(source_hru)
+    dest_hrus.append(dest_hru)
+    case_area_fracs.append(new_area_frac)
+
   for veg_type, hru in band.hrus.items():
     if veg_type is not Band.glacier_id and veg_type is not Band.open_ground_id:
       logging.debug('VEGETATED HRU %s update phase...', veg_type)
@@ -888,7 +1788,7 @@ def update_band_state(cell, band, band_id, new_band_area_frac,
         new_area_fracs = {
           'new_hru_area_frac': new_hru_area_frac[str(band_id)][str(veg_type)]
         }
-        update_hru_state(
+        update_veg_hru_state(
           hru,
           hru,
           '3', **new_area_fracs)
@@ -905,7 +1805,7 @@ def update_band_state(cell, band, band_id, new_band_area_frac,
         new_area_fracs = {
           'new_glacier_area_frac': new_glacier_area_frac[band_id]
         }
-        update_hru_state(
+        update_veg_hru_state(
           hru,
           band.hrus[Band.glacier_id],
           '4b', **new_area_fracs)
@@ -930,11 +1830,12 @@ def update_band_state(cell, band, band_id, new_band_area_frac,
             'Creating GLACIER HRU with area fraction %s.', band_id - 1,
             new_glacier_area_frac[band_id - 1])
           cell.bands[band_id - 1].create_hru(band_id - 1, Band.glacier_id, \
-                                             new_glacier_area_frac[band_id - 1])
+                                             new_glacier_area_frac[band_id - 1],
+                                             cell.hru_store)
         new_area_fracs = {
           'new_glacier_area_frac': new_glacier_area_frac[band_id - 1]
         }
-        update_hru_state(
+        update_veg_hru_state(
           hru,
           cell.bands[band_id - 1].hrus[Band.glacier_id],
           '5a', **new_area_fracs)
@@ -958,11 +1859,12 @@ def update_band_state(cell, band, band_id, new_band_area_frac,
             'Creating OPEN GROUND HRU with area fraction %s.',
             band_id - 1, new_open_ground_area_frac[band_id - 1])
           cell.bands[band_id - 1].create_hru(band_id - 1, Band.open_ground_id,
-                                        new_open_ground_area_frac[band_id - 1])
+                                        new_open_ground_area_frac[band_id - 1],
+                                        cell.hru_store)
         new_area_fracs = {
           'new_open_ground_area_frac': new_open_ground_area_frac[band_id - 1]
         }
-        update_hru_state(
+        update_veg_hru_state(
           hru,
           cell.bands[band_id - 1].hrus[Band.open_ground_id],
           '5b', **new_area_fracs)
@@ -984,7 +1886,7 @@ def update_band_state(cell, band, band_id, new_band_area_frac,
         new_area_fracs = {
           'new_hru_area_frac': new_hru_area_frac[str(band_id - 1)][str(max_veg_type_below)]
         }
-        update_hru_state(
+        update_veg_hru_state(
           hru,
           cell.bands[band_id - 1].hrus[int(max_veg_type_below)],
           '5c', **new_area_fracs)
@@ -1004,7 +1906,7 @@ def update_band_state(cell, band, band_id, new_band_area_frac,
         new_area_fracs = {
           'new_glacier_area_frac': new_glacier_area_frac[band_id + 1]
         }
-        update_hru_state(
+        update_veg_hru_state(
           hru,
           cell.bands[band_id + 1].hrus[Band.glacier_id],
           '5d', **new_area_fracs)
@@ -1013,9 +1915,15 @@ def update_band_state(cell, band, band_id, new_band_area_frac,
           'Error: No state update case identified for band {}, HRU {}.'
           .format(band_id, veg_type)
         )
-      # Apply update to the HRU's area fraction. HRU will get deleted later
-      # if this is 0 (it will have already been added to hrus_to_be_deleted)
-      band.hrus[veg_type].area_frac = new_hru_area_frac[str(band_id)][str(veg_type)]
+  for case, (source_hrus, dest_hrus, case_area_fracs) \
+      in veg_state_updates.items():
+    update_hru_states(source_hrus, dest_hrus, case,
+      **{_case_area_frac_kwargs[case]: case_area_fracs})
+  # Apply update to the HRUs' area fractions. HRUs will get deleted later
+  # if this is 0 (they will have already been added to hrus_to_be_deleted)
+  for veg_type, hru in band.hrus.items():
+    if veg_type is not Band.glacier_id and veg_type is not Band.open_ground_id:
+      hru.area_frac = new_hru_area_frac[str(band_id)][str(veg_type)]
 
   # Remove HRUs marked for deletion
   for hru in hrus_to_be_deleted:
@@ -1417,3 +2325,149 @@ def update_hru_state(source_hru, dest_hru, case, **kwargs):
       elif var in spec_9_vars:
         source_hru.hru_state.variables[var] = 0
         dest_hru.hru_state.variables[var] = 0
+
+# Name of the new area fraction keyword argument used by each transfer case
+_case_area_frac_kwargs = {
+  '3': 'new_hru_area_frac',
+  '4a': 'new_open_ground_area_frac',
+  '4b': 'new_glacier_area_frac',
+  '5a': 'new_glacier_area_frac',
+  '5b': 'new_open_ground_area_frac',
+  '5c': 'new_hru_area_frac',
+  '5d': 'new_glacier_area_frac'
+}
+
+def update_hru_states(source_hrus, dest_hrus, case, **kwargs):
+  """ Batched counterpart of update_hru_state(). Applies the same State Update
+    Spec 3.0 case to each (source_hrus[i], dest_hrus[i]) pair, with the new
+    area fraction keyword argument of that case given as one value (or a
+    sequence of values, one per pair). Pairs are processed as whole-column
+    operations on the HruStateStore they share (a single pair is simply
+    handed to update_hru_state()). Pairs that touch an HRU
+    already touched by an earlier pair of the batch (e.g. several HRUs
+    transferring state to the same glacier HRU) are deferred to a following
+    round, so that the results are identical to calling update_hru_state()
+    on each pair in turn.
+  """
+  if case == '1' or case == '2':
+    return
+  source_hrus = list(source_hrus)
+  dest_hrus = list(dest_hrus)
+  if len(source_hrus) != len(dest_hrus):
+    raise ValueError('update_hru_states: got {} source HRUs but {} '
+      'destination HRUs'.format(len(source_hrus), len(dest_hrus)))
+  area_frac_kwarg = _case_area_frac_kwargs[case]
+  new_area_fracs = np.broadcast_to(np.asarray(kwargs[area_frac_kwarg],
+    dtype=float), (len(source_hrus),))
+  if len(source_hrus) == 1:
+    # (not worth the whole-column operations)
+    update_hru_state(source_hrus[0], dest_hrus[0], case,
+                     **{area_frac_kwarg: float(new_area_fracs[0])})
+    return
+
+  def flush(round_pairs):
+    if round_pairs:
+      idxs = np.array(round_pairs)
+      _update_hru_state_rows(store,
+        np.array([source_hrus[i].hru_state.slot for i in idxs]),
+        np.array([dest_hrus[i].hru_state.slot for i in idxs]),
+        np.array([source_hrus[i].area_frac for i in idxs], dtype=float),
+        np.array([dest_hrus[i].area_frac for i in idxs], dtype=float),
+        new_area_fracs[idxs], case)
+
+  store = None
+  round_pairs = []
+  touched_slots = set()
+  for i, (source_hru, dest_hru) in enumerate(zip(source_hrus, dest_hrus)):
+    if source_hru.hru_state.store is not dest_hru.hru_state.store:
+      # e.g. a released HRU holding its state in a private store
+      flush(round_pairs)
+      round_pairs, touched_slots = [], set()
+      update_hru_state(source_hru, dest_hru, case,
+                       **{area_frac_kwarg: new_area_fracs[i]})
+      continue
+    slots = { source_hru.hru_state.slot, dest_hru.hru_state.slot }
+    if source_hru.hru_state.store is not store or slots & touched_slots:
+      flush(round_pairs)
+      store = source_hru.hru_state.store
+      round_pairs, touched_slots = [], set()
+    round_pairs.append(i)
+    touched_slots |= slots
+  flush(round_pairs)
+
+def _update_hru_state_rows(store, src, dest, src_area_frac, dest_area_frac,
+                           new_area_frac, case):
+  """ Applies a State Update Spec 3.0 case to the HRUs at slots src and dest
+    of store, none of which may appear twice. Mirrors update_hru_state()
+    variable by variable, in store variable order.
+  """
+  get = store.get_rows
+  set_rows = store.set_rows
+
+  def zero(slots, var):
+    if len(slots):
+      store.set_rows(slots, var, 0)
+
+  def per_row(values, var):
+    # Reshapes per-HRU factors to broadcast against the rows of var
+    return values.reshape((-1,) + (1,) * len(store.shapes[var]))
+
+  ratio = src_area_frac / new_area_frac
+  transfer = case != '3'
+  for var in list(store.variable_names):
+    if var in spec_2_vars:
+      scaled = get(src, var) * per_row(ratio, var)
+      set_rows(dest, var, get(dest, var) + scaled if transfer else scaled)
+      if transfer and var == 'SNOW_CANOPY': # spec-10 sanity check
+        has_canopy = dest[get(dest, var) > 0]
+        if len(has_canopy):
+          store.set_rows(has_canopy, 'SNOW_SWQ',
+            get(has_canopy, 'SNOW_SWQ') + get(has_canopy, 'SNOW_CANOPY'))
+          zero(has_canopy, 'SNOW_CANOPY')
+    elif var in spec_3_vars: # SNOW_DENSITY
+      # avoid division by zero
+      has_depth = get(dest, 'SNOW_DEPTH') > 0
+      if np.any(has_depth):
+        store.set_rows(dest[has_depth], var,
+          (get(dest[has_depth], 'SNOW_SWQ') * 1000)
+          / get(dest[has_depth], 'SNOW_DEPTH'))
+      zero(dest[~has_depth], var)
+    elif var in spec_4_vars: # GLAC_WATER_STORAGE
+      if case == '4b':
+        continue # this value is carried over from the previous time step
+      scaled = get(src, var) * ratio
+      set_rows(dest, var, get(dest, var) + scaled if transfer else scaled)
+      if case in ('4a', '5b', '5c'): # spec-10 sanity check
+        has_storage = dest[get(dest, var) > 0]
+        if len(has_storage):
+          #FIXME: hard-coding the dist dim to [0] for now
+          moist = get(has_storage, 'LAYER_MOIST')
+          moist[:, 0, Cell.Nlayers-1] += get(has_storage, var)
+          set_rows(has_storage, 'LAYER_MOIST', moist)
+          zero(has_storage, var)
+    elif var in spec_5_vars: # GLAC_CUM_MASS_BALANCE
+      if transfer:
+        zero(src, var)
+        zero(dest, var)
+    elif var in spec_6_vars: # SNOW_COLD_CONTENT
+      swq = get(dest, 'SNOW_SWQ')
+      # as min(MAX_SURFACE_SWE, swq), which also returns MAX_SURFACE_SWE for
+      # a nan swq
+      surface_swe = np.where(swq < MAX_SURFACE_SWE, swq, MAX_SURFACE_SWE)
+      set_rows(dest, var, get(dest, 'SNOW_SURF_TEMP') * surface_swe * CH_ICE)
+    elif var in spec_7_vars:
+      if transfer:
+        dest_weight = dest_area_frac * (get(dest, 'SNOW_SWQ') >= 0)
+        src_weight = src_area_frac * (get(src, 'SNOW_SWQ') >= 0)
+        values = (get(dest, var) * per_row(dest_weight, var)
+          + get(src, var) * per_row(src_weight, var)) \
+          / per_row(dest_weight + src_weight, var)
+        if var == 'SNOW_LAST_SNOW' or var == 'SNOW_MELTING':
+          # update_hru_state() rounds these up to ints
+          values = np.ceil(values)
+        set_rows(dest, var, values)
+        zero(src, var)
+    elif var in spec_9_vars:
+      if transfer:
+        zero(src, var)
+        zero(dest, var)
@@ -5,71 +5,178 @@
 
 """
 
-import numpy as np
 import csv
+import io
+import logging
+import os
+import shutil
+import sys
+
+import numpy as np
 import netCDF4
 
-def get_rgm_pixel_mapping(pixel_map_file):
+from conductor.cells import CellPixelIndex
+from conductor.grids import TILE_PIXELS, row_tiles, pixel_tiles, new_grid,\
+  memmap_grid
+
+def _parse_int_columns(chunk, num_cols, cols):
+  """ Parses the given columns of a whitespace-delimited table of
+    non-negative integers held in a bytes chunk of whole lines with
+    np.loadtxt, returning a (num_lines, len(cols)) int64 array and a boolean
+    array flagging the 'NA' entries. Raises ValueError unless every
+    (non-blank) line holds num_cols numbers, and the given columns only hold
+    non-negative integers or 'NA'.
+  """
+  # ('NA' entries are read as NaN)
+  table = np.loadtxt(io.BytesIO(chunk.replace(b'NA', b'nan')), ndmin=2)
+  if table.shape[1] != num_cols:
+    raise ValueError('expected {} columns per line, found {}'.format(\
+      num_cols, table.shape[1]))
+  table = table[:, cols]
+  is_na = np.isnan(table)
+  values = np.where(is_na, 0, table)
+  bad_entries = np.flatnonzero(np.any((values < 0)\
+    | (values != np.floor(values)), axis=1))
+  if len(bad_entries):
+    raise ValueError('expected non-negative integers in columns {}, found {} \
+      at row {}'.format(cols, table[bad_entries[0]].tolist(), bad_entries[0]))
+  return values.astype(np.int64), is_na
+
+def get_rgm_pixel_mapping(pixel_map_file, chunk_size=2**20):
   """ Parses the RGM pixel to VIC grid cell mapping file and initialises a 2D
     grid of dimensions num_rows_dem x num_cols_dem (matching the RGM pixel
     grid), each element containing a list with the VIC cell ID associated
-    with that RGM pixel and its median elevation
+    with that RGM pixel and its median elevation.
+    The table is read in blocks of about chunk_size bytes, each parsed as a
+    whole by np.loadtxt, of which the ROW, COL and CELL_ID columns are kept.
+    The pixel-granularity
+    cell areas are tallied with np.bincount, keyed (as before) by cell ID
+    string in order of first appearance, with 'NA' counting the pixels lying
+    outside of the VIC domain.
   """
   cell_areas = {}
   headers = {}
-  with open(pixel_map_file, 'r') as f:
+  with open(pixel_map_file, 'rb') as f:
     # Read the number of columns and rows (order is unimportant)
     for _ in range(2):
       key, value = f.readline().split(None, 1)
-      headers[key] = value
+      headers[key.decode()] = value
     nx = int(headers['NCOLS'])
     ny = int(headers['NROWS'])
     # create an empty two dimensional array
     cell_id_map = np.empty((ny, nx))
     cell_id_map.fill(np.nan)
     _ = f.readline() # Consume the column headers
-    for line in f:
-      # Note that we are ignoring the median elevation data (5th column)
-      _, i, j, _, _, cell_id = line.split()
-      i, j = int(i), int(j)
-      if cell_id != 'NA': #otherwise we leave it as np.NaN
-        cell_id_map[i,j] = cell_id
-      # Increment the pixel-granularity area within the grid cell
-      if cell_id in cell_areas:
-        cell_areas[cell_id] += 1
+    remainder = b''
+    while True:
+      block = f.read(chunk_size)
+      chunk = remainder + block
+      if block:
+        # Hold back the trailing partial line for the next block
+        split = chunk.rfind(b'\n') + 1
+        chunk, remainder = chunk[:split], chunk[split:]
       else:
-        cell_areas[cell_id] = 1
-  vic_cell_mask = np.ma.masked_array(np.int32(cell_id_map))
-  vic_cell_mask[np.where(np.isnan(cell_id_map))] = np.ma.masked
+        chunk, remainder = chunk + b'\n', b''
+      if chunk.strip():
+        # Note that we are ignoring the median elevation data (5th column)
+        try:
+          table, is_na = _parse_int_columns(chunk, 6, (1, 2, 5))
+          if np.any(is_na[:, :2]):
+            raise ValueError('NA pixel row or column')
+        except ValueError as e:
+          raise Exception('get_rgm_pixel_mapping({}): malformed pixel map \
+            file: {}'.format(pixel_map_file, e))
+        in_domain = ~is_na[:, 2]
+        #otherwise we leave it as np.NaN
+        cell_id_map[table[in_domain, 0], table[in_domain, 1]] \
+          = table[in_domain, 2]
+        # Increment the pixel-granularity area within each grid cell (NA
+        # pixels are tallied under a -1 placeholder ID)
+        cell_nums = np.where(in_domain, table[:, 2], -1)
+        unique_nums, first_inds, inverse = np.unique(cell_nums,\
+          return_index=True, return_inverse=True)
+        counts = np.bincount(inverse.ravel())
+        for idx in np.argsort(first_inds):
+          cell_num = int(unique_nums[idx])
+          cell_id = 'NA' if cell_num == -1 else str(cell_num)
+          cell_areas[cell_id] = cell_areas.get(cell_id, 0) + int(counts[idx])
+      if not block:
+        break
+  out_of_domain = np.isnan(cell_id_map)
+  vic_cell_mask = np.ma.masked_array(np.where(out_of_domain,\
+    np.iinfo(np.int32).min, cell_id_map).astype(np.int32))
+  vic_cell_mask[np.where(out_of_domain)] = np.ma.masked
 
   return vic_cell_mask, cell_areas, nx, ny
 
+# (bumped whenever what is returned for the same file changes, so that input
+# cache entries written before aren't used)
+get_rgm_pixel_mapping.cache_version = 1
+
+def reset_out_of_domain_elevations(vic_cell_mask, surf_dem, bed_dem,\
+  num_rows_dem, num_cols_dem, tile_pixels=TILE_PIXELS):
+  """ Sets the surf_dem elevations of the pixels lying outside of the VIC
+    domain to those of the bed_dem (in place), a tile of rows at a time
+  """
+  for rows in row_tiles(num_rows_dem, num_cols_dem, tile_pixels):
+    out_of_domain = np.ma.getmaskarray(vic_cell_mask[rows])
+    surf_dem[rows][out_of_domain] = bed_dem[rows][out_of_domain]
+
 def mass_balances_to_rgm_grid(gmb_polys, vic_cell_mask, surf_dem, bed_dem, \
-  num_rows_dem, num_cols_dem):
+  num_rows_dem, num_cols_dem, pixel_index=None, mass_balance_grid=None,\
+  tile_pixels=TILE_PIXELS):
   """ Translate mass balances from grid cell GMB polynomials to 2D RGM pixel \
-    grid to use as one of the inputs to RGM
-  """
-  mass_balance_grid = np.ma.empty(vic_cell_mask.shape)
-  mass_balance_grid[np.where(vic_cell_mask.mask)] = 0
-  try:
-    for row in range(num_rows_dem):
-      for col in range(num_cols_dem):
-        # only grab elevation for pixels that fall within a VIC cell
-        if vic_cell_mask[row][col] is not np.ma.masked:
-          cell_id = str(vic_cell_mask[row][col])
-          # read most recent median elevation of this pixel
-          median_elev = surf_dem[row][col]
-          mass_balance_grid[row][col] = gmb_polys[cell_id][0] + median_elev \
-            * (gmb_polys[cell_id][1] + median_elev * gmb_polys[cell_id][2])
-        else:
-          surf_dem[row][col] = bed_dem[row][col]
-  except Exception as e:
+    grid to use as one of the inputs to RGM. The GMB polynomial terms are
+    gathered into a dense coefficient array indexed by compact cell index
+    (as given by pixel_index, a cells.CellPixelIndex, which is built from
+    vic_cell_mask if not provided), so that the polynomial is evaluated over
+    the whole grid in one expression per tile of about tile_pixels pixels
+    (the DEMs may be np.memmap grids). Pixels lying outside of the VIC domain
+    get a mass balance of zero, and their surf_dem elevations are set to
+    those of the bed_dem (in place). The mass balances are written into
+    mass_balance_grid (e.g. a grids.new_grid() memmap) if given.
+  """
+  def exit_on_pixel_error(pixel_ind, e):
+    row, col = np.unravel_index(pixel_ind, (num_rows_dem, num_cols_dem))
     print('mass_balances_to_rgm_grid: Exception while processing pixel at \
 row {} column {}: \n{}'.format(row, col, e))
-    logging.error('mass_balances_to_rgm_grid: Exception while processing pixel \
-at row %s column %s: \n %s', row, col, e)
+    logging.error('mass_balances_to_rgm_grid: Exception while processing \
+pixel at row %s column %s: \n %s', row, col, e)
     sys.exit(0)
-  return mass_balance_grid
+
+  if pixel_index is None:
+    pixel_index = CellPixelIndex.from_cell_mask(vic_cell_mask)
+  if len(pixel_index.orphan_pixel_inds):
+    pixel_ind = pixel_index.orphan_pixel_inds[0]
+    exit_on_pixel_error(pixel_ind,
+      KeyError(str(np.ma.getdata(vic_cell_mask).flat[pixel_ind])))
+
+  reset_out_of_domain_elevations(vic_cell_mask, surf_dem, bed_dem,\
+    num_rows_dem, num_cols_dem, tile_pixels)
+
+  # Cell ID lookup table: row i holds the polynomial terms of the cell with
+  # compact index i
+  gmb_coeffs = np.empty((pixel_index.num_cells, 3))
+  for idx, cell_id in enumerate(pixel_index.cell_ids):
+    try:
+      gmb_poly = gmb_polys[cell_id]
+      gmb_coeffs[idx] = [gmb_poly[0], gmb_poly[1], gmb_poly[2]]
+    except (KeyError, IndexError) as e:
+      exit_on_pixel_error(pixel_index.cell_pixels(cell_id)[0], e)
+
+  if mass_balance_grid is None:
+    mass_balance_grid = np.zeros((num_rows_dem, num_cols_dem))
+  else:
+    for rows in row_tiles(num_rows_dem, num_cols_dem, tile_pixels):
+      mass_balance_grid[rows] = 0
+  mass_balances = mass_balance_grid.reshape(-1)
+  for pixels in pixel_tiles(pixel_index.num_pixels, tile_pixels):
+    # read most recent median elevation of the pixels
+    median_elev = pixel_index.gather(surf_dem, pixels)
+    pixel_coeffs = gmb_coeffs[pixel_index.pixel_cells[pixels]]
+    mass_balances[pixel_index.pixel_inds[pixels]] = pixel_coeffs[:, 0]\
+      + median_elev * (pixel_coeffs[:, 1] + median_elev * pixel_coeffs[:, 2])
+  return np.ma.masked_array(mass_balance_grid)
 
 def read_gsa_headers(dem_file):
   """ Opens and reads the header metadata from a GSA Digital Elevation Map
@@ -90,63 +197,362 @@ def read_gsa_headers(dem_file):
     out_2 = [int(x) for x in (num_rows, num_cols)]
   return out_1 + out_2
 
+def read_gsa_grid(dem_file, chunk_size=2**20, filename=None):
+  """ Reads a GSA Digital Elevation Map (or other grid, e.g. glacier mask or
+    RGM output) file into a 2D float array of the dimensions stated in its
+    header, held in a np.memmap backed by filename (which is created or
+    overwritten) if given. The body is parsed in blocks of about chunk_size
+    bytes straight into the preallocated grid, raising an Exception if the
+    number of values found does not match the header.
+  """
+  _, _, _, _, num_rows, num_cols = read_gsa_headers(dem_file)
+  grid = new_grid((num_rows, num_cols), filename=filename)
+  # (a flat view, through which values are written into the grid)
+  values_out = grid.reshape(-1)
+  num_values = 0
+  with open(dem_file, 'rb') as f:
+    for _ in range(5): # DSAA, dimensions, x, y and z extents lines
+      f.readline()
+    remainder = b''
+    while True:
+      block = f.read(chunk_size)
+      chunk = remainder + block
+      if block:
+        # Hold back a trailing partial number for the next block
+        split = max(chunk.rfind(b' '), chunk.rfind(b'\n')) + 1
+        chunk, remainder = chunk[:split], chunk[split:]
+      # (np.fromstring parses a whitespace-only string as [-1.])
+      values = np.fromstring(chunk, sep=' ') if chunk.strip()\
+        else values_out[:0]
+      if num_values + len(values) > len(values_out):
+        raise Exception('read_gsa_grid({}): more values found than the {} \
+          rows x {} columns stated in the header.'.format(dem_file, num_rows,\
+          num_cols))
+      values_out[num_values:num_values + len(values)] = values
+      num_values += len(values)
+      if not block:
+        break
+  if num_values != len(values_out):
+    raise Exception('read_gsa_grid({}): {} values found, but the header \
+      states {} rows x {} columns.'.format(dem_file, num_values, num_rows,\
+      num_cols))
+  if filename is not None:
+    grid.flush()
+  return grid
+
 def write_grid_to_gsa_file(grid, outfilename, num_cols_dem, num_rows_dem,\
-    dem_xmin, dem_xmax, dem_ymin, dem_ymax):
+    dem_xmin, dem_xmax, dem_ymin, dem_ymax, precision=None, block_rows=256):
   """ Writes a 2D grid to ASCII file in the input format expected by the RGM \
-  for DEM and mass balance grids """
+  for DEM and mass balance grids. Values are written with the given number
+  of decimal places, or in their shortest round-trip form (as csv.writer
+  did) if precision is None. Rows are formatted block_rows at a time and
+  written as one string per block.
+  """
   zmin = np.min(grid)
   zmax = np.max(grid)
   header_rows = [['DSAA'], [num_cols_dem, num_rows_dem], [dem_xmin, dem_xmax],\
     [dem_ymin, dem_ymax], [zmin, zmax]]
+  values = np.ma.getdata(grid)
+  if precision is not None:
+    row_format = ' '.join(['%.{}f'.format(precision)] * values.shape[1])\
+      + '\r\n'
   with open(outfilename, 'w') as csvfile:
     writer = csv.writer(csvfile, delimiter=' ')
     for header_row in header_rows:
       writer.writerow(header_row)
-    for row in grid:
-      writer.writerow(row)
+    # Rows end in '\r\n', like the csv.writer header rows
+    for start in range(0, len(values), block_rows):
+      rows = values[start:start + block_rows].tolist()
+      if precision is None:
+        lines = [' '.join(map(repr, row)) + '\r\n' for row in rows]
+      else:
+        lines = [row_format % tuple(row) for row in rows]
+      csvfile.write(''.join(lines))
+
+# Surfer binary grid layouts (little-endian). Surfer 6 (DSBB): 'DSBB', then
+# num_cols and num_rows as int16, the x, y and z extents as doubles, and the
+# grid as float32. Surfer 7 (DSRB): a header section ('DSRB', size, version),
+# a grid section ('GRID', size, num_rows and num_cols as int32, then x and y
+# of the lower left corner, x and y spacing, z extents, rotation and blank
+# value as doubles) and a data section ('DATA', size), followed by the grid
+# as doubles. In all formats the grid is stored row by row, first row first.
+DSBB_HEADER = np.dtype([('id', 'S4'), ('num_cols', '<i2'), ('num_rows', '<i2'),\
+  ('xmin', '<f8'), ('xmax', '<f8'), ('ymin', '<f8'), ('ymax', '<f8'),\
+  ('zmin', '<f8'), ('zmax', '<f8')])
+DSRB_HEADER = np.dtype([('id', 'S4'), ('header_size', '<i4'),\
+  ('version', '<i4'), ('grid_id', 'S4'), ('grid_size', '<i4'),\
+  ('num_rows', '<i4'), ('num_cols', '<i4'), ('xll', '<f8'), ('yll', '<f8'),\
+  ('xsize', '<f8'), ('ysize', '<f8'), ('zmin', '<f8'), ('zmax', '<f8'),\
+  ('rotation', '<f8'), ('blank_value', '<f8'), ('data_id', 'S4'),\
+  ('data_size', '<i4')])
+# Surfer's value for blanked grid nodes
+SURFER_BLANK_VALUE = 1.70141e38
+GRID_FORMATS = ['DSAA', 'DSBB', 'DSRB']
+
+def get_grid_format(grid_file):
+  """ Returns the Surfer grid format (one of GRID_FORMATS) of grid_file,
+    as given by its leading identifier
+  """
+  with open(grid_file, 'rb') as f:
+    grid_format = f.read(4).decode('ascii', 'replace')
+  if grid_format not in GRID_FORMATS:
+    raise Exception('get_grid_format({}): unrecognized grid file \
+      identifier {}. Supported formats are {}.'.format(grid_file,\
+      grid_format, GRID_FORMATS))
+  return grid_format
+
+def read_surfer_binary_header(grid_file):
+  """ Reads the header of a Surfer binary (DSBB or DSRB) grid file, returning
+    it as a numpy record of DSBB_HEADER or DSRB_HEADER type
+  """
+  grid_format = get_grid_format(grid_file)
+  assert grid_format != 'DSAA', 'read_surfer_binary_header({}): ASCII grid \
+    file given.'.format(grid_file)
+  header_dtype = DSBB_HEADER if grid_format == 'DSBB' else DSRB_HEADER
+  header = np.fromfile(grid_file, dtype=header_dtype, count=1)
+  if len(header) != 1:
+    raise Exception('read_surfer_binary_header({}): truncated {} header.'\
+      .format(grid_file, grid_format))
+  header = header[0]
+  if grid_format == 'DSRB' and (header['grid_id'] != b'GRID' \
+    or header['data_id'] != b'DATA'):
+    raise Exception('read_surfer_binary_header({}): unsupported DSRB section \
+      layout (expected GRID then DATA sections).'.format(grid_file))
+  return header
+
+def read_grid_headers(grid_file):
+  """ Returns the x and y extents and dimensions of a Surfer grid file of any
+    of the GRID_FORMATS, in the form returned by read_gsa_headers()
+  """
+  grid_format = get_grid_format(grid_file)
+  if grid_format == 'DSAA':
+    return read_gsa_headers(grid_file)
+  header = read_surfer_binary_header(grid_file)
+  num_rows, num_cols = int(header['num_rows']), int(header['num_cols'])
+  if grid_format == 'DSBB':
+    extents = [float(header[k]) for k in ('xmin', 'xmax', 'ymin', 'ymax')]
+  else:
+    xmin, ymin = float(header['xll']), float(header['yll'])
+    extents = [xmin, xmin + float(header['xsize']) * (num_cols - 1),\
+      ymin, ymin + float(header['ysize']) * (num_rows - 1)]
+  return extents + [num_rows, num_cols]
+
+def read_grid_file(grid_file, mmap_mode=None):
+  """ Reads a Surfer grid file of any of the GRID_FORMATS into a 2D array.
+    Binary grids are read without parsing, and are memory-mapped (as a
+    np.memmap opened with the given mode, e.g. 'r' or copy-on-write 'c')
+    if mmap_mode is given. DSBB grids hold float32 values, which are cast to
+    float64 when read into memory (but not when memory-mapped).
+  """
+  grid_format = get_grid_format(grid_file)
+  if grid_format == 'DSAA':
+    return read_gsa_grid(grid_file)
+  header = read_surfer_binary_header(grid_file)
+  shape = (int(header['num_rows']), int(header['num_cols']))
+  dtype = np.dtype('<f4') if grid_format == 'DSBB' else np.dtype('<f8')
+  offset = header.dtype.itemsize
+  expected_size = offset + shape[0] * shape[1] * dtype.itemsize
+  file_size = os.path.getsize(grid_file)
+  if file_size < expected_size:
+    raise Exception('read_grid_file({}): file holds {} bytes, but its {} \
+      header states {} rows x {} columns.'.format(grid_file, file_size,\
+      grid_format, shape[0], shape[1]))
+  if mmap_mode:
+    return np.memmap(grid_file, dtype=dtype, mode=mmap_mode, offset=offset,\
+      shape=shape)
+  with open(grid_file, 'rb') as f:
+    f.seek(offset)
+    return np.fromfile(f, dtype=dtype, count=shape[0] * shape[1])\
+      .reshape(shape).astype(np.float64, copy=False)
+
+read_grid_file.cache_version = 2
+
+def memmap_grid_file(grid_file, filename):
+  """ Reads a Surfer grid file of any of the GRID_FORMATS into a float64
+    np.memmap backed by filename (which is created or overwritten), without
+    ever holding the whole grid in memory: DSAA grids are parsed straight
+    into the memmap, DSRB files are copied to filename and mapped read-write,
+    and DSBB grids are widened from their mapped float32 values in row
+    tiles. The grid file itself is left untouched by changes to the memmap.
+  """
+  grid_format = get_grid_format(grid_file)
+  if grid_format == 'DSAA':
+    return read_gsa_grid(grid_file, filename=filename)
+  if grid_format == 'DSRB':
+    os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+    shutil.copyfile(grid_file, filename)
+    return read_grid_file(filename, mmap_mode='r+')
+  return memmap_grid(read_grid_file(grid_file, mmap_mode='r'), filename,\
+    np.float64)
+
+def write_grid_to_surfer_binary_file(grid, outfilename, grid_format,\
+    num_cols_dem, num_rows_dem, dem_xmin, dem_xmax, dem_ymin, dem_ymax):
+  """ Writes a 2D grid to a Surfer 6 (grid_format 'DSBB', single precision)
+    or Surfer 7 (grid_format 'DSRB', double precision) binary grid file,
+    in row tiles
+  """
+  values = np.ma.getdata(grid)
+  assert values.shape == (num_rows_dem, num_cols_dem),\
+    'write_grid_to_surfer_binary_file({}): grid shape {} does not match {} \
+    rows x {} columns.'.format(outfilename, values.shape, num_rows_dem,\
+    num_cols_dem)
+  if grid_format == 'DSBB':
+    assert max(num_rows_dem, num_cols_dem) <= np.iinfo(np.int16).max,\
+      'write_grid_to_surfer_binary_file({}): DSBB grids are limited to {} rows \
+      and columns.'.format(outfilename, np.iinfo(np.int16).max)
+    header = np.array((b'DSBB', num_cols_dem, num_rows_dem, dem_xmin,\
+      dem_xmax, dem_ymin, dem_ymax, np.min(grid), np.max(grid)),\
+      dtype=DSBB_HEADER)
+    data_dtype = np.dtype('<f4')
+  elif grid_format == 'DSRB':
+    xsize = (dem_xmax - dem_xmin) / max(num_cols_dem - 1, 1)
+    ysize = (dem_ymax - dem_ymin) / max(num_rows_dem - 1, 1)
+    header = np.array((b'DSRB', 4, 2, b'GRID', 72, num_rows_dem, num_cols_dem,\
+      dem_xmin, dem_ymin, xsize, ysize, np.min(grid), np.max(grid), 0,\
+      SURFER_BLANK_VALUE, b'DATA', num_rows_dem * num_cols_dem * 8),\
+      dtype=DSRB_HEADER)
+    data_dtype = np.dtype('<f8')
+  else:
+    raise Exception('write_grid_to_surfer_binary_file({}): unsupported \
+      binary grid format {}.'.format(outfilename, grid_format))
+  with open(outfilename, 'wb') as f:
+    header.tofile(f)
+    # (converted a row tile at a time, rather than as a whole-grid copy)
+    for rows in row_tiles(num_rows_dem, num_cols_dem):
+      np.ascontiguousarray(values[rows], dtype=data_dtype).tofile(f)
+
+def write_grid_file(grid, outfilename, grid_format, num_cols_dem,\
+    num_rows_dem, dem_xmin, dem_xmax, dem_ymin, dem_ymax, precision=None):
+  """ Writes a 2D grid to a Surfer grid file of the given format (one of
+    GRID_FORMATS). precision only applies to the ASCII (DSAA) format.
+  """
+  if grid_format == 'DSAA':
+    write_grid_to_gsa_file(grid, outfilename, num_cols_dem, num_rows_dem,\
+      dem_xmin, dem_xmax, dem_ymin, dem_ymax, precision)
+  else:
+    write_grid_to_surfer_binary_file(grid, outfilename, grid_format,\
+      num_cols_dem, num_rows_dem, dem_xmin, dem_xmax, dem_ymin, dem_ymax)
 
 def read_state(state_in, cells):
   """Reads the most recent state variables from the VIC state file produced by
     the most recent VIC run and updates the CellState and HruState object
-    members of each cell.
+    members of each cell. Each state variable is read from the file once, as
+    a whole array, and its values are then handed out to the cells and HRUs.
   """
   num_lats = len(state_in['lat'])
   num_lons = len(state_in['lon'])
 
+  state = {}
+  def read_variable(variable):
+    """ Returns the whole array of a state variable, read on first use """
+    if variable not in state:
+      state[variable] = state_in[variable][:]
+    return state[variable]
+
+  def element(variable, idx):
+    """ Returns a copy of the value(s) of a state variable at index idx (so
+      that states don't hold views into the whole array)
+    """
+    value = read_variable(variable)[idx]
+    return value.copy() if isinstance(value, np.ndarray) else value
+
+  grid_cells = read_variable('GRID_CELL')
   for cell_idx in range(0, num_lats*num_lons):
     cell_lat_idx, cell_lon_idx = np.unravel_index(cell_idx, (num_lats, num_lons))
-    cell_id = state_in['GRID_CELL'][cell_lat_idx][cell_lon_idx]
+    cell_id = grid_cells[cell_lat_idx, cell_lon_idx]
     cell_hru_idx = 0
     # Skip dummy cells (found in non-rectangular domains)
     if cell_id != netCDF4.default_fillvals['i4']:
       cell_id = str(cell_id)
       # read all cell state variables
-      for variable in cells[cell_id].cell_state.variables:
+      cell_state = cells[cell_id].cell_state.variables
+      for variable in cell_state:
         if variable == 'lat':
-          cells[cell_id].cell_state.variables[variable] = state_in[variable][cell_lat_idx]
+          cell_state[variable] = element(variable, cell_lat_idx)
         elif variable == 'lon':
-          cells[cell_id].cell_state.variables[variable] = state_in[variable][cell_lon_idx]
+          cell_state[variable] = element(variable, cell_lon_idx)
         else:
-          cells[cell_id].cell_state.variables[variable] = \
-            state_in[variable][cell_lat_idx][cell_lon_idx]
+          cell_state[variable] = \
+            element(variable, (cell_lat_idx, cell_lon_idx))
       for band in cells[cell_id].bands:
         # HRUs are sorted by ascending veg_type_num in VIC state file
         for hru_veg_type in band.hru_keys_sorted:
           # read all HRU state variables with dimensions (lat, lon, hru)
-          for variable in band.hrus[hru_veg_type].hru_state.variables:
-            band.hrus[hru_veg_type].hru_state.variables[variable] = \
-              state_in[variable][cell_lat_idx][cell_lon_idx][cell_hru_idx]
+          hru_state = band.hrus[hru_veg_type].hru_state.variables
+          for variable in hru_state:
+            hru_state[variable] = \
+              element(variable, (cell_lat_idx, cell_lon_idx, cell_hru_idx))
           cell_hru_idx += 1
 
-def write_state(cells, old_dataset, new_dataset, new_state_date):
+def max_num_hrus(cells):
+  """ Returns the length the hru dimension of the VIC state file must have
+    to hold the HRUs of all cells
+  """
+  return max(sum([band.num_hrus for band in cell.bands])
+             for cell in cells.values())
+
+def _assemble_state(cells, grid_cells, dataset, cell_variables=None):
+  """Returns a dict of the whole arrays of the state variables of the cells,
+    shaped for the variables of dataset, and masked, so that dummy cells and
+    unused HRU slots get the variable's fill value. Only the cell state
+    variables in cell_variables are included, if it is given.
+  """
+  grid_cells = np.ma.getdata(grid_cells)
+  num_lats, num_lons = grid_cells.shape
+
+  state = {}
+  def variable_array(variable):
+    """ Returns the (initially all masked) in-memory array of a state
+      variable, created on first use
+    """
+    if variable not in state:
+      var = dataset.variables[variable]
+      shape = [len(dataset.dimensions[d]) for d in var.dimensions]
+      state[variable] = np.ma.masked_all(shape, dtype=var.dtype)
+    return state[variable]
+
+  for cell_idx in range(0, num_lats*num_lons):
+    cell_lat_idx, cell_lon_idx = np.unravel_index(cell_idx, (num_lats, num_lons))
+    cell_id = grid_cells[cell_lat_idx, cell_lon_idx]
+    cell_hru_idx = 0
+    # Skip dummy cells (found in non-rectangular domains)
+    if cell_id != netCDF4.default_fillvals['i4']:
+      cell_id = str(cell_id)
+      # write all cell state variables
+      cell_state = cells[cell_id].cell_state.variables
+      for variable in cell_state:
+        if cell_variables is not None and variable not in cell_variables:
+          continue
+        if variable == 'lat':
+          variable_array(variable)[cell_lat_idx] = cell_state[variable]
+        elif variable == 'lon':
+          variable_array(variable)[cell_lon_idx] = cell_state[variable]
+        else:
+          variable_array(variable)[cell_lat_idx, cell_lon_idx] = \
+            cell_state[variable]
+      for band in cells[cell_id].bands:
+        # HRUs are sorted by ascending veg_type_num in VIC state file
+        for hru_veg_type in band.hru_keys_sorted:
+          # write all HRU state variables with dimensions (lat, lon, hru)
+          hru_state = band.hrus[hru_veg_type].hru_state.variables
+          for variable in hru_state:
+            variable_array(variable)\
+              [cell_lat_idx, cell_lon_idx, cell_hru_idx] = hru_state[variable]
+          cell_hru_idx += 1
+  return state
+
+def write_state(cells, old_dataset, new_dataset, new_state_date, zlib=False,\
+  complevel=4, chunksizes=None):
   """Takes the dataset from the last VIC state file, copies its static
     metadata and writes a new state file with static metadata, new
     dynamic metadata, and the new state variable values from the CellState and
     HruState object members of each Cell object in cells.
+    Each state variable is assembled as a whole array in memory (masked, so
+    that dummy cells and unused HRU slots get the variable's fill value) and
+    written with a single call. Variables are zlib-compressed at complevel
+    if zlib is True, and chunked according to chunksizes if given, a dict of
+    chunk lengths by dimension name (dimensions not in it are not split).
   """
-  num_lats = len(old_dataset.variables['lat'])
-  num_lons = len(old_dataset.variables['lon'])
-
   new_dataset.state_year = np.int32(new_state_date.year)
   new_dataset.state_month = np.int32(new_state_date.month)
   new_dataset.state_day = np.int32(new_state_date.day)
@@ -158,39 +564,52 @@ def write_state(cells, old_dataset, new_dataset, new_state_date):
   # Copy dimensions
   for d_name, dim in old_dataset.dimensions.items():
     if d_name == 'hru': # need to update HRU dimension because it can change
-      max_num_hrus = max(sum([band.num_hrus for band in cell.bands]) for cell_id, cell in cells.items())
-      new_dataset.createDimension(d_name, max_num_hrus)
+      new_dataset.createDimension(d_name, max_num_hrus(cells))
     else:
       new_dataset.createDimension(d_name, len(dim) if not dim.isunlimited() else None)
   # Copy variables
   for v_name, var in old_dataset.variables.items():
-    new_var = new_dataset.createVariable(v_name, var.datatype, var.dimensions)
+    var_attrs = {k: var.getncattr(k) for k in var.ncattrs()}
+    # The fill value can only be set on creation
+    fill_value = var_attrs.pop('_FillValue', None)
+    if chunksizes:
+      var_chunksizes = [min(chunksizes.get(d, len(new_dataset.dimensions[d])),\
+        max(len(new_dataset.dimensions[d]), 1)) for d in var.dimensions]
+    else:
+      var_chunksizes = None
+    new_var = new_dataset.createVariable(v_name, var.datatype, var.dimensions,\
+      zlib=zlib, complevel=complevel, chunksizes=var_chunksizes,\
+      fill_value=fill_value)
     # Copy variable attributes
-    new_var.setncatts({k: var.getncattr(k) for k in var.ncattrs()})
+    new_var.setncatts(var_attrs)
 
-  state = new_dataset.variables
-  for cell_idx in range(0, num_lats*num_lons):
-    cell_lat_idx, cell_lon_idx = np.unravel_index(cell_idx, (num_lats, num_lons))
-    cell_id = old_dataset.variables['GRID_CELL'][cell_lat_idx][cell_lon_idx]
-    cell_hru_idx = 0
-    # Skip dummy cells (found in non-rectangular domains)
-    if cell_id != netCDF4.default_fillvals['i4']:
-      cell_id = str(cell_id)
-      # write all cell state variables
-      for variable in cells[cell_id].cell_state.variables:
-        if variable == 'lat':
-          state[variable][cell_lat_idx] = cells[cell_id].cell_state.variables[variable]
-        elif variable == 'lon':
-          state[variable][cell_lon_idx] = cells[cell_id].cell_state.variables[variable]
-        else:
-          # print('writing CellState variable {} for cell {} (value = {})').format(variable, cell_id, cells[cell_id].cell_state.variables[variable])
-          state[variable][cell_lat_idx, cell_lon_idx] = \
-            cells[cell_id].cell_state.variables[variable]
-      for band in cells[cell_id].bands:
-        # HRUs are sorted by ascending veg_type_num in VIC state file
-        for hru_veg_type in band.hru_keys_sorted:
-          # write all HRU state variables with dimensions (lat, lon, hru)
-          for variable in band.hrus[hru_veg_type].hru_state.variables:
-            state[variable][cell_lat_idx, cell_lon_idx, cell_hru_idx] = \
-              band.hrus[hru_veg_type].hru_state.variables[variable]
-          cell_hru_idx += 1
+  state = _assemble_state(cells, old_dataset.variables['GRID_CELL'][:],
+                          new_dataset)
+  for variable, values in state.items():
+    new_dataset.variables[variable][:] = values
+
+def update_state(cells, dataset, new_state_date):
+  """Writes the new state date and the new state variable values from the
+    CellState and HruState object members of each Cell object in cells into
+    a VIC state file dataset opened for modification (the last VIC state
+    file, or a copy of it), leaving its metadata and the storage of its
+    variables as they are. Only the variables the conductor modifies are
+    written: the HRU state variables and VEG_TYPE_NUM (the other cell state
+    variables are never modified, so they are left as they are). The hru
+    dimension of dataset must already have the length max_num_hrus(cells).
+  """
+  num_hrus = max_num_hrus(cells)
+  if len(dataset.dimensions['hru']) != num_hrus:
+    raise Exception(
+      'update_state: Error: The hru dimension of the VIC state file has '
+      'length {}, but the cells have up to {} HRUs.'
+      .format(len(dataset.dimensions['hru']), num_hrus))
+
+  dataset.state_year = np.int32(new_state_date.year)
+  dataset.state_month = np.int32(new_state_date.month)
+  dataset.state_day = np.int32(new_state_date.day)
+
+  state = _assemble_state(cells, dataset.variables['GRID_CELL'][:], dataset,
+                          cell_variables=['VEG_TYPE_NUM'])
+  for variable, values in state.items():
+    dataset.variables[variable][:] = values
@@ -0,0 +1,54 @@
+"""grids.py
+
+  This module provides helpers for working with the large 2D grids of the
+  hydro-conductor (the DEMs, the glacier mask and the mass balance grid) in
+  bounded memory: grids can be held in np.memmap files on disk instead of in
+  RAM, and processed in tiles of whole rows, so that temporaries only ever
+  span one tile.
+"""
+
+__all__ = ['TILE_PIXELS', 'row_tiles', 'pixel_tiles', 'new_grid',
+           'memmap_grid']
+
+import os
+
+import numpy as np
+
+# Default number of pixels per tile
+TILE_PIXELS = 2**22
+
+def row_tiles(num_rows, num_cols, tile_pixels=TILE_PIXELS):
+  """ Yields slices over the rows of a num_rows x num_cols grid, each
+    spanning as many whole rows as fit in tile_pixels (at least one)
+  """
+  tile_rows = max(1, tile_pixels // max(num_cols, 1))
+  for first_row in range(0, num_rows, tile_rows):
+    yield slice(first_row, min(first_row + tile_rows, num_rows))
+
+def pixel_tiles(num_pixels, tile_pixels=TILE_PIXELS):
+  """ Yields slices over num_pixels pixels, tile_pixels at a time """
+  for first_pixel in range(0, num_pixels, tile_pixels):
+    yield slice(first_pixel, min(first_pixel + tile_pixels, num_pixels))
+
+def new_grid(shape, dtype=float, filename=None):
+  """ Returns a new zero-filled grid, held in RAM, or in a np.memmap backed
+    by filename (which is created or overwritten) if given
+  """
+  if filename is None:
+    return np.zeros(shape, dtype=dtype)
+  os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok=True)
+  # (a newly created memmap file reads as zeros)
+  return np.memmap(filename, dtype=dtype, mode='w+', shape=shape)
+
+def memmap_grid(grid, filename, dtype=None, tile_pixels=TILE_PIXELS):
+  """ Returns a copy of a 2D grid in a np.memmap backed by filename (which is
+    created or overwritten), copied over in row tiles. Masked values of a
+    masked grid are copied as their underlying data.
+  """
+  num_rows, num_cols = np.shape(grid)
+  memmap = new_grid((num_rows, num_cols), dtype or np.ma.getdata(grid).dtype,
+                    filename)
+  for rows in row_tiles(num_rows, num_cols, tile_pixels):
+    memmap[rows] = np.ma.getdata(grid[rows])
+  memmap.flush()
+  return memmap
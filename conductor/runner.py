@@ -0,0 +1,167 @@
+"""runner.py
+
+  This module runs the models coupled by the hydro-conductor (VIC and the
+  RGM) as asyncio subprocesses: their stdout and stderr are streamed into the
+  log line by line as they are written, each run can be given a timeout, and
+  the wall time, CPU time and peak resident set size of each run are
+  recorded. Other work of the conductor can be done in threads while a model
+  runs.
+"""
+
+__all__ = ['ModelRunError', 'ModelRunStats', 'run_model_async', 'run_model']
+
+import asyncio
+from collections import namedtuple
+import logging
+import sys
+import time
+
+try:
+  import resource
+except ImportError:
+  # (not available on Windows)
+  resource = None
+
+# Longest line of model output read in one go
+MAX_LINE_LENGTH = 2**20
+# Seconds for which the output of a model is still logged after it exits
+# (its pipes may be held open by processes it left running)
+DRAIN_TIMEOUT = 10
+
+class ModelRunError(Exception):
+  """ Raised when a model run fails or times out """
+  pass
+
+ModelRunStats = namedtuple('ModelRunStats', ['name', 'returncode',\
+  'wall_time', 'cpu_time', 'peak_rss'])
+ModelRunStats.__doc__ = """ Statistics of a model run: wall and CPU (user +
+  system) times in seconds, and peak resident set size in bytes (None where
+  it cannot be determined) """
+
+def _children_usage():
+  """ Returns the CPU time used by the terminated child processes so far, and
+    the largest peak RSS (in bytes) among them
+  """
+  if resource is None:
+    return 0.0, 0
+  usage = resource.getrusage(resource.RUSAGE_CHILDREN)
+  # (ru_maxrss is in bytes on macOS, and in kilobytes elsewhere)
+  max_rss = usage.ru_maxrss * (1 if sys.platform == 'darwin' else 1024)
+  return usage.ru_utime + usage.ru_stime, max_rss
+
+def _peak_rss(pid):
+  """ Returns the peak resident set size of running process pid in bytes, or
+    None where it cannot be read (from /proc, i.e. outside Linux)
+  """
+  try:
+    with open('/proc/{}/status'.format(pid)) as f:
+      for line in f:
+        if line.startswith('VmHWM:'):
+          return int(line.split()[1]) * 1024
+  except (OSError, ValueError, IndexError):
+    pass
+  return None
+
+async def _log_lines(stream, name, stream_name):
+  """ Logs each line read from stream as soon as it is read """
+  while True:
+    line = await stream.readline()
+    if not line:
+      return
+    logging.info('%s %s: %s', name, stream_name,\
+      line.decode(errors='replace').rstrip())
+
+async def _sample_peak_rss(pid, peak, poll_interval):
+  """ Keeps peak[0] up to date with the peak RSS of process pid """
+  while True:
+    rss = _peak_rss(pid)
+    if rss is not None:
+      peak[0] = max(peak[0] or 0, rss)
+    await asyncio.sleep(poll_interval)
+
+async def _wait_exit(process, poll_interval=0.01):
+  """ Waits for process to exit. Unlike process.wait() (before Python 3.12),
+    does not also wait for the process's pipes to be closed.
+  """
+  while process.returncode is None:
+    await asyncio.sleep(poll_interval)
+
+async def run_model_async(name, args, timeout=None, poll_interval=0.5,\
+  drain_timeout=DRAIN_TIMEOUT):
+  """ Runs the model command line args (a list), logging its output, and
+    returns its ModelRunStats. Raises ModelRunError if the model exits with
+    a non-zero status, or is still running after timeout seconds (in which
+    case it is killed). The model is killed as well if the run is cancelled
+    (e.g. on KeyboardInterrupt). Output left in its pipes is logged for at
+    most drain_timeout seconds after it exits.
+  """
+  logging.info('Running %s: %s', name, ' '.join(args))
+  cpu_start, max_rss_start = _children_usage()
+  wall_start = time.perf_counter()
+  try:
+    process = await asyncio.create_subprocess_exec(*args,\
+      stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE,\
+      limit=MAX_LINE_LENGTH)
+  except OSError as e:
+    raise ModelRunError('{} could not be started: {}'.format(name, e))
+  peak = [None]
+  sampler = asyncio.ensure_future(_sample_peak_rss(process.pid, peak,\
+    poll_interval))
+  streams = asyncio.gather(_log_lines(process.stdout, name, 'stdout'),\
+    _log_lines(process.stderr, name, 'stderr'))
+  try:
+    await asyncio.wait_for(_wait_exit(process), timeout)
+  except asyncio.TimeoutError:
+    raise ModelRunError('{} did not finish within {} s and was killed'\
+      .format(name, timeout))
+  finally:
+    sampler.cancel()
+    # (on a timeout, or if the run was cancelled)
+    if process.returncode is None:
+      try:
+        process.kill()
+      except ProcessLookupError:
+        pass
+      await _wait_exit(process)
+    # (the output still buffered in the pipes is logged before returning)
+    try:
+      await asyncio.wait_for(streams, drain_timeout)
+    except asyncio.TimeoutError:
+      logging.warning('%s output still open %s s after it exited, no longer '
+        'logged', name, drain_timeout)
+      # (closes the pipes, which asyncio offers no public way to do)
+      process._transport.close()
+  cpu_end, max_rss_end = _children_usage()
+  if max_rss_end > max_rss_start:
+    # This run's peak exceeds that of all children before it (and covers
+    # runs too short to be sampled)
+    peak[0] = max(peak[0] or 0, max_rss_end)
+  stats = ModelRunStats(name, process.returncode,\
+    time.perf_counter() - wall_start, cpu_end - cpu_start, peak[0])
+  logging.info('%s finished with status %s in %.1f s (%.1f s CPU, peak RSS '
+    '%s MB)', name, stats.returncode, stats.wall_time, stats.cpu_time,\
+    '?' if stats.peak_rss is None else '{:.0f}'.format(stats.peak_rss / 2**20))
+  if process.returncode != 0:
+    raise ModelRunError('{} exited with status {}'.format(name,\
+      process.returncode))
+  return stats
+
+def run_model(name, args, timeout=None, concurrent_tasks=()):
+  """ Runs the model command line args as run_model_async() does, while
+    running each of concurrent_tasks (callables taking no arguments) in a
+    thread. Returns the ModelRunStats of the run once both the model and the
+    tasks are done; an exception raised by a task is re-raised then.
+  """
+  async def run():
+    loop = asyncio.get_running_loop()
+    tasks = [ loop.run_in_executor(None, task) for task in concurrent_tasks ]
+    try:
+      stats = await run_model_async(name, args, timeout)
+    finally:
+      # (tasks can't be cancelled once started, so are always waited for)
+      results = await asyncio.gather(*tasks, return_exceptions=True)
+    for result in results:
+      if isinstance(result, BaseException):
+        raise result
+    return stats
+  return asyncio.run(run())
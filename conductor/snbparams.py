@@ -9,10 +9,11 @@
   N should be equal to num_snow_bands
 """
 
-__all__ = ['load_snb_parms', 'save_snb_parms']
+__all__ = ['load_snb_parms', 'format_snb_parms', 'save_snb_parms']
 
 from collections import OrderedDict
-import csv
+
+import numpy as np
 
 from conductor.cells import Band, HydroResponseUnit
 
@@ -85,26 +86,68 @@ def load_snb_parms(snb_file, num_snow_bands):
       cells[cell_id] = cell
   return cells
 
-def save_snb_parms(cells, filename):
+def _format_snb_lines(cells, cell_ids):
+  """ Returns the Snow Band Parameter File line of each of cell_ids, formatted
+    as csv.writer would. The HRU area fractions of all bands are gathered in
+    one pass and summed per band at once (np.bincount adds them in the same
+    order as Band.area_frac does), then formatted as one column.
+  """
+  cell_num_bands = []
+  band_num_hrus = []
+  median_elevs = []
+  hru_area_fracs = []
+  for cell_id in cell_ids:
+    bands = cells[cell_id].bands
+    cell_num_bands.append(len(bands))
+    for band in bands:
+      band_num_hrus.append(len(band.hrus))
+      # Bands without HRUs are placeholders, written with an elevation of 0
+      if band.hrus:
+        median_elevs.append(band.median_elev)
+        hru_area_fracs.extend([hru.area_frac for hru in band.hrus.values()])
+      else:
+        median_elevs.append(0)
+  num_bands = len(band_num_hrus)
+  area_fracs = np.bincount(np.repeat(np.arange(num_bands), band_num_hrus),\
+    weights=np.array(hru_area_fracs, dtype=float), minlength=num_bands)
+  area_fracs = list(map(repr, area_fracs.tolist()))
+  # (and an area fraction of 0, as an int like Band.area_frac returns)
+  for band_idx in np.flatnonzero(np.array(band_num_hrus) == 0).tolist():
+    area_fracs[band_idx] = '0'
+  # Elevations are ints as read in, or floats once binned from the DEM
+  median_elevs = list(map(str, median_elevs))
+
+  lines = []
+  first_band = 0
+  for cell_id, num_cell_bands in zip(cell_ids, cell_num_bands):
+    bands = slice(first_band, first_band + num_cell_bands)
+    # Hack to introduce Pfactors: a 1 per band
+    lines.append(' '.join([cell_id] + area_fracs[bands] + median_elevs[bands]\
+      + ['1'] * num_cell_bands) + '\r\n')
+    first_band += num_cell_bands
+  return lines
+
+def format_snb_parms(cells, line_cache=None, dirty_cells=None):
+  """ Returns the contents of the Snow Band Parameter File for cells. If a
+    line_cache dict is given, the formatted line of each cell is kept in it,
+    and reused for cells not in dirty_cells (when that is given).
+  """
+  if line_cache is not None and dirty_cells is not None:
+    dirty_cells = set(dirty_cells)
+    stale_cells = [ cell_id for cell_id in cells\
+      if cell_id in dirty_cells or cell_id not in line_cache ]
+  else:
+    stale_cells = list(cells)
+  lines = _format_snb_lines(cells, stale_cells)
+  if line_cache is not None:
+    line_cache.update(zip(stale_cells, lines))
+    lines = [ line_cache[cell_id] for cell_id in cells ]
+  return ''.join(lines)
+
+def save_snb_parms(cells, filename, line_cache=None, dirty_cells=None):
   """ Assembles and writes updated snow band parameters to a new temporary
     Snow Band Parameter File for feeding back into VIC in the next iteration.
+    The line_cache and dirty_cells are as for format_snb_parms().
   """
   with open(filename, 'w') as f:
-    writer = csv.writer(f, delimiter=' ')
-    for cell_id, cell in cells.items():
-      area_fracs = []
-      elevations = []
-      for band in cell.bands:
-        area_fracs.append(band.area_frac)
-        # only write out elevations for Bands that contain HRUs
-        # (including shadow glaciers). Otherwise, they are placeholders and
-        # a 0 should be written)
-        if band.num_hrus > 0:
-          elevations.append(band.median_elev)
-        else:
-          elevations.append(0)
-      # line = [cell_id] + area_fracs + elevations
-      # Hack to introduce Pfactors:
-      line = [cell_id] + area_fracs + elevations + [1]*cell.num_bands
-
-      writer.writerow(line)
+    f.write(format_snb_parms(cells, line_cache, dirty_cells))
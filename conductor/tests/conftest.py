@@ -51,6 +51,7 @@
 import io
 from pkg_resources import resource_stream, resource_filename
 import numpy as np
+import netCDF4
 
 import pytest
 
@@ -142,13 +143,14 @@ def large_merge_cells_unit_test_parms():
   fname = resource_filename('conductor', 'tests/input/snow_band.txt')
   elevation_cells = load_snb_parms(fname, 15)
   fname = resource_filename('conductor', 'tests/input/veg.txt')
-  hru_cells = load_veg_parms(fname)
+  hru_store = HruStateStore()
+  hru_cells = load_veg_parms(fname, hru_store)
   expected_zs = [ 2076, 2159, 2264, 2354, 2451, 2550, 2620, 2714, 2802, 2900,\
     3000, 3100, 3200, 3300, 3400 ]
   expected_afs = { 0.000765462339, 0.000873527611, 0.009125511809,\
     0.009314626034, 0.004426673711, 0.004558753487, 0.001388838859, 0.000737445417 }
 
-  return elevation_cells, hru_cells, expected_zs, expected_afs
+  return elevation_cells, hru_cells, hru_store, expected_zs, expected_afs
 
 @pytest.fixture(scope="function")
 def toy_domain_64px_cells():
@@ -164,8 +166,9 @@ def toy_domain_64px_cells():
   fname = resource_filename('conductor', 'tests/input/snb_toy_64px.txt')
   elevation_cells = load_snb_parms(fname, 5)
   fname = resource_filename('conductor', 'tests/input/vpf_toy_64px.txt')
-  hru_cells = load_veg_parms(fname)
-  cells = merge_cell_input(hru_cells, elevation_cells)
+  hru_store = HruStateStore()
+  hru_cells = load_veg_parms(fname, hru_store)
+  cells = merge_cell_input(hru_cells, elevation_cells, hru_store)
   cell_ids = list(cells.keys())
   # We have a total allowable number of snow bands of 5, with 100m spacing
   num_snow_bands = 5
@@ -398,3 +401,63 @@ def toy_domain_64px_rgm_vic_map_file_readout(toy_domain_64px_cells):
 # @pytest.fixture(scope="function")
 # def toy_domain_64px_state():
 #   fname = resource_filename('conductor', 'tests/input/vic_state_test_file.nc')
+
+@pytest.fixture(scope="function")
+def toy_domain_64px_state_file(tmpdir, toy_domain_64px_cells):
+  """ Writes a VIC state file for the two toy domain cells (plus a dummy
+    cell, as found in non-rectangular domains) with distinct pseudo-random
+    values for all state variables, and returns its file name
+  """
+  cells = toy_domain_64px_cells[0]
+  cell_ids = list(cells.keys())
+  num_hrus = max(sum(band.num_hrus for band in cell.bands)\
+    for cell in cells.values())
+  fname = str(tmpdir.join('vic_state_toy_64px.nc'))
+  random = np.random.RandomState(42)
+
+  with netCDF4.Dataset(fname, 'w') as state:
+    state.state_year = np.int32(2000)
+    state.state_month = np.int32(10)
+    state.state_day = np.int32(1)
+    state.title = 'toy domain state'
+    dims = [('lat', 1), ('lon', 3), ('hru', num_hrus + 1),\
+      ('nnodes', Cell.Nnodes), ('dist', Cell.dist), ('nlayer', Cell.Nlayers),\
+      ('glac_mass_balance_info', Cell.NglacMassBalanceEqnTerms + 1)]
+    for name, size in dims:
+      state.createDimension(name, size)
+    state.createVariable('lat', 'f8', ('lat',))[:] = [50.0]
+    state.createVariable('lon', 'f8', ('lon',))[:] = [-116.5, -116.0, -115.5]
+    grid_cell = state.createVariable('GRID_CELL', 'i4', ('lat', 'lon'))
+    grid_cell.long_name = 'grid cell ID'
+    grid_cell[:] = [[int(cell_ids[0]), int(cell_ids[1]),\
+      netCDF4.default_fillvals['i4']]]
+    cell_dims = {
+      'NUM_BANDS': ('i4', ()),
+      'SOIL_DZ_NODE': ('f8', ('nnodes',)),
+      'SOIL_ZSUM_NODE': ('f8', ('nnodes',)),
+      'VEG_TYPE_NUM': ('i4', ()),
+      'GLAC_MASS_BALANCE_EQN_TERMS': ('f8', ('glac_mass_balance_info',))
+    }
+    hru_dims = {
+      'LAYER_ICE_CONTENT': ('dist', 'nlayer'),
+      'LAYER_MOIST': ('dist', 'nlayer'),
+      'HRU_VEG_VAR_WDEW': ('dist',),
+      'ENERGY_T': ('nnodes',),
+      'ENERGY_T_FBCOUNT': ('nnodes',)
+    }
+    variables = [(v, cell_dims[v][0], ('lat', 'lon') + cell_dims[v][1])\
+      for v in cell_dims]
+    for v in HruState(0, 0, HruStateStore()).variables:
+      dtype = 'i4' if v.endswith(('_INDEX', '_FBCOUNT', '_FBFLAG'))\
+        or v in ('SNOW_LAST_SNOW', 'SNOW_MELTING') else 'f8'
+      variables.append((v, dtype, ('lat', 'lon', 'hru') + hru_dims.get(v, ())))
+    for v, dtype, var_dims in variables:
+      var = state.createVariable(v, dtype, var_dims)
+      var.units = '-'
+      shape = [len(state.dimensions[d]) for d in var_dims]
+      if dtype == 'i4':
+        var[:] = random.randint(0, 100, shape)
+      else:
+        var[:] = random.uniform(-10, 10, shape)
+
+  return fname
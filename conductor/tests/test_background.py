@@ -0,0 +1,97 @@
+''' This is a set of tests for the background.py module.
+'''
+
+from functools import partial
+import os
+import sys
+import threading
+
+import pytest
+
+from conductor.background import BackgroundWorker
+
+@pytest.mark.parametrize('max_pending', [0, 1, 3])
+def test_background_worker_order(max_pending):
+  done = []
+  worker = BackgroundWorker(max_pending)
+  for i in range(10):
+    worker.submit(done.append, i)
+  worker.flush()
+  assert done == list(range(10))
+  worker.submit(done.append, 10)
+  worker.shutdown()
+  worker.shutdown()
+  assert done == list(range(11))
+
+def test_background_worker_bounded_queue():
+  release = threading.Event()
+  worker = BackgroundWorker(1)
+  # One task running and one queued fill it up
+  worker.submit(release.wait)
+  worker.submit(release.wait)
+  submitter = threading.Thread(target=worker.submit, args=(release.wait,))
+  submitter.start()
+  submitter.join(0.2)
+  assert submitter.is_alive()
+  release.set()
+  submitter.join()
+  worker.shutdown()
+
+def test_background_worker_error():
+  def fail():
+    raise IOError('disk full')
+  release = threading.Event()
+  done = []
+  worker = BackgroundWorker(3)
+  worker.submit(release.wait)
+  worker.submit(fail)
+  worker.submit(done.append, 1)
+  release.set()
+  with pytest.raises(IOError):
+    worker.flush()
+  # Tasks queued after the failed one were dropped
+  assert done == []
+  worker.submit(done.append, 2)
+  worker.shutdown()
+  assert done == [2]
+
+def test_background_worker_error_unnamed_task(tmpdir):
+  class Fail(object):
+    def __call__(self):
+      raise ValueError('bad value')
+  done = []
+  worker = BackgroundWorker(1)
+  # Neither a partial nor a callable object has a __name__
+  worker.submit(partial(os.remove, str(tmpdir.join('missing.txt'))))
+  with pytest.raises(OSError):
+    worker.flush()
+  worker.submit(Fail())
+  with pytest.raises(ValueError):
+    worker.flush()
+  # The background thread survived both failures
+  worker.submit(done.append, 1)
+  worker.shutdown()
+  assert done == [1]
+
+def test_background_worker_base_exception():
+  errors = []
+  def flush():
+    try:
+      worker.flush()
+    except SystemExit as e:
+      errors.append(e)
+  done = []
+  worker = BackgroundWorker(1)
+  worker.submit(sys.exit, 3)
+  worker.submit(done.append, 1)
+  # (flushed in a thread, which would be left waiting if the worker's
+  # thread had ended)
+  flusher = threading.Thread(target=flush, daemon=True)
+  flusher.start()
+  flusher.join(5)
+  assert not flusher.is_alive()
+  assert [e.code for e in errors] == [3]
+  assert done == []
+  worker.submit(done.append, 2)
+  worker.shutdown()
+  assert done == [2]
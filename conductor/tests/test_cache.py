@@ -0,0 +1,123 @@
+''' This is a set of tests for the cache.py module.
+  See conftest.py for details on the test fixtures used.
+'''
+
+from functools import partial
+import os
+
+import numpy as np
+
+from pkg_resources import resource_filename
+
+from conductor.cache import load_cached, ReusingTextWriter
+from conductor.file_io import get_rgm_pixel_mapping
+
+def test_load_cached_pixel_map(tmpdir):
+  fname = resource_filename(\
+    'conductor', 'tests/input/rgm_vic_map_toy_64px_auto.txt')
+  cache_dir = str(tmpdir.join('input_cache'))
+  calls = []
+  def loader(f):
+    calls.append(f)
+    return get_rgm_pixel_mapping(f)
+
+  expected = get_rgm_pixel_mapping(fname)
+  for _ in range(2):
+    vic_cell_mask, cell_areas, nx, ny = load_cached(fname, loader, cache_dir,\
+      'pixel_map')
+    assert np.array_equal(np.ma.getmaskarray(vic_cell_mask),\
+      np.ma.getmaskarray(expected[0]))
+    assert np.array_equal(vic_cell_mask.compressed(), expected[0].compressed())
+    assert list(cell_areas.items()) == list(expected[1].items())
+    assert (nx, ny) == expected[2:]
+  # The second load came from the cache
+  assert len(calls) == 1
+
+def test_load_cached_invalidation(tmpdir):
+  fname = str(tmpdir.join('grid.txt'))
+  cache_dir = str(tmpdir.join('input_cache'))
+  calls = []
+  def loader(f):
+    calls.append(f)
+    return np.loadtxt(f)
+
+  with open(fname, 'w') as f:
+    f.write('1 2\n3 4\n')
+  grid = load_cached(fname, loader, cache_dir, 'grid')
+  assert np.array_equal(grid, [[1, 2], [3, 4]])
+
+  # Touching the file without changing it is caught by the content hash
+  stat = os.stat(fname)
+  os.utime(fname, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10**9))
+  grid = load_cached(fname, loader, cache_dir, 'grid')
+  assert len(calls) == 1
+
+  # Same size, different contents
+  with open(fname, 'w') as f:
+    f.write('5 6\n7 8\n')
+  os.utime(fname, ns=(stat.st_atime_ns, stat.st_mtime_ns + 2 * 10**9))
+  grid = load_cached(fname, loader, cache_dir, 'grid')
+  assert np.array_equal(grid, [[5, 6], [7, 8]])
+  assert len(calls) == 2
+
+  # Different size
+  with open(fname, 'w') as f:
+    f.write('5 6 7\n7 8 9\n')
+  grid = load_cached(fname, loader, cache_dir, 'grid')
+  assert np.array_equal(grid, [[5, 6, 7], [7, 8, 9]])
+  assert len(calls) == 3
+
+def test_load_cached_loader_key(tmpdir):
+  fname = str(tmpdir.join('grid.txt'))
+  cache_dir = str(tmpdir.join('input_cache'))
+  with open(fname, 'w') as f:
+    f.write('1 2\n3 4\n')
+  calls = []
+  def loader(f, scale=1):
+    calls.append(f)
+    return np.loadtxt(f) * scale
+  def other_loader(f):
+    calls.append(f)
+    return np.loadtxt(f) + 1
+
+  assert np.array_equal(load_cached(fname, loader, cache_dir, 'grid'),\
+    [[1, 2], [3, 4]])
+  assert len(calls) == 1
+  # Another loader under the same name doesn't get the same entry
+  assert np.array_equal(load_cached(fname, other_loader, cache_dir, 'grid'),\
+    [[2, 3], [4, 5]])
+  assert len(calls) == 2
+  # Nor does the same loader with other arguments
+  assert np.array_equal(load_cached(fname, loader, cache_dir, 'grid',\
+    scale=2), [[2, 4], [6, 8]])
+  assert np.array_equal(load_cached(fname, partial(loader, scale=3),\
+    cache_dir, 'grid'), [[3, 6], [9, 12]])
+  assert len(calls) == 4
+  # Each entry is kept, and is used again by its own loader
+  assert np.array_equal(load_cached(fname, loader, cache_dir, 'grid'),\
+    [[1, 2], [3, 4]])
+  assert np.array_equal(load_cached(fname, loader, cache_dir, 'grid',\
+    scale=2), [[2, 4], [6, 8]])
+  assert len(calls) == 4
+  # Bumping the loader's cache version invalidates its entries
+  loader.cache_version = 1
+  assert np.array_equal(load_cached(fname, loader, cache_dir, 'grid'),\
+    [[1, 2], [3, 4]])
+  assert len(calls) == 5
+
+def test_reusing_text_writer(tmpdir):
+  names = [ str(tmpdir.join('vpf_{}.txt'.format(year))) for year in range(4) ]
+  writer = ReusingTextWriter()
+  assert writer.write('a b\r\n', names[0]) == names[0]
+  # Unchanged contents are referred to under the last file's name
+  assert writer.write('a b\r\n', names[1]) == names[0]
+  assert not os.path.exists(names[1])
+  assert writer.write('a c\r\n', names[2]) == names[2]
+  with open(names[2], newline='') as f:
+    assert f.read() == 'a c\r\n'
+
+  linking_writer = ReusingTextWriter(link=True)
+  linking_writer.write('a b\r\n', names[0])
+  # ... or hard-linked to the new name
+  assert linking_writer.write('a b\r\n', names[3]) == names[3]
+  assert os.path.samefile(names[0], names[3])
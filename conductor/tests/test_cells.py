@@ -2,12 +2,14 @@
   See conftest.py for details on the test fixtures used.
 '''
 
+from concurrent.futures import ProcessPoolExecutor
 from copy import deepcopy
 
 import pytest
 import mock
 
 from conductor.cells import *
+from conductor.grids import new_grid, memmap_grid
 
 GLACIER_ID = Band.glacier_id
 OPEN_GROUND_ID = Band.open_ground_id
@@ -39,7 +41,7 @@ class TestsSimpleUnit:
       test_area_fracs, test_area_fracs_by_band, test_veg_types \
       = simple_unit_test_parms
 
-    elevation_cells, hru_cells, expected_zs, expected_afs \
+    elevation_cells, hru_cells, hru_store, expected_zs, expected_afs \
       = large_merge_cells_unit_test_parms
 
     def test_band_simple(self):
@@ -55,7 +57,7 @@ class TestsSimpleUnit:
 
     def test_hru_simple(self):
       my_hru = HydroResponseUnit(test_area_fracs_simple[0],\
-        expected_root_zone_parms['22'],0,22)
+        expected_root_zone_parms['22'],0,22,HruStateStore())
 
       assert my_hru.area_frac == test_area_fracs_simple[0]
       assert my_hru.root_zone_parms == expected_root_zone_parms['22']
@@ -64,9 +66,11 @@ class TestsSimpleUnit:
       my_band = Band(test_median_elevs_simple[0])
 
       # Create and populate three HRUs in this Band...
+      store = HruStateStore()
       for veg_type, area_frac, root_zone in zip(test_veg_types,\
         test_area_fracs_simple, expected_root_zone_parms):
-          my_band.hrus[veg_type] = HydroResponseUnit(area_frac, root_zone, 0, veg_type)
+          my_band.hrus[veg_type] = HydroResponseUnit(area_frac, root_zone, 0, veg_type,\
+            store)
 
       assert my_band.median_elev == test_median_elevs_simple[0]
       assert my_band.area_frac == sum(test_area_fracs_simple[0:3])
@@ -83,7 +87,7 @@ class TestsSimpleUnit:
     # Load up data from large sample vegetation and snow band parameters files
     # and test a few pieces of the cells created
     def test_merge_cell_input(self):
-      cells = merge_cell_input(hru_cells, elevation_cells)
+      cells = merge_cell_input(hru_cells, elevation_cells, hru_store)
       assert len(cells) == 6
       assert len(cells['369560'].bands) == 15
       zs = [ band.median_elev for band in cells['368470'].bands ]
@@ -194,7 +198,8 @@ class TestsDynamic:
       # Confirm that there are (temporarily) no HRUs in this band
       assert cells[cell_ids[0]].bands[3].num_hrus == 0
       # create new glacier HRU:
-      cells[cell_ids[0]].bands[3].create_hru(3, GLACIER_ID, new_glacier_area_frac)
+      cells[cell_ids[0]].bands[3].create_hru(3, GLACIER_ID, new_glacier_area_frac,
+        cells[cell_ids[0]].hru_store)
       # Check that there is only the one glacier HRU in this band
       assert cells[cell_ids[0]].bands[3].num_hrus == 1
       assert cells[cell_ids[0]].bands[3].hrus[22].area_frac == new_glacier_area_frac
@@ -214,7 +219,8 @@ class TestsDynamic:
       # Confirm that there are currently no HRUs in the new band         
       assert cells[cell_ids[0]].bands[4].num_hrus == 0
       # Create the corresponding new glacier HRU
-      cells[cell_ids[0]].bands[4].create_hru(4, GLACIER_ID, new_glacier_area_frac)
+      cells[cell_ids[0]].bands[4].create_hru(4, GLACIER_ID, new_glacier_area_frac,
+        cells[cell_ids[0]].hru_store)
       # Confirm that this new HRU was correctly instantiated
       assert cells[cell_ids[0]].bands[4].num_hrus == 1
       assert cells[cell_ids[0]].bands[4].hrus[22].area_frac == new_glacier_area_frac
@@ -231,6 +237,63 @@ class TestsDynamic:
     test_new_glacier_growth_into_band_and_replacing_all_open_ground(self)
     test_new_glacier_growth_into_upper_dummy_band(self)
 
+def _bin_bands_and_glaciers_per_cell(cells, vic_cell_mask, num_snow_bands,
+                                     surf_dem, glacier_mask):
+  """ Reference binning, one cell and one band at a time, as done before
+    bin_bands_and_glaciers() binned all cells in a single pass. Returns the
+    band areas, glacier areas and band median elevations of each cell.
+  """
+  band_areas = {}
+  glacier_areas = {}
+  median_elevs = {}
+  for cell_id, cell in cells.items():
+    in_cell = np.asarray(vic_cell_mask) == float(cell_id)
+    elevs = np.asarray(surf_dem)[in_cell]
+    glacier_elevs = np.asarray(surf_dem)[in_cell\
+      & (np.asarray(glacier_mask) == 1)]
+    bounds = [band.lower_bound for band in cell.bands]
+    band_areas[cell_id] = np.bincount(np.digitize(elevs, bounds) - 1,\
+      minlength=num_snow_bands).tolist()
+    glacier_areas[cell_id] = np.bincount(np.digitize(glacier_elevs,\
+      bounds) - 1, minlength=num_snow_bands).tolist()
+    median_elevs[cell_id] = []
+    for band in cell.bands:
+      band_elevs = elevs[(elevs >= band.lower_bound)\
+        & (elevs < band.upper_bound)]
+      median_elevs[cell_id].append(np.median(band_elevs) if band_elevs.size\
+        else band.lower_bound)
+  return band_areas, glacier_areas, median_elevs
+
+def test_bin_bands_and_glaciers_matches_per_cell(toy_domain_64px_cells,\
+  toy_domain_64px_rgm_vic_map_file_readout):
+  cells, cell_ids, num_snow_bands, _, cellid_map, bed_dem, surf_dem, _, _\
+    = toy_domain_64px_cells
+  _, cell_areas, num_cols_dem, num_rows_dem\
+    = toy_domain_64px_rgm_vic_map_file_readout
+  # Glacier growth in band 2 of cell '12345', and the top band of the second
+  # cell emptied by lowering its pixels into the band below
+  surf_dem = deepcopy(surf_dem)
+  surf_dem[2 + 5][2 + 2 : 2 + 4] = [2230, 2240]
+  top_band = cells[cell_ids[1]].bands[-1]
+  second_cell = np.asarray(cellid_map) == float(cell_ids[1])
+  in_top_band = second_cell & (surf_dem >= top_band.lower_bound)
+  surf_dem[in_top_band] = top_band.lower_bound - 1
+  glacier_mask = update_glacier_mask(surf_dem, bed_dem, num_rows_dem,\
+    num_cols_dem, glacier_thickness_threshold)
+
+  expected = _bin_bands_and_glaciers_per_cell(cells, cellid_map,\
+    num_snow_bands, surf_dem, glacier_mask)
+  band_areas, glacier_areas = bin_bands_and_glaciers(cells, cell_areas,\
+    cellid_map, num_snow_bands, surf_dem, glacier_mask)
+  assert band_areas == expected[0]
+  assert glacier_areas == expected[1]
+  for cell_id, cell in cells.items():
+    assert [band.median_elev for band in cell.bands] == expected[2][cell_id]
+  # The domain exercises empty bands and glacier pixels
+  assert any(0 in areas for areas in band_areas.values())
+  assert band_areas[cell_ids[1]][-1] == 0
+  assert all(sum(areas) > 0 for areas in glacier_areas.values())
+
 def mock_update_hru_state(source_hru, dest_hru, case, **kwargs):
   """ Mock function for cells.update_hru_state(), just returns the
     state update case that was given in the case input parameter.
@@ -674,7 +737,8 @@ class TestsAreaFracUpdate:
       # glacier HRU for next incremental test 
       surf_dem[dem_padding_thickness + 0][dem_padding_thickness + 8 + 2] = 1850
       cells['23456'].bands[0].delete_hru(22)
-      cells['23456'].bands[0].create_hru(0, 19, initial_area_frac)
+      cells['23456'].bands[0].create_hru(0, 19, initial_area_frac,
+        cells['23456'].hru_store)
 
     @mock.patch('conductor.cells.update_hru_state', side_effect=mock_update_hru_state)
     def test_glacier_thickening_to_conceal_lowest_band_of_open_ground(self, mock_update_hru_state_fcn):
@@ -1199,3 +1263,538 @@ the zero padding to accommodate this.' in str(message.value)
     test_glacier_receding_entirely_from_band(self)
     test_glacier_receding_from_top_band_leaving_band_area_as_zero_2(self)
     test_glacier_concealing_entire_multi_hru_band(self)
+
+def test_cell_pixel_index(toy_domain_64px_cells,\
+  toy_domain_64px_rgm_vic_map_file_readout):
+  cells, cell_ids, _, _, cellid_map, _, surf_dem, _, _ = toy_domain_64px_cells
+  vic_cell_mask, cell_areas, _, _ = toy_domain_64px_rgm_vic_map_file_readout
+
+  pixel_index = CellPixelIndex.from_cell_mask(vic_cell_mask, cell_ids)
+  assert pixel_index.cell_ids == cell_ids
+  assert pixel_index.num_pixels == 128
+  for cell_id in cell_ids:
+    assert pixel_index.num_cell_pixels(cell_id) == cell_areas[cell_id]
+    rows, cols = np.unravel_index(pixel_index.cell_pixels(cell_id),\
+      pixel_index.shape)
+    assert np.all(cellid_map[rows, cols] == float(cell_id))
+  assert np.all(pixel_index.gather(surf_dem)[pixel_index.pixel_cells == 1]\
+    == surf_dem[cellid_map == float(cell_ids[1])])
+  assert len(pixel_index.orphan_pixel_inds) == 0
+
+  # Cells missing from cell_ids leave their pixels orphaned
+  partial_index = CellPixelIndex.from_cell_mask(vic_cell_mask, cell_ids[1:])
+  assert partial_index.num_pixels == 64
+  assert len(partial_index.orphan_pixel_inds) == 64
+
+  reversed_index = pixel_index.subset(cell_ids[::-1])
+  assert np.all(reversed_index.cell_pixels(cell_ids[0])\
+    == pixel_index.cell_pixels(cell_ids[0]))
+  assert reversed_index.num_cell_pixels('99999') == 0
+
+def test_hru_state_store():
+  store = HruStateStore(block_size=2)
+  states = [HruState(band_id, 19, store) for band_id in range(3)]
+  assert len(store) == 3 and store.capacity == 4
+  assert list(states[0].variables) == list(default_hru_state_values(0, 19))
+  assert list(store.column('HRU_BAND_INDEX')) == [0, 1, 2]
+
+  assert states[0] == HruState(0, 19, HruStateStore())
+  assert states[0] != states[1]
+
+  # Columns hold floats from the start
+  states[1].variables['SNOW_SWQ'] = 0.25
+  assert states[1].variables['SNOW_SWQ'] == 0.25
+  assert states[0].variables['SNOW_SWQ'] == 0
+  # Array values are views into the store, which stay valid as it grows
+  layer_moist = states[2].variables['LAYER_MOIST']
+  more_states = [HruState(band_id, 11, store) for band_id in range(4)]
+  assert store.capacity == 8
+  layer_moist[0][2] += 1.5
+  assert states[2].variables['LAYER_MOIST'][0][2] == 1.5
+  assert np.array_equal(more_states[3].variables['LAYER_MOIST'], [[0] * 3])
+  # Values of a new shape reshape the column, keeping the overlap
+  states[2].variables['LAYER_MOIST'] = np.array([[1.0, 2.0, 3.0, 4.0]])
+  assert store.column('LAYER_MOIST').shape == (7, 1, 4)
+  assert np.array_equal(states[2].variables['LAYER_MOIST'], [[1, 2, 3, 4]])
+  # Scalars assigned to array-valued variables are broadcast over the row
+  states[2].variables['ENERGY_T'] = [1.0, 2.0, 3.0]
+  states[0].variables['ENERGY_T'] = 0
+  assert np.array_equal(states[0].variables['ENERGY_T'], [0, 0, 0])
+  assert np.array_equal(states[2].variables['ENERGY_T'], [1, 2, 3])
+  # Rows are read and written across blocks
+  slots = [more_states[3].slot, states[0].slot, states[2].slot]
+  store.set_rows(slots, 'SNOW_DEPTH', [3.0, 1.0, 2.0])
+  assert list(store.get_rows(slots, 'SNOW_DEPTH')) == [3, 1, 2]
+  assert more_states[3].variables['SNOW_DEPTH'] == 3
+
+  # Released slots are reused, while the released state keeps its values
+  released_slot = states[1].slot
+  states[1].release()
+  assert states[1].variables['SNOW_SWQ'] == 0.25
+  new_state = HruState(4, 22, store)
+  assert new_state.slot == released_slot
+  assert new_state.variables['SNOW_SWQ'] == 0
+  assert new_state.variables['HRU_VEG_INDEX'] == 22
+  assert len(store) == 7
+
+def test_hru_state_lifetime():
+  import gc
+  import pickle
+  store = HruStateStore()
+  states = [HruState(band_id, 19, store) for band_id in range(4)]
+  states[1].variables['SNOW_SWQ'] = 0.25
+  states[1].variables['ENERGY_T'] = [1.0, 2.0, 3.0]
+  # Slots are only freed explicitly, not when states are garbage collected
+  del states[3]
+  gc.collect()
+  assert len(store) == 4 and store.free_slots == []
+  discarded = states.pop(2)
+  discarded.discard()
+  discarded.discard()
+  assert store.free_slots == [discarded.slot]
+
+  # A copy of one state holds just that state
+  state_copy = deepcopy(states[1])
+  assert state_copy == states[1]
+  assert state_copy.store is not store and len(state_copy.store) == 1
+  state_copy.variables['SNOW_SWQ'] = 0.5
+  assert states[1].variables['SNOW_SWQ'] == 0.25
+  # States copied together share one new store
+  states_copy = deepcopy(states)
+  assert states_copy == states
+  assert states_copy[0].store is states_copy[1].store
+  assert len(states_copy[0].store) == 2
+  unpickled = pickle.loads(pickle.dumps(states[1]))
+  assert unpickled == states[1] and len(unpickled.store) == 1
+  unpickled = pickle.loads(pickle.dumps(states))
+  assert unpickled == states and unpickled[0].store is unpickled[1].store
+  assert len(unpickled[0].store) == 2
+
+  # Cells copied with their HRUs share the copy of their store
+  cell = Cell([Band(2050)], store)
+  cell.bands[0].create_hru(0, Band.glacier_id, 1.0, store)
+  cell_copy = deepcopy(cell)
+  assert cell_copy.hru_store is not store and len(cell_copy.hru_store) == 1
+  assert cell_copy.bands[0].hrus[Band.glacier_id].hru_state.store\
+    is cell_copy.hru_store
+
+def test_band_delete_hru_releases_state_slot():
+  store = HruStateStore()
+  band = Band(2050)
+  band.create_hru(0, Band.glacier_id, 0.5, store)
+  band.create_hru(0, Band.open_ground_id, 0.5, store)
+  hru = band.hrus[Band.glacier_id]
+  slot = hru.hru_state.slot
+  hru.hru_state.variables['SNOW_DEPTH'] = 1.5
+  band.delete_hru(Band.glacier_id)
+  assert slot in store.free_slots
+  assert hru.hru_state.store is not store
+  assert hru.hru_state.variables['SNOW_DEPTH'] == 1.5
+
+@pytest.mark.parametrize('case', ['3', '4a', '4b', '5a', '5b', '5c', '5d'])
+def test_update_hru_states_matches_update_hru_state(case,\
+  toy_domain_64px_cells):
+  cells = toy_domain_64px_cells[0]
+  hrus = [hru for cell in cells.values() for band in cell.bands\
+    for hru in band.hrus.values()]
+  # Give every HRU distinct, partly negative or zero state values
+  rng = np.random.RandomState(int(case[0]))
+  for hru in hrus:
+    for var, value in hru.hru_state.variables.items():
+      if var not in ('HRU_BAND_INDEX', 'HRU_VEG_INDEX'):
+        hru.hru_state.variables[var] = rng.uniform(-0.5, 1.5, np.shape(value))
+    hru.hru_state.variables['SNOW_DEPTH'] *= rng.randint(2)
+  batch_cells = deepcopy(cells)
+  batch_hrus = [hru for cell in batch_cells.values()\
+    for band in cell.bands for hru in band.hrus.values()]
+
+  # Pairs include HRUs receiving state from several others, and HRUs
+  # receiving state after having given it
+  if case == '3':
+    pairs = [(i, i) for i in range(len(hrus))]
+  else:
+    pairs = [(i, (i * 3 + 1) % len(hrus)) for i in range(len(hrus))\
+      if i != (i * 3 + 1) % len(hrus)]
+  new_area_fracs = rng.uniform(0.1, 1, len(pairs))
+  area_frac_kwarg = {'3': 'new_hru_area_frac', '5c': 'new_hru_area_frac',
+    '4a': 'new_open_ground_area_frac', '5b': 'new_open_ground_area_frac'}\
+    .get(case, 'new_glacier_area_frac')
+
+  for (source, dest), new_area_frac in zip(pairs, new_area_fracs):
+    update_hru_state(hrus[source], hrus[dest], case,
+                     **{area_frac_kwarg: new_area_frac})
+  update_hru_states([batch_hrus[source] for source, _ in pairs],
+                    [batch_hrus[dest] for _, dest in pairs], case,
+                    **{area_frac_kwarg: new_area_fracs})
+
+  for hru, batch_hru in zip(hrus, batch_hrus):
+    for var, value in hru.hru_state.variables.items():
+      assert np.allclose(batch_hru.hru_state.variables[var], value,\
+        rtol=1e-12, atol=0, equal_nan=True), var
+
+def test_update_area_fracs_batches_vegetated_hrus(toy_domain_64px_cells,\
+  toy_domain_64px_rgm_vic_map_file_readout):
+  cells, cell_ids, num_snow_bands, _, cellid_map, bed_dem, surf_dem, _, _\
+    = toy_domain_64px_cells
+  _, cell_areas, num_cols_dem, num_rows_dem\
+    = toy_domain_64px_rgm_vic_map_file_readout
+  # Split the tree HRU of band 1 of the first cell in three, and give them
+  # most of its open ground, so that they shrink as the glacier grows
+  rng = np.random.RandomState(2)
+  cell = cells[cell_ids[0]]
+  band = cell.bands[1]
+  tree, open_ground = band.hrus[11], band.hrus[OPEN_GROUND_ID]
+  tree.area_frac = (tree.area_frac + open_ground.area_frac * 0.9) / 3
+  open_ground.area_frac *= 0.1
+  for veg_type in (12, 13):
+    band.hrus[veg_type] = HydroResponseUnit(tree.area_frac,\
+      tree.root_zone_parms, 1, veg_type, cell.hru_store)
+  for cell in cells.values():
+    for band in cell.bands:
+      for hru in band.hrus.values():
+        hru.hru_state.variables['SNOW_SWQ'] = rng.rand()
+        hru.hru_state.variables['LAYER_MOIST'] = rng.rand(1, Cell.Nlayers)
+  # Glacier growth in both cells
+  surf_dem = deepcopy(surf_dem)
+  surf_dem[2 + 5][2 + 1 : 2 + 4] = [2230, 2240, 2250]
+  surf_dem[2 + 6][2 + 1 : 2 + 4] = [2210, 2220, 2230]
+  surf_dem[2 + 4][2 + 8 + 3 : 2 + 8 + 5] = [2120, 2110]
+  glacier_mask = update_glacier_mask(surf_dem, bed_dem, num_rows_dem,\
+    num_cols_dem, glacier_thickness_threshold)
+
+  def update_hrus_one_by_one(source_hrus, dest_hrus, case, **kwargs):
+    (area_frac_kwarg, new_area_fracs), = kwargs.items()
+    for source_hru, dest_hru, new_area_frac in zip(source_hrus, dest_hrus,\
+      new_area_fracs):
+      update_hru_state(source_hru, dest_hru, case,\
+                       **{area_frac_kwarg: new_area_frac})
+  expected_cells = deepcopy(cells)
+  with mock.patch('conductor.cells.update_hru_states',\
+                  side_effect=update_hrus_one_by_one) as batched:
+    update_area_fracs(expected_cells, cell_areas, cellid_map, num_snow_bands,\
+      surf_dem, glacier_mask)
+  assert any(len(args[0]) > 1 for args, _ in batched.call_args_list)
+  update_area_fracs(cells, cell_areas, cellid_map, num_snow_bands,\
+    surf_dem, glacier_mask)
+  assert cells == expected_cells
+
+@pytest.mark.parametrize('case', ['5a', '5b'])
+def test_update_area_fracs_vanished_top_band(toy_domain_64px_cells,\
+  toy_domain_64px_rgm_vic_map_file_readout, case):
+  """ Band 3 of cell '12345' is made all glacier and band 2 below it all open
+    ground (or all trees), without any glacier HRU (or open ground HRU).
+    Once the glacier of band 3 sinks into band 2 (staying glacier, or not),
+    CASE 5a (or 5b) creates the glacier (or open ground) HRU of band 2 with
+    its new area fraction, which leaves band 2 as binned: like the original
+    band by band loop, update_area_fracs() must then not update band 2.
+  """
+  cells, _, num_snow_bands, _, cellid_map, bed_dem, surf_dem, _, _\
+    = toy_domain_64px_cells
+  _, cell_areas, num_cols_dem, num_rows_dem\
+    = toy_domain_64px_rgm_vic_map_file_readout
+  cells, bed_dem, surf_dem = deepcopy((cells, bed_dem, surf_dem))
+  cell = cells['12345']
+  for row in range(2 + 1, 2 + 7):
+    for col in range(2 + 1, 2 + 7):
+      if 2200 <= surf_dem[row][col] < 2300:
+        bed_dem[row][col] = surf_dem[row][col]
+  bed_dem[2 + 3][2 + 3 : 2 + 5] = [2200, 2200]
+  bed_dem[2 + 4][2 + 3 : 2 + 5] = [2200, 2200]
+  band_2, band_3 = cell.bands[2], cell.bands[3]
+  band_2.delete_hru(GLACIER_ID)
+  if case == '5b':
+    band_2.delete_hru(OPEN_GROUND_ID)
+    band_2.hrus[11] = HydroResponseUnit(12/64,\
+      cell.bands[1].hrus[11].root_zone_parms, 2, 11, cell.hru_store)
+  else:
+    band_2.hrus[OPEN_GROUND_ID].area_frac = 12/64
+  band_3.delete_hru(OPEN_GROUND_ID)
+  band_3.create_hru(3, GLACIER_ID, 4/64, cell.hru_store)
+  glacier_mask = update_glacier_mask(surf_dem, bed_dem, num_rows_dem,\
+    num_cols_dem, glacier_thickness_threshold)
+  band_areas, glacier_areas = bin_bands_and_glaciers(cells, cell_areas,\
+    cellid_map, num_snow_bands, surf_dem, glacier_mask)
+  assert not np.any(compute_new_area_fracs(cells, cell_areas, band_areas,\
+    glacier_areas)[2])
+
+  surf_dem[2 + 3][2 + 3 : 2 + 5] = [2250, 2260]
+  surf_dem[2 + 4][2 + 3 : 2 + 5] = [2270, 2280]
+  if case == '5b':
+    bed_dem[2 + 3][2 + 3 : 2 + 5] = [2250, 2260]
+    bed_dem[2 + 4][2 + 3 : 2 + 5] = [2270, 2280]
+  glacier_mask = update_glacier_mask(surf_dem, bed_dem, num_rows_dem,\
+    num_cols_dem, glacier_thickness_threshold)
+  with mock.patch('conductor.cells.update_band_state',\
+                  side_effect=update_band_state) as band_update,\
+       mock.patch('conductor.cells.update_hru_state',\
+                  side_effect=update_hru_state) as hru_update:
+    update_area_fracs(cells, cell_areas, cellid_map, num_snow_bands,\
+      surf_dem, glacier_mask)
+  assert [args[2] for args, _ in band_update.call_args_list] == [3]
+  assert [args[2] for args, _ in hru_update.call_args_list] == [case]
+  assert band_3.area_frac == 0
+  assert band_2.area_frac == 16/64
+  if case == '5b':
+    assert band_2.area_frac_open_ground == 4/64
+    assert band_2.hrus[11].area_frac == 12/64
+  else:
+    assert band_2.area_frac_glacier == 4/64
+    assert band_2.area_frac_open_ground == 12/64
+
+def test_compute_new_area_fracs(toy_domain_64px_cells,\
+  toy_domain_64px_rgm_vic_map_file_readout):
+  cells, cell_ids, num_snow_bands, _, cellid_map, bed_dem, surf_dem,\
+    glacier_mask, _ = toy_domain_64px_cells
+  _, cell_areas, num_cols_dem, num_rows_dem\
+    = toy_domain_64px_rgm_vic_map_file_readout
+
+  band_areas, glacier_areas = bin_bands_and_glaciers(cells, cell_areas,\
+    cellid_map, num_snow_bands, surf_dem, glacier_mask)
+  veg_types, changed, needs_update, new_band_area_frac, _, _, _, _ = \
+    compute_new_area_fracs(cells, cell_areas, band_areas, glacier_areas)
+  assert veg_types == sorted(veg_types)
+  assert new_band_area_frac.shape == (len(cell_ids), num_snow_bands)
+  assert not np.any(changed) and not np.any(needs_update)
+
+  # Band 2 of cell '12345' loses some of its open ground to glacier growth
+  surf_dem = deepcopy(surf_dem)
+  surf_dem[2 + 5][2 + 2 : 2 + 4] = [2230, 2240]
+  glacier_mask = update_glacier_mask(surf_dem, bed_dem, num_rows_dem,\
+    num_cols_dem, glacier_thickness_threshold)
+  band_areas, glacier_areas = bin_bands_and_glaciers(cells, cell_areas,\
+    cellid_map, num_snow_bands, surf_dem, glacier_mask)
+  veg_types, changed, needs_update, new_band_area_frac, new_glacier_area_frac,\
+    new_open_ground_area_frac, new_hru_area_frac, delta_area_hru = \
+    compute_new_area_fracs(cells, cell_areas, band_areas, glacier_areas)
+  assert np.array_equal(np.argwhere(changed), [[0, 2]])
+  assert np.array_equal(needs_update, changed)
+  assert new_band_area_frac[0, 2] == 12/64
+  assert new_glacier_area_frac[0, 2] == 10/64
+  assert new_open_ground_area_frac[0, 2] == 2/64
+  # Bands without changes keep zero open ground and vegetated HRU fractions
+  assert not np.any(new_open_ground_area_frac[~changed])
+  assert not np.any(new_hru_area_frac[~changed])
+  assert not np.any(delta_area_hru)
+
+def test_pack_unpack_cells(toy_domain_64px_cells):
+  cells = toy_domain_64px_cells[0]
+  for cell in cells.values():
+    for band in cell.bands:
+      for hru in band.hrus.values():
+        hru.hru_state.variables['SNOW_SWQ'] = hru.area_frac
+  packed = pack_cells(cells)
+  assert packed['cell_ids'] == list(cells.keys())
+  assert len(packed['hru_area_frac']) == sum(cell.bands[0].num_hrus\
+    + sum(band.num_hrus for band in cell.bands[1:]) for cell in cells.values())
+
+  unpacked = unpack_cells(packed)
+  for cell_id, cell in cells.items():
+    for band, unpacked_band in zip(cell.bands, unpacked[cell_id].bands):
+      assert unpacked_band.median_elev == band.median_elev
+      assert list(unpacked_band.hrus) == list(band.hrus)
+      for veg_type, hru in band.hrus.items():
+        assert unpacked_band.hrus[veg_type] == hru
+
+  # Unpacking into existing cells reuses their HRUs and drops missing ones
+  glacier_hru = cells['12345'].bands[2].hrus[GLACIER_ID]
+  del unpacked['12345'].bands[2].hrus[OPEN_GROUND_ID]
+  unpacked['12345'].bands[2].hrus[GLACIER_ID].area_frac = 0.5
+  unpack_cells(pack_cells(unpacked), cells)
+  assert cells['12345'].bands[2].hrus[GLACIER_ID] is glacier_hru
+  assert glacier_hru.area_frac == 0.5
+  assert list(cells['12345'].bands[2].hrus) == [GLACIER_ID]
+
+def test_update_area_fracs_parallel(toy_domain_64px_cells,\
+  toy_domain_64px_rgm_vic_map_file_readout):
+  cells, cell_ids, num_snow_bands, _, cellid_map, bed_dem, surf_dem, _, _\
+    = toy_domain_64px_cells
+  _, cell_areas, num_cols_dem, num_rows_dem\
+    = toy_domain_64px_rgm_vic_map_file_readout
+  for cell in cells.values():
+    for band in cell.bands:
+      for hru in band.hrus.values():
+        hru.hru_state.variables['SNOW_SWQ'] = 0.1 + hru.area_frac
+  # Glacier growth in both cells
+  surf_dem = deepcopy(surf_dem)
+  surf_dem[2 + 5][2 + 2 : 2 + 4] = [2230, 2240]
+  surf_dem[2 + 4][2 + 8 + 3 : 2 + 8 + 5] = [2120, 2110]
+  glacier_mask = update_glacier_mask(surf_dem, bed_dem, num_rows_dem,\
+    num_cols_dem, glacier_thickness_threshold)
+
+  parallel_cells = deepcopy(cells)
+  update_area_fracs(cells, cell_areas, cellid_map, num_snow_bands,\
+    surf_dem, glacier_mask)
+  with ProcessPoolExecutor(max_workers=2) as executor:
+    update_area_fracs(parallel_cells, cell_areas, cellid_map,\
+      num_snow_bands, surf_dem, glacier_mask, executor=executor,\
+      num_shards=2)
+  for cell_id in cell_ids:
+    assert parallel_cells[cell_id].cell_state.variables['VEG_TYPE_NUM']\
+      == cells[cell_id].cell_state.variables['VEG_TYPE_NUM']
+    for band, parallel_band in zip(cells[cell_id].bands,\
+      parallel_cells[cell_id].bands):
+      assert parallel_band.median_elev == band.median_elev
+      assert list(parallel_band.hrus) == list(band.hrus)
+      for veg_type, hru in band.hrus.items():
+        assert parallel_band.hrus[veg_type].area_frac == hru.area_frac
+        assert parallel_band.hrus[veg_type] == hru
+
+def test_find_dirty_cells(toy_domain_64px_cells):
+  cells, cell_ids, _, _, cellid_map, bed_dem, surf_dem, glacier_mask, _\
+    = toy_domain_64px_cells
+  pixel_index = CellPixelIndex.from_cell_mask(cellid_map, cell_ids)
+  assert find_dirty_cells(cells, pixel_index, None, surf_dem, None,
+                          glacier_mask) == cell_ids
+  assert find_dirty_cells(cells, pixel_index, surf_dem, surf_dem,
+                          glacier_mask, glacier_mask) == []
+
+  new_surf_dem = deepcopy(surf_dem)
+  new_surf_dem[2 + 4][2 + 8 + 3] += 10
+  assert find_dirty_cells(cells, pixel_index, surf_dem, new_surf_dem,
+                          glacier_mask, glacier_mask) == [cell_ids[1]]
+  # Changes outside the VIC domain don't count
+  new_surf_dem = deepcopy(surf_dem)
+  new_surf_dem[0][0] += 10
+  assert find_dirty_cells(cells, pixel_index, surf_dem, new_surf_dem,
+                          glacier_mask, glacier_mask) == []
+  new_glacier_mask = deepcopy(glacier_mask)
+  new_glacier_mask[2 + 5][2 + 2] = 1 - new_glacier_mask[2 + 5][2 + 2]
+  assert find_dirty_cells(cells, pixel_index, surf_dem, surf_dem,
+                          glacier_mask, new_glacier_mask) == [cell_ids[0]]
+
+def test_update_area_fracs_dirty_cells(toy_domain_64px_cells,\
+  toy_domain_64px_rgm_vic_map_file_readout):
+  cells, cell_ids, num_snow_bands, _, cellid_map, bed_dem, surf_dem, _, _\
+    = toy_domain_64px_cells
+  _, cell_areas, num_cols_dem, num_rows_dem\
+    = toy_domain_64px_rgm_vic_map_file_readout
+  pixel_index = CellPixelIndex.from_cell_mask(cellid_map, cell_ids)
+  glacier_mask = update_glacier_mask(surf_dem, bed_dem, num_rows_dem,\
+    num_cols_dem, glacier_thickness_threshold)
+  update_area_fracs(cells, cell_areas, cellid_map, num_snow_bands,\
+    surf_dem, glacier_mask, pixel_index)
+
+  # Glacier growth in the second cell only
+  new_surf_dem = deepcopy(surf_dem)
+  new_surf_dem[2 + 4][2 + 8 + 3 : 2 + 8 + 5] = [2120, 2110]
+  new_glacier_mask = update_glacier_mask(new_surf_dem, bed_dem, num_rows_dem,\
+    num_cols_dem, glacier_thickness_threshold)
+  dirty_cells = find_dirty_cells(cells, pixel_index, surf_dem, new_surf_dem,
+                                 glacier_mask, new_glacier_mask)
+  assert dirty_cells == [cell_ids[1]]
+  all_cells = deepcopy(cells)
+  update_area_fracs(all_cells, cell_areas, cellid_map, num_snow_bands,\
+    new_surf_dem, new_glacier_mask, pixel_index)
+  update_area_fracs(cells, cell_areas, cellid_map, num_snow_bands,\
+    new_surf_dem, new_glacier_mask, pixel_index, dirty_cells=dirty_cells)
+  assert cells[cell_ids[1]].bands[3].area_frac_glacier > 0
+  for cell_id in cell_ids:
+    assert cells[cell_id].cell_state.variables['VEG_TYPE_NUM']\
+      == all_cells[cell_id].cell_state.variables['VEG_TYPE_NUM']
+    for band, all_band in zip(cells[cell_id].bands, all_cells[cell_id].bands):
+      assert band.median_elev == all_band.median_elev
+      assert band.hrus == all_band.hrus
+
+  # Nothing to do if no pixels changed
+  update_area_fracs(cells, cell_areas, cellid_map, num_snow_bands,\
+    new_surf_dem, new_glacier_mask, pixel_index, dirty_cells=[])
+  assert cells[cell_ids[1]].bands[3].hrus == all_cells[cell_ids[1]].bands[3].hrus
+
+def test_incremental_binning(toy_domain_64px_cells,\
+  toy_domain_64px_rgm_vic_map_file_readout):
+  cells, cell_ids, num_snow_bands, _, cellid_map, bed_dem, surf_dem, _, _\
+    = toy_domain_64px_cells
+  _, cell_areas, num_cols_dem, num_rows_dem\
+    = toy_domain_64px_rgm_vic_map_file_readout
+  pixel_index = CellPixelIndex.from_cell_mask(cellid_map, cell_ids)
+  glacier_mask = update_glacier_mask(surf_dem, bed_dem, num_rows_dem,\
+    num_cols_dem, glacier_thickness_threshold)
+  binning = IncrementalBinning(cells, num_snow_bands, surf_dem, glacier_mask,
+                               pixel_index, check=True)
+  full_cells = deepcopy(cells)
+  assert binning.bin(cells) == bin_bands_and_glaciers(full_cells, cell_areas,
+    cellid_map, num_snow_bands, surf_dem, glacier_mask, pixel_index)
+  assert cells == full_cells
+
+  # Glacier growth in the second cell only, crossing into band 3
+  old_surf_dem, old_glacier_mask = surf_dem, glacier_mask
+  surf_dem = deepcopy(surf_dem)
+  surf_dem[2 + 4][2 + 8 + 3 : 2 + 8 + 5] = [2120, 2110]
+  glacier_mask = update_glacier_mask(surf_dem, bed_dem, num_rows_dem,\
+    num_cols_dem, glacier_thickness_threshold)
+  assert binning.update(cells, surf_dem, glacier_mask) == [cell_ids[1]]\
+    == find_dirty_cells(cells, pixel_index, old_surf_dem, surf_dem,\
+      old_glacier_mask, glacier_mask)
+  assert binning.bin(cells) == bin_bands_and_glaciers(full_cells, cell_areas,
+    cellid_map, num_snow_bands, surf_dem, glacier_mask, pixel_index)
+  assert cells == full_cells
+  assert not np.any(binning.stale_bins)
+  assert binning.update(cells, surf_dem, glacier_mask) == []
+
+  # The float32 rounding of a DEM passed through a DSBB grid changes nothing
+  surf_dem = surf_dem + 1/3
+  assert binning.update(cells, surf_dem, glacier_mask) == cell_ids
+  assert binning.bin(cells) == bin_bands_and_glaciers(full_cells, cell_areas,
+    cellid_map, num_snow_bands, surf_dem, glacier_mask, pixel_index)
+  rounded_surf_dem = surf_dem.astype(np.float32).astype(np.float64)
+  assert np.all(rounded_surf_dem != surf_dem)
+  assert find_dirty_cells(cells, pixel_index, surf_dem, rounded_surf_dem,\
+    glacier_mask, glacier_mask) == []
+  assert binning.update(cells, rounded_surf_dem, glacier_mask) == []
+  assert binning.bin(cells) == bin_bands_and_glaciers(deepcopy(cells),\
+    cell_areas, cellid_map, num_snow_bands, surf_dem, glacier_mask,\
+    pixel_index)
+  assert cells == full_cells
+
+  # The consistency check catches bins gone out of sync with the pixels
+  binning.band_counts[0] += 1
+  surf_dem[2 + 4][2 + 8 + 3] += 1
+  with pytest.raises(Exception):
+    binning.update(cells, surf_dem, glacier_mask)
+
+@pytest.mark.parametrize('dtype', [np.float64, np.float32, np.int64])
+def test_grouped_median(dtype):
+  values = np.array([5, 1, 3, 2, 2, 7, 8, 4, 6], dtype=dtype)
+  groups = np.array([0, 0, 0, 2, 2, 3, 3, 3, 3])
+  medians = grouped_median(values, groups, 5)
+  assert medians[[0, 2, 3]].tolist() == [3, 2, 6.5]
+  assert np.isnan(medians[1]) and np.isnan(medians[4])
+  for group in (0, 2, 3):
+    assert medians[group] == np.median(values[groups == group])
+    assert medians.dtype == np.median(values[groups == group]).dtype
+
+def test_binning_in_tiles(tmpdir, toy_domain_64px_cells,\
+  toy_domain_64px_rgm_vic_map_file_readout):
+  cells, cell_ids, num_snow_bands, _, cellid_map, bed_dem, surf_dem, _, _\
+    = toy_domain_64px_cells
+  _, cell_areas, num_cols_dem, num_rows_dem\
+    = toy_domain_64px_rgm_vic_map_file_readout
+  pixel_index = CellPixelIndex.from_cell_mask(cellid_map, cell_ids)
+  assert list(pixel_index.cell_tiles(100)) == [slice(0, 1), slice(1, 2)]
+  assert list(pixel_index.cell_tiles(128)) == [slice(0, 2)]
+
+  glacier_mask = update_glacier_mask(surf_dem, bed_dem, num_rows_dem,\
+    num_cols_dem, glacier_thickness_threshold)
+  tiled_glacier_mask = update_glacier_mask(
+    memmap_grid(surf_dem, str(tmpdir.join('surf_dem.dat'))), bed_dem,
+    num_rows_dem, num_cols_dem, glacier_thickness_threshold,
+    new_grid((num_rows_dem, num_cols_dem),
+             filename=str(tmpdir.join('glacier_mask.dat'))),
+    tile_pixels=25)
+  assert isinstance(tiled_glacier_mask, np.memmap)
+  assert np.array_equal(tiled_glacier_mask, glacier_mask)
+
+  tiled_cells = deepcopy(cells)
+  assert bin_bands_and_glaciers(tiled_cells, cell_areas, cellid_map,\
+    num_snow_bands, surf_dem, tiled_glacier_mask, pixel_index,\
+    tile_pixels=1)\
+    == bin_bands_and_glaciers(cells, cell_areas, cellid_map,\
+    num_snow_bands, surf_dem, glacier_mask, pixel_index)
+  assert tiled_cells == cells
+
+def test_reconcile_bed_dem():
+  surf_dem = np.array([[10., 20., 30.], [40., 50., 60.]])
+  bed_dem = np.array([[5., 25., 30.], [45., 50., 55.]])
+  assert reconcile_bed_dem(surf_dem, bed_dem, 2, 3, tile_pixels=2) == 2
+  assert np.array_equal(bed_dem, [[5., 20., 30.], [40., 50., 55.]])
+  assert reconcile_bed_dem(surf_dem, bed_dem, 2, 3) == 0
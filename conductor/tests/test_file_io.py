@@ -0,0 +1,352 @@
+''' This is a set of tests for the file_io.py module.
+  See conftest.py for details on the test fixtures used.
+'''
+
+from datetime import date
+import os
+
+import numpy as np
+import netCDF4
+
+import pytest
+from pkg_resources import resource_filename
+
+from conductor.file_io import *
+from conductor.grids import new_grid, memmap_grid
+
+def test_get_rgm_pixel_mapping(toy_domain_64px_cells,\
+  toy_domain_64px_rgm_vic_map_file_readout):
+  _, _, _, _, cellid_map, _, _, _, _ = toy_domain_64px_cells
+  vic_cell_mask, cell_areas, nx, ny = toy_domain_64px_rgm_vic_map_file_readout
+
+  assert (nx, ny) == (20, 12)
+  assert list(cell_areas.items()) == [('NA', 112), ('12345', 64), ('23456', 64)]
+  assert np.array_equal(np.ma.getmaskarray(vic_cell_mask), cellid_map == 9999)
+  assert np.array_equal(vic_cell_mask.compressed(),\
+    cellid_map[cellid_map != 9999].astype(np.int32))
+
+  # Parsing in blocks much smaller than the file gives the same result
+  fname = resource_filename(\
+    'conductor', 'tests/input/rgm_vic_map_toy_64px_auto.txt')
+  vic_cell_mask_2, cell_areas_2, _, _ = get_rgm_pixel_mapping(fname,\
+    chunk_size=100)
+  assert list(cell_areas_2.items()) == list(cell_areas.items())
+  assert np.array_equal(vic_cell_mask_2.filled(0), vic_cell_mask.filled(0))
+
+def test_get_rgm_pixel_mapping_malformed(tmpdir):
+  fname = str(tmpdir.join('rgm_vic_map_bad.txt'))
+  with open(fname, 'w') as f:
+    f.write('NCOLS 2\nNROWS 1\n"PIXEL_ID" "ROW" "COL" "BAND" "ELEV" "CELL_ID"\n')
+    f.write('1 0 0 0 2000 12345\n2 0 1 0 2000.5\n')
+  with pytest.raises(Exception):
+    get_rgm_pixel_mapping(fname)
+  # Short and long lines adding up to whole lines are caught line by line
+  with open(fname, 'w') as f:
+    f.write('NCOLS 3\nNROWS 1\n"PIXEL_ID" "ROW" "COL" "BAND" "ELEV" "CELL_ID"\n')
+    f.write('1 0 0 0 2000 12345\n2 0 1 0 2000\n3 0 2 0 2000 12345 7\n')
+  with pytest.raises(Exception) as excinfo:
+    get_rgm_pixel_mapping(fname)
+  assert 'number of columns changed from 6 to 5 at row 2' in str(excinfo.value)
+  # Signed and non-integer rows, columns and cell IDs are rejected
+  for line in ['1 -1 0 0 2000 12345', '1 0 0.5 0 2000 12345',\
+      '1 0 0 0 2000 12345.5', '1 NA 0 0 2000 12345', '1 0 0 0 2000 12x']:
+    with open(fname, 'w') as f:
+      f.write('NCOLS 2\nNROWS 1\n"PIXEL_ID" "ROW" "COL" "BAND" "ELEV" "CELL_ID"\n')
+      f.write(line + '\n')
+    with pytest.raises(Exception):
+      get_rgm_pixel_mapping(fname)
+  # Blank lines and CRLF line ends are fine
+  with open(fname, 'w') as f:
+    f.write('NCOLS 2\nNROWS 1\n"PIXEL_ID" "ROW" "COL" "BAND" "ELEV" "CELL_ID"\n')
+    f.write('1 0 0 0 2000 12345\r\n\n2 0 1 0 2000 NA\r\n')
+  _, cell_areas, _, _ = get_rgm_pixel_mapping(fname)
+  assert cell_areas == { '12345': 1, 'NA': 1 }
+
+def test_mass_balances_to_rgm_grid(toy_domain_64px_cells,\
+  toy_domain_64px_rgm_vic_map_file_readout):
+  _, _, _, _, _, bed_dem, surf_dem, _, _ = toy_domain_64px_cells
+  vic_cell_mask, _, num_cols_dem, num_rows_dem\
+    = toy_domain_64px_rgm_vic_map_file_readout
+
+  gmb_polys = {
+    '12345': [-10.0, 0.005, 0.000001],
+    '23456': [-12.0, 0.006, 0.0000005]
+  }
+  surf_dem = surf_dem.copy()
+  mass_balance_grid = mass_balances_to_rgm_grid(gmb_polys, vic_cell_mask,\
+    surf_dem, bed_dem, num_rows_dem, num_cols_dem)
+
+  for row in range(num_rows_dem):
+    for col in range(num_cols_dem):
+      if vic_cell_mask[row][col] is np.ma.masked:
+        assert mass_balance_grid[row][col] == 0
+        assert surf_dem[row][col] == bed_dem[row][col]
+      else:
+        a, b, c = gmb_polys[str(vic_cell_mask[row][col])]
+        elev = surf_dem[row][col]
+        assert mass_balance_grid[row][col] == a + elev * (b + elev * c)
+
+def test_reset_out_of_domain_elevations(toy_domain_64px_cells,\
+  toy_domain_64px_rgm_vic_map_file_readout):
+  _, _, _, _, _, bed_dem, surf_dem, _, _ = toy_domain_64px_cells
+  vic_cell_mask, _, num_cols_dem, num_rows_dem\
+    = toy_domain_64px_rgm_vic_map_file_readout
+
+  reset_surf_dem = surf_dem.copy()
+  reset_out_of_domain_elevations(vic_cell_mask, reset_surf_dem, bed_dem,\
+    num_rows_dem, num_cols_dem, tile_pixels=num_cols_dem * 3)
+  out_of_domain = np.ma.getmaskarray(vic_cell_mask)
+  assert np.array_equal(reset_surf_dem[out_of_domain], bed_dem[out_of_domain])
+  assert np.array_equal(reset_surf_dem[~out_of_domain],\
+    surf_dem[~out_of_domain])
+  # The surface DEM fed to the RGM is the same whether it is reset before
+  # or by mass_balances_to_rgm_grid()
+  gmb_polys = { '12345': [-10.0, 0.005, 0.000001],
+                '23456': [-12.0, 0.006, 0.0000005] }
+  expected_surf_dem = surf_dem.copy()
+  mass_balances_to_rgm_grid(gmb_polys, vic_cell_mask, expected_surf_dem,\
+    bed_dem, num_rows_dem, num_cols_dem)
+  mass_balances_to_rgm_grid(gmb_polys, vic_cell_mask, reset_surf_dem,\
+    bed_dem, num_rows_dem, num_cols_dem)
+  assert np.array_equal(reset_surf_dem, expected_surf_dem)
+
+def test_mass_balances_to_rgm_grid_missing_cell(toy_domain_64px_cells,\
+  toy_domain_64px_rgm_vic_map_file_readout):
+  _, _, _, _, _, bed_dem, surf_dem, _, _ = toy_domain_64px_cells
+  vic_cell_mask, _, num_cols_dem, num_rows_dem\
+    = toy_domain_64px_rgm_vic_map_file_readout
+
+  gmb_polys = { '12345': [-10.0, 0.005, 0.000001] }
+  with pytest.raises(SystemExit):
+    mass_balances_to_rgm_grid(gmb_polys, vic_cell_mask, surf_dem.copy(),\
+      bed_dem, num_rows_dem, num_cols_dem)
+
+def test_read_gsa_grid(tmpdir):
+  grid = np.arange(12 * 20, dtype=float).reshape(12, 20) * 1.5 + 1000.25
+  fname = str(tmpdir.join('dem.gsa'))
+  write_grid_to_gsa_file(grid, fname, 20, 12, 0, 19, 0, 11)
+
+  assert np.array_equal(read_gsa_grid(fname), grid)
+  assert np.array_equal(read_gsa_grid(fname), np.loadtxt(fname, skiprows=5))
+  # Block boundaries falling inside numbers and lines
+  for chunk_size in [7, 64, 1000]:
+    assert np.array_equal(read_gsa_grid(fname, chunk_size=chunk_size), grid)
+
+def test_read_gsa_grid_dimension_mismatch(tmpdir):
+  grid = np.ones((3, 4))
+  fname = str(tmpdir.join('dem.gsa'))
+  # Header states 3 rows x 5 columns
+  write_grid_to_gsa_file(grid, fname, 5, 3, 0, 4, 0, 2)
+  with pytest.raises(Exception) as excinfo:
+    read_gsa_grid(fname)
+  assert '12 values found' in str(excinfo.value)
+
+  # Header states 2 rows x 4 columns
+  write_grid_to_gsa_file(grid, fname, 4, 2, 0, 3, 0, 1)
+  with pytest.raises(Exception):
+    read_gsa_grid(fname, chunk_size=8)
+
+def test_write_grid_to_gsa_file(tmpdir):
+  grid = np.array([[1.5, 2.0, 1e-05], [1234.5678, -0.1, 3.0]])
+  fname = str(tmpdir.join('grid.gsa'))
+  write_grid_to_gsa_file(grid, fname, 3, 2, 0, 2, 0.5, 1.5)
+  with open(fname, 'rb') as f:
+    assert f.read() == b'DSAA\r\n3 2\r\n0 2\r\n0.5 1.5\r\n-0.1 1234.5678\r\n'\
+      b'1.5 2.0 1e-05\r\n1234.5678 -0.1 3.0\r\n'
+
+  write_grid_to_gsa_file(grid, fname, 3, 2, 0, 2, 0.5, 1.5, precision=2,\
+    block_rows=1)
+  with open(fname, 'rb') as f:
+    assert f.read() == b'DSAA\r\n3 2\r\n0 2\r\n0.5 1.5\r\n-0.1 1234.5678\r\n'\
+      b'1.50 2.00 0.00\r\n1234.57 -0.10 3.00\r\n'
+  assert np.array_equal(read_gsa_grid(fname), np.round(grid, 2))
+
+@pytest.mark.parametrize('grid_format', GRID_FORMATS)
+def test_grid_file_round_trip(tmpdir, grid_format):
+  grid = np.arange(12 * 20, dtype=float).reshape(12, 20) * 1.5 + 1000.25
+  fname = str(tmpdir.join('dem.grd'))
+  write_grid_file(grid, fname, grid_format, 20, 12, 100.0, 195.0, 50.0, 105.0)
+
+  assert get_grid_format(fname) == grid_format
+  assert read_grid_headers(fname) == [100.0, 195.0, 50.0, 105.0, 12, 20]
+  assert np.array_equal(read_grid_file(fname), grid)
+  # (DSBB float32 values are widened when read into memory)
+  assert read_grid_file(fname).dtype == np.float64
+  mapped_grid = read_grid_file(fname, mmap_mode='c')
+  assert np.array_equal(mapped_grid, grid)
+  if grid_format != 'DSAA':
+    assert isinstance(mapped_grid, np.memmap)
+    # Copy-on-write: changes are not written back to the file
+    mapped_grid[0, 0] = 0
+    assert np.array_equal(read_grid_file(fname), grid)
+
+@pytest.mark.parametrize('grid_format', GRID_FORMATS)
+def test_memmap_grid_file(tmpdir, grid_format):
+  grid = np.arange(12 * 20, dtype=float).reshape(12, 20) * 1.5 + 1000.25
+  fname = str(tmpdir.join('dem.grd'))
+  write_grid_file(grid, fname, grid_format, 20, 12, 100.0, 195.0, 50.0, 105.0)
+
+  memmap_fname = str(tmpdir.join('memmap', 'dem.dat'))
+  memmap = memmap_grid_file(fname, memmap_fname)
+  assert isinstance(memmap, np.memmap) and memmap.dtype == np.float64
+  assert memmap.filename == os.path.abspath(memmap_fname)
+  assert np.array_equal(memmap, grid)
+  # Changes are written to the memmap file, not to the grid file
+  memmap[0, 0] = 0
+  memmap.flush()
+  assert np.array_equal(read_grid_file(fname), grid)
+  if grid_format == 'DSAA':
+    assert np.array_equal(read_gsa_grid(fname, filename=memmap_fname), grid)
+
+def test_surfer_binary_headers(tmpdir):
+  grid = np.array([[1.0, 2.0, 3.0], [4.0, 5.0, 6.5]])
+  fname = str(tmpdir.join('dem.grd'))
+  write_grid_file(grid, fname, 'DSRB', 3, 2, 0.0, 20.0, 5.0, 15.0)
+  header = read_surfer_binary_header(fname)
+  assert (header['num_rows'], header['num_cols']) == (2, 3)
+  assert (header['xll'], header['yll']) == (0.0, 5.0)
+  assert (header['xsize'], header['ysize']) == (10.0, 10.0)
+  assert (header['zmin'], header['zmax']) == (1.0, 6.5)
+  assert header['data_size'] == 6 * 8
+
+  write_grid_file(grid, fname, 'DSBB', 3, 2, 0.0, 20.0, 5.0, 15.0)
+  header = read_surfer_binary_header(fname)
+  assert (header['num_cols'], header['num_rows']) == (3, 2)
+  assert (header['zmin'], header['zmax']) == (1.0, 6.5)
+  assert header.dtype.itemsize == 56
+
+  # Truncated grid data
+  with open(fname, 'rb') as f:
+    contents = f.read()
+  with open(fname, 'wb') as f:
+    f.write(contents[:-4])
+  with pytest.raises(Exception):
+    read_grid_file(fname)
+
+def test_read_state(toy_domain_64px_cells, toy_domain_64px_state_file):
+  cells = toy_domain_64px_cells[0]
+  with netCDF4.Dataset(toy_domain_64px_state_file, 'r') as state:
+    read_state(state, cells)
+
+    for lon_idx, cell in enumerate(cells.values()):
+      cell_state = cell.cell_state.variables
+      assert cell_state['lat'] == state['lat'][0]
+      assert cell_state['lon'] == state['lon'][lon_idx]
+      assert str(cell_state['GRID_CELL']) == list(cells.keys())[lon_idx]
+      for variable in ['NUM_BANDS', 'SOIL_DZ_NODE',\
+        'GLAC_MASS_BALANCE_EQN_TERMS']:
+        assert np.array_equal(cell_state[variable],\
+          state[variable][0, lon_idx])
+      hru_idx = 0
+      for band in cell.bands:
+        for veg_type in band.hru_keys_sorted:
+          hru_state = band.hrus[veg_type].hru_state.variables
+          for variable in hru_state:
+            assert np.array_equal(hru_state[variable],\
+              state[variable][0, lon_idx, hru_idx])
+          hru_idx += 1
+
+
+@pytest.mark.parametrize('zlib, chunksizes', [(False, None), (True, {'hru': 4})])
+def test_write_state(tmpdir, toy_domain_64px_cells, toy_domain_64px_state_file,\
+  zlib, chunksizes):
+  cells = toy_domain_64px_cells[0]
+  new_state_file = str(tmpdir.join('vic_state_new.nc'))
+  with netCDF4.Dataset(toy_domain_64px_state_file, 'r') as state:
+    read_state(state, cells)
+    # Leave one HRU slot of the first cell unused
+    cells['12345'].bands[0].delete_hru(11)
+    with netCDF4.Dataset(new_state_file, 'w') as new_state:
+      write_state(cells, state, new_state, date(2001, 10, 1), zlib=zlib,\
+        chunksizes=chunksizes)
+
+  with netCDF4.Dataset(new_state_file, 'r') as new_state:
+    assert new_state.state_year == 2001
+    assert new_state.title == 'toy domain state'
+    assert len(new_state.dimensions['hru']) == 8
+    assert new_state['LAYER_MOIST'].filters()['zlib'] == zlib
+    if chunksizes:
+      assert new_state['LAYER_MOIST'].chunking() == [1, 3, 4, 1, 3]
+    # The dummy cell is left at fill values
+    assert new_state['GRID_CELL'][0, 2] is np.ma.masked
+    assert np.ma.getmaskarray(new_state['SNOW_SWQ'][0, 2]).all()
+
+    for lon_idx, cell in enumerate(cells.values()):
+      cell_state = cell.cell_state.variables
+      assert new_state['lon'][lon_idx] == cell_state['lon']
+      assert np.array_equal(new_state['SOIL_DZ_NODE'][0, lon_idx],\
+        cell_state['SOIL_DZ_NODE'])
+      hru_idx = 0
+      for band in cell.bands:
+        for veg_type in band.hru_keys_sorted:
+          hru_state = band.hrus[veg_type].hru_state.variables
+          for variable in hru_state:
+            assert np.array_equal(new_state[variable][0, lon_idx, hru_idx],\
+              hru_state[variable])
+          hru_idx += 1
+      # Unused HRU slots are left at fill values
+      assert np.ma.getmaskarray(\
+        new_state['SNOW_SWQ'][0, lon_idx, hru_idx:]).all()
+
+def test_update_state(tmpdir, toy_domain_64px_cells, toy_domain_64px_state_file):
+  cells = toy_domain_64px_cells[0]
+  # (the fixture state file has a spare HRU slot, so start from a state file
+  # written with a matching hru dimension)
+  new_state_file = str(tmpdir.join('vic_state_new.nc'))
+  written_state_file = str(tmpdir.join('vic_state_written.nc'))
+  with netCDF4.Dataset(toy_domain_64px_state_file, 'r') as state:
+    read_state(state, cells)
+    with netCDF4.Dataset(new_state_file, 'w') as new_state:
+      write_state(cells, state, new_state, date(2000, 10, 1))
+  for band in cells['23456'].bands:
+    for hru in band.hrus.values():
+      hru.hru_state.variables['SNOW_SWQ'] = 0.5
+  with netCDF4.Dataset(new_state_file, 'r') as state,\
+    netCDF4.Dataset(written_state_file, 'w') as written_state:
+    write_state(cells, state, written_state, date(2001, 10, 1))
+  with netCDF4.Dataset(new_state_file, 'r+') as new_state:
+    update_state(cells, new_state, date(2001, 10, 1))
+
+  with netCDF4.Dataset(new_state_file, 'r') as new_state,\
+    netCDF4.Dataset(written_state_file, 'r') as written_state:
+    assert new_state.state_year == 2001
+    assert new_state.title == 'toy domain state'
+    assert set(new_state.variables) == set(written_state.variables)
+    for variable in new_state.variables:
+      assert np.ma.allequal(new_state[variable][:], written_state[variable][:])
+      assert np.array_equal(np.ma.getmaskarray(new_state[variable][:]),\
+        np.ma.getmaskarray(written_state[variable][:]))
+    assert (new_state['SNOW_SWQ'][0, 1, :cells['23456'].bands[0].num_hrus]\
+      == 0.5).all()
+
+  # The hru dimension can't be changed in place
+  cells['12345'].bands[0].delete_hru(11)
+  cells['23456'].bands[1].delete_hru(11)
+  with netCDF4.Dataset(new_state_file, 'r+') as new_state:
+    with pytest.raises(Exception):
+      update_state(cells, new_state, date(2002, 10, 1))
+
+def test_mass_balances_to_rgm_grid_tiled(tmpdir, toy_domain_64px_cells,\
+  toy_domain_64px_rgm_vic_map_file_readout):
+  _, _, _, _, _, bed_dem, surf_dem, _, _ = toy_domain_64px_cells
+  vic_cell_mask, _, num_cols_dem, num_rows_dem\
+    = toy_domain_64px_rgm_vic_map_file_readout
+
+  gmb_polys = {
+    '12345': [-10.0, 0.005, 0.000001],
+    '23456': [-12.0, 0.006, 0.0000005]
+  }
+  expected_surf_dem = surf_dem.copy()
+  expected = mass_balances_to_rgm_grid(gmb_polys, vic_cell_mask,\
+    expected_surf_dem, bed_dem, num_rows_dem, num_cols_dem)
+  # Memory-mapped DEM and output grid (with stale contents), small tiles
+  surf_dem = memmap_grid(surf_dem, str(tmpdir.join('surf_dem.dat')))
+  output_grid = new_grid((num_rows_dem, num_cols_dem),\
+    filename=str(tmpdir.join('mass_balance_grid.dat')))
+  output_grid[:] = 1
+  mass_balance_grid = mass_balances_to_rgm_grid(gmb_polys, vic_cell_mask,\
+    surf_dem, bed_dem, num_rows_dem, num_cols_dem,\
+    mass_balance_grid=output_grid, tile_pixels=7)
+  assert np.array_equal(mass_balance_grid, expected)
+  assert np.array_equal(output_grid, expected)
+  assert np.array_equal(surf_dem, expected_surf_dem)
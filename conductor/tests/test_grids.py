@@ -0,0 +1,29 @@
+''' This is a set of tests for the grids.py module.
+'''
+
+import numpy as np
+
+from conductor.grids import row_tiles, pixel_tiles, new_grid, memmap_grid
+
+def test_row_tiles():
+  assert list(row_tiles(5, 4, 8)) == [slice(0, 2), slice(2, 4), slice(4, 5)]
+  # At least one row per tile
+  assert list(row_tiles(2, 4, 3)) == [slice(0, 1), slice(1, 2)]
+  assert list(row_tiles(0, 4)) == []
+
+def test_pixel_tiles():
+  assert list(pixel_tiles(5, 2)) == [slice(0, 2), slice(2, 4), slice(4, 5)]
+
+def test_memmap_grid(tmpdir):
+  grid = np.ma.masked_array(np.arange(12, dtype=float).reshape(3, 4))
+  grid[0, 0] = np.ma.masked
+  fname = str(tmpdir.join('memmap', 'grid.dat'))
+  memmap = memmap_grid(grid, fname, tile_pixels=5)
+  assert isinstance(memmap, np.memmap)
+  assert np.array_equal(memmap, np.ma.getdata(grid))
+  assert np.array_equal(np.fromfile(fname).reshape(3, 4), memmap)
+
+  zeros = new_grid((2, 3), dtype=np.int32, filename=fname)
+  assert isinstance(zeros, np.memmap) and zeros.dtype == np.int32
+  assert not zeros.any()
+  assert not isinstance(new_grid((2, 3)), np.memmap)
@@ -0,0 +1,102 @@
+''' This is a set of tests for the runner.py module.
+'''
+
+import asyncio
+import logging
+import os
+import sys
+import threading
+import time
+
+import pytest
+
+from conductor.runner import ModelRunError, run_model, run_model_async
+
+def python_args(code):
+  return [sys.executable, '-c', code]
+
+def test_run_model(caplog):
+  caplog.set_level(logging.INFO)
+  code = 'import sys; print("year 1"); print("warning", file=sys.stderr); \
+x = bytearray(64 * 2**20); sum(range(10**6))'
+  stats = run_model('model', python_args(code), timeout=60)
+  assert stats.name == 'model'
+  assert stats.returncode == 0
+  assert stats.wall_time > 0
+  assert stats.cpu_time > 0
+  if stats.peak_rss is not None:
+    assert stats.peak_rss > 64 * 2**20
+  messages = [ record.getMessage() for record in caplog.records ]
+  assert 'model stdout: year 1' in messages
+  assert 'model stderr: warning' in messages
+
+def test_run_model_failure():
+  with pytest.raises(ModelRunError, match='status 3'):
+    run_model('model', python_args('import sys; sys.exit(3)'))
+  with pytest.raises(ModelRunError, match='could not be started'):
+    run_model('model', ['/nonexistent/model'])
+
+def test_run_model_timeout():
+  with pytest.raises(ModelRunError, match='killed'):
+    run_model('model', python_args('import time; time.sleep(60)'),\
+      timeout=0.5)
+
+def test_run_model_drain_timeout(caplog):
+  caplog.set_level(logging.INFO)
+  # A process left running by the model holds its output pipes open
+  code = 'import subprocess, sys; print("done"); sys.stdout.flush(); \
+subprocess.Popen([sys.executable, "-c", "import time; time.sleep(10)"])'
+  start = time.perf_counter()
+  stats = asyncio.run(run_model_async('model', python_args(code),\
+    drain_timeout=0.5))
+  assert time.perf_counter() - start < 5
+  assert stats.returncode == 0
+  messages = [ record.getMessage() for record in caplog.records ]
+  assert 'model stdout: done' in messages
+  assert any('no longer logged' in message for message in messages)
+
+def test_run_model_cancelled(caplog):
+  caplog.set_level(logging.INFO)
+  code = 'import os, sys, time; print(os.getpid()); sys.stdout.flush(); \
+time.sleep(60)'
+  async def run():
+    task = asyncio.ensure_future(run_model_async('model', python_args(code)))
+    pids = []
+    while not pids:
+      await asyncio.sleep(0.05)
+      pids = [ int(record.getMessage().split()[-1])\
+        for record in caplog.records\
+        if record.getMessage().startswith('model stdout: ') ]
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+      await task
+    return pids[0]
+  pid = asyncio.run(asyncio.wait_for(run(), 30))
+  # The model was killed (and reaped) when the run was cancelled
+  with pytest.raises(ProcessLookupError):
+    os.kill(pid, 0)
+
+def test_run_model_concurrent_tasks():
+  # The task only completes while the model is running
+  started = threading.Event()
+  def task():
+    assert started.wait(30)
+  code = 'import sys; print("started"); sys.stdout.flush(); \
+import time; time.sleep(0.5)'
+  class StartedHandler(logging.Handler):
+    def emit(self, record):
+      if record.getMessage() == 'model stdout: started':
+        started.set()
+  handler = StartedHandler()
+  logging.getLogger().addHandler(handler)
+  logging.getLogger().setLevel(logging.INFO)
+  try:
+    run_model('model', python_args(code), concurrent_tasks=[task])
+  finally:
+    logging.getLogger().removeHandler(handler)
+  assert started.is_set()
+
+  def fail():
+    raise IOError('disk full')
+  with pytest.raises(IOError):
+    run_model('model', python_args('pass'), concurrent_tasks=[fail])
@@ -1,8 +1,12 @@
+import csv
 from pkg_resources import resource_filename
 
+import numpy as np
 import pytest
 
-from conductor.snbparams import load_snb_parms
+from conductor.cells import HruStateStore, merge_cell_input
+from conductor.snbparams import load_snb_parms, save_snb_parms
+from conductor.vegparams import load_veg_parms
 
 def test_load_snb_parms():
   fname = resource_filename('conductor', 'tests/input/snow_band.txt')
@@ -14,3 +18,23 @@ def test_load_snb_parms():
   zs = [ band.median_elev for band in cells['368470'] ]
   assert zs == expected_zs
 
+
+def test_save_snb_parms(tmpdir):
+  fname = resource_filename('conductor', 'tests/input/vpf_toy_64px.txt')
+  hru_store = HruStateStore()
+  hru_cells = load_veg_parms(fname, hru_store)
+  fname = resource_filename('conductor', 'tests/input/snb_toy_64px.txt')
+  cells = merge_cell_input(hru_cells, load_snb_parms(fname, 5), hru_store)
+  # Elevations binned from the DEM are floats
+  cell = cells[list(cells.keys())[0]]
+  cell.bands[1].median_elev = np.float64(2150.5)
+  cell.bands[2].median_elev = np.float64(2200)
+  save_snb_parms(cells, str(tmpdir.join('snb.txt')))
+
+  with open(str(tmpdir.join('expected.txt')), 'w') as f:
+    writer = csv.writer(f, delimiter=' ')
+    for cell_id, cell in cells.items():
+      writer.writerow([cell_id] + [band.area_frac for band in cell.bands]\
+        + [band.median_elev if band.num_hrus > 0 else 0\
+           for band in cell.bands] + [1] * cell.num_bands)
+  assert tmpdir.join('snb.txt').read() == tmpdir.join('expected.txt').read()
@@ -1,9 +1,99 @@
+import csv
 from pkg_resources import resource_filename
+import pytest
 
-from conductor.vegparams import load_veg_parms
+from conductor.cells import HruStateStore, merge_cell_input
+from conductor.snbparams import load_snb_parms
+from conductor.vegparams import load_veg_parms, read_one_cell, save_veg_parms
 
 def test_load_veg_parms():
   fname = resource_filename('conductor', 'tests/input/veg.txt')
-  cells = load_veg_parms(fname)
+  cells = load_veg_parms(fname, HruStateStore())
   assert len(cells) == 6
   assert len(cells['368470']) == 16
+
+def test_load_veg_parms_matches_read_one_cell():
+  fname = resource_filename('conductor', 'tests/input/vpf_toy_64px.txt')
+  cells = load_veg_parms(fname, HruStateStore())
+  store = HruStateStore()
+  with open(fname) as f:
+    expected = []
+    cell = read_one_cell(f, store)
+    while cell:
+      expected.append(cell)
+      cell = read_one_cell(f, store)
+  assert list(cells.keys()) == [cell_id for cell_id, _ in expected]
+  for cell_id, hru_dict in expected:
+    assert sorted(cells[cell_id]) == sorted(hru_dict)
+    for key, hru in hru_dict.items():
+      loaded = cells[cell_id][key]
+      assert loaded.area_frac == hru.area_frac
+      assert loaded.root_zone_parms == hru.root_zone_parms
+      assert loaded.hru_state == hru.hru_state
+
+def test_load_veg_parms_truncated(tmpdir):
+  fname = str(tmpdir.join('vpf.txt'))
+  with open(fname, 'w') as f:
+    f.write('12345 2\n  11 0.5 0.10 0.60 0.50 0.30 1.00 0.10 0\n')
+  with pytest.raises(Exception):
+    load_veg_parms(fname, HruStateStore())
+
+def test_load_veg_parms_column_count(tmpdir):
+  fname = str(tmpdir.join('vpf.txt'))
+  # A long line followed by a short one, with 18 tokens between them
+  with open(fname, 'w') as f:
+    f.write('12345 2\n  11 0.5 0.10 0.60 0.50 0.30 1.00 0.10 0 7\n'
+      '  12 0.5 0.10 0.60 0.50 0.30 1.00 0.10\n')
+  with pytest.raises(Exception, match='found 8'):
+    load_veg_parms(fname, HruStateStore())
+  # Trailing extra columns are ignored, as by read_one_cell()
+  with open(fname, 'w') as f:
+    f.write('12345 2\n  11 0.5 0.10 0.60 0.50 0.30 1.00 0.10 0 7\n'
+      '  12 0.5 0.10 0.60 0.50 0.30 1.00 0.10 1\n')
+  cells = load_veg_parms(fname, HruStateStore())
+  assert sorted(cells['12345']) == [(0, 11), (1, 12)]
+  assert cells['12345'][(1, 12)].area_frac == 0.5
+
+def test_save_veg_parms(tmpdir):
+  fname = resource_filename('conductor', 'tests/input/vpf_toy_64px.txt')
+  hru_store = HruStateStore()
+  hru_cells = load_veg_parms(fname, hru_store)
+  fname = resource_filename('conductor', 'tests/input/snb_toy_64px.txt')
+  cells = merge_cell_input(hru_cells, load_snb_parms(fname, 5), hru_store)
+  cell = cells[list(cells.keys())[0]]
+  cell.bands[4].create_hru(4, 22, 0.125, cell.hru_store)
+  save_veg_parms(cells, str(tmpdir.join('vpf.txt')))
+
+  with open(str(tmpdir.join('expected.txt')), 'w') as f:
+    writer = csv.writer(f, delimiter=' ')
+    for cell_id, cell in cells.items():
+      writer.writerow([cell_id, sum([band.num_hrus for band in cell.bands])])
+      for band_id, band in enumerate(cell.bands):
+        for veg_type, hru in band.hrus.items():
+          writer.writerow([veg_type, hru.area_frac] + hru.root_zone_parms\
+            + [band_id])
+  assert tmpdir.join('vpf.txt').read() == tmpdir.join('expected.txt').read()
+
+def test_save_veg_parms_line_cache(tmpdir):
+  fname = resource_filename('conductor', 'tests/input/vpf_toy_64px.txt')
+  hru_store = HruStateStore()
+  hru_cells = load_veg_parms(fname, hru_store)
+  fname = resource_filename('conductor', 'tests/input/snb_toy_64px.txt')
+  cells = merge_cell_input(hru_cells, load_snb_parms(fname, 5), hru_store)
+  cell_ids = list(cells.keys())
+  line_cache = {}
+  save_veg_parms(cells, str(tmpdir.join('vpf_0.txt')), line_cache)
+  assert sorted(line_cache) == sorted(cell_ids)
+
+  hru = cells[cell_ids[0]].bands[1].hrus[11]
+  hru.area_frac = 0.25
+  # Clean cells are written out as cached, dirty ones anew
+  save_veg_parms(cells, str(tmpdir.join('vpf_1.txt')), line_cache, [])
+  save_veg_parms(cells, str(tmpdir.join('vpf_2.txt')), line_cache,
+                 [cell_ids[0]])
+  save_veg_parms(cells, str(tmpdir.join('vpf_3.txt')))
+  assert tmpdir.join('vpf_1.txt').read() == tmpdir.join('vpf_0.txt').read()
+  assert tmpdir.join('vpf_2.txt').read() == tmpdir.join('vpf_3.txt').read()
+  assert tmpdir.join('vpf_2.txt').read() != tmpdir.join('vpf_0.txt').read()
+  assert load_veg_parms(str(tmpdir.join('vpf_2.txt')), HruStateStore())[cell_ids[0]]\
+    [(1, 11)].area_frac == 0.25
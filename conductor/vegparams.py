@@ -6,12 +6,14 @@
 """
 
 from collections import OrderedDict
-import csv
-from conductor.cells import Band, HydroResponseUnit
 
-def read_one_cell(f):
+import numpy as np
+
+from conductor.cells import Band, HydroResponseUnit, HruState
+
+def read_one_cell(f, hru_store):
   """Reads all data (elevation bands/hrus) for one cell and advance the
-    file pointer to the next cell.
+    file pointer to the next cell. The HRU states are created in hru_store.
   """
   try:
     cell_id, num_veg = f.readline().split()
@@ -26,35 +28,141 @@ def read_one_cell(f):
     root_zone_parms = [ float(x) for x in split_line[2:8] ]
     band_id = int(split_line[8])
     key = (band_id, veg_type)
-    hru_dict[key] = HydroResponseUnit(area_frac, root_zone_parms, band_id, veg_type)
+    hru_dict[key] = HydroResponseUnit(area_frac, root_zone_parms, band_id,\
+      veg_type, hru_store)
 
   return cell_id, hru_dict
 
-def load_veg_parms(filename):
+def load_veg_parms(filename, hru_store):
   """ Reads in VIC vegetation parameter file and creates and partially
-    initializes all VIC grid cells.
+    initializes all VIC grid cells, with their HRU states in hru_store (an
+    HruStateStore). The file is read in one go: the cell header lines (cell
+    ID and number of HRUs) are walked to find the HRU lines, which are then
+    tokenized and converted to arrays of veg types, area fractions, root zone
+    parameters and band IDs all at once. As with read_one_cell(), reading
+    stops at the first line that is not a cell header where one is expected
+    (e.g. a blank line).
   """
+  with open(filename, 'rb') as f:
+    lines = f.read().splitlines()
+
+  cell_ids = []
+  cell_num_hrus = []
+  hru_lines = []
+  line_idx = 0
+  while line_idx < len(lines):
+    header = lines[line_idx].split()
+    if len(header) != 2:
+      break
+    num_hrus = int(header[1])
+    if line_idx + 1 + num_hrus > len(lines):
+      raise Exception('load_veg_parms({}): cell {} lists {} HRUs, but the \
+        file ends after {} of them.'.format(filename, header[0].decode(),\
+        num_hrus, len(lines) - line_idx - 1))
+    cell_ids.append(header[0].decode())
+    cell_num_hrus.append(num_hrus)
+    hru_lines.extend(lines[line_idx + 1:line_idx + 1 + num_hrus])
+    line_idx += 1 + num_hrus
+
+  # Columns: veg type, area fraction, 6 root zone parameters, band ID
+  rows = [ line.split() for line in hru_lines ]
+  line_num_tokens = np.fromiter(map(len, rows), dtype=np.int64,\
+    count=len(rows))
+  short_lines = np.flatnonzero(line_num_tokens < 9)
+  if len(short_lines) > 0:
+    line_idx = short_lines[0]
+    cell_idx = np.searchsorted(np.cumsum(cell_num_hrus), line_idx,\
+      side='right')
+    raise Exception('load_veg_parms({}): expected 9 columns per HRU line of \
+      cell {}, found {} in line {!r}.'.format(filename, cell_ids[cell_idx],\
+      line_num_tokens[line_idx], hru_lines[line_idx].decode()))
+  if np.all(line_num_tokens == 9):
+    table = np.array(rows).reshape(-1, 9)
+  else:
+    # (lines with trailing extra columns, which are ignored)
+    table = np.array([ row[:9] for row in rows ]).reshape(-1, 9)
+  veg_types = table[:, 0].astype(np.int64).tolist()
+  area_fracs = table[:, 1].astype(float).tolist()
+  root_zone_parms = table[:, 2:8].astype(float).tolist()
+  band_ids = table[:, 8].astype(np.int64).tolist()
+  hru_states = HruState.new_states(band_ids, veg_types, hru_store)
+
   cells = OrderedDict()
-  # iterate over each block of cells in the file and populate the class dict
-  with open(filename, 'r') as f:
-    while True:
-      try:
-        id_, cell = read_one_cell(f)
-      except TypeError:
-        break
-      else:
-        cells[id_] = cell
+  hru_idx = 0
+  for cell_id, num_hrus in zip(cell_ids, cell_num_hrus):
+    hru_dict = {}
+    for idx in range(hru_idx, hru_idx + num_hrus):
+      hru_dict[(band_ids[idx], veg_types[idx])] = HydroResponseUnit(\
+        area_fracs[idx], root_zone_parms[idx], band_ids[idx], veg_types[idx],\
+        hru_store, hru_states[idx])
+    cells[cell_id] = hru_dict
+    hru_idx += num_hrus
   return cells
 
-def save_veg_parms(cells, filename):
+def _format_veg_cells(cells, cell_ids):
+  """ Returns the Vegetation Parameter File lines of each of cell_ids (as one
+    string per cell), formatted as csv.writer would. The HRUs of all cells
+    are gathered in one pass into columns, and each column is formatted at
+    once: veg types, band IDs and root zone parameter sets (which take few
+    distinct values) are formatted once per distinct value, and area
+    fractions are written as floats in their shortest round-trip form.
+  """
+  cell_num_hrus = []
+  veg_types = []
+  band_ids = []
+  area_fracs = []
+  root_zone_parms = []
+  for cell_id in cell_ids:
+    num_hrus = len(veg_types)
+    for band_id, band in enumerate(cells[cell_id].bands):
+      if band.hrus:
+        hrus = list(band.hrus.values())
+        veg_types.extend(band.hrus.keys())
+        band_ids.extend([band_id] * len(hrus))
+        area_fracs.extend([hru.area_frac for hru in hrus])
+        root_zone_parms.extend([tuple(hru.root_zone_parms) for hru in hrus])
+    cell_num_hrus.append(len(veg_types) - num_hrus)
+
+  def format_ints(values):
+    distinct, inverse = np.unique(np.array(values, dtype=np.int64),\
+      return_inverse=True)
+    return distinct.astype(str)[inverse].tolist()
+
+  parms_texts = { parms: ' '.join(map(str, parms))\
+    for parms in set(root_zone_parms) }
+  lines = list(map('{} {} {} {}\r\n'.format, format_ints(veg_types),\
+    map(repr, np.array(area_fracs, dtype=float).tolist()),\
+    map(parms_texts.__getitem__, root_zone_parms), format_ints(band_ids)))
+
+  texts = []
+  first_line = 0
+  for cell_id, num_hrus in zip(cell_ids, cell_num_hrus):
+    texts.append('{} {}\r\n'.format(cell_id, num_hrus)\
+      + ''.join(lines[first_line:first_line + num_hrus]))
+    first_line += num_hrus
+  return texts
+
+def format_veg_parms(cells, line_cache=None, dirty_cells=None):
+  """ Returns the contents of the Vegetation Parameter File for cells. If a
+    line_cache dict is given, the formatted lines of each cell are kept in
+    it, and reused for cells not in dirty_cells (when that is given).
+  """
+  if line_cache is not None and dirty_cells is not None:
+    dirty_cells = set(dirty_cells)
+    stale_cells = [ cell_id for cell_id in cells\
+      if cell_id in dirty_cells or cell_id not in line_cache ]
+  else:
+    stale_cells = list(cells)
+  texts = _format_veg_cells(cells, stale_cells)
+  if line_cache is not None:
+    line_cache.update(zip(stale_cells, texts))
+    texts = [ line_cache[cell_id] for cell_id in cells ]
+  return ''.join(texts)
+
+def save_veg_parms(cells, filename, line_cache=None, dirty_cells=None):
   """ Writes the vegetation parameters out to a file of the same format as the
     original vegetation parameters file.
+    The line_cache and dirty_cells are as for format_veg_parms().
   """
   with open(filename, 'w') as f:
-    writer = csv.writer(f, delimiter=' ')
-    for cell_id, cell in cells.items():
-      writer.writerow( [ cell_id, sum([band.num_hrus for band in cell.bands]) ] )
-      for band_id, band in enumerate(cell.bands):
-        for veg_type, hru in band.hrus.items():
-          line = [veg_type, hru.area_frac] + hru.root_zone_parms + [ band_id ]
-          writer.writerow(line)
+    f.write(format_veg_parms(cells, line_cache, dirty_cells))
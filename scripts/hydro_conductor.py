@@ -5,9 +5,10 @@
 """
 
 import argparse
+import atexit
+from concurrent.futures import ProcessPoolExecutor
 import os
 import shutil
-import subprocess
 import sys
 from warnings import warn
 import logging
@@ -17,14 +18,21 @@ import netCDF4
 from dateutil.relativedelta import relativedelta
 from time import strftime
 
-from conductor.file_io import get_rgm_pixel_mapping, read_gsa_headers,\
-  write_grid_to_gsa_file, mass_balances_to_rgm_grid, read_state, write_state
-from conductor.cells import Cell, Band, HydroResponseUnit, merge_cell_input, \
-  bin_bands_and_glaciers, digitize_domain, update_glacier_mask, update_area_fracs
-from conductor.snbparams import load_snb_parms, save_snb_parms
-from conductor.vegparams import load_veg_parms, save_veg_parms
+from conductor.background import BackgroundWorker
+from conductor.cache import load_cached, ReusingTextWriter
+from conductor.grids import new_grid, memmap_grid
+from conductor.file_io import get_rgm_pixel_mapping, read_grid_headers,\
+  read_grid_file, memmap_grid_file, write_grid_file, mass_balances_to_rgm_grid, read_state,\
+  write_state, update_state, max_num_hrus, reset_out_of_domain_elevations,\
+  GRID_FORMATS
+from conductor.cells import Cell, Band, HydroResponseUnit, HruStateStore, \
+  CellPixelIndex, IncrementalBinning, merge_cell_input, digitize_domain, \
+  update_glacier_mask, reconcile_bed_dem, update_area_fracs
+from conductor.snbparams import load_snb_parms, format_snb_parms
+from conductor.vegparams import load_veg_parms, format_veg_parms
 from conductor.vic_globals import Global
 from conductor.glacier_plotter import GlacierPlotter
+from conductor.runner import run_model, ModelRunError
 
 one_year = relativedelta(years=+1)
 one_day = relativedelta(days=+1)
@@ -90,6 +98,56 @@ def parse_input_parms():
   parser.add_argument('--plots', action='store_true', dest='output_plots',
     default=False, help='plot the Surface DEM and glacier mask to screen on \
       every iteration.')
+  parser.add_argument('--gsa-precision', action='store',
+    dest='gsa_precision', type=int, default=None, help='number of decimal \
+      places to write the yearly mass balance and surface DEM grids for the \
+      RGM with (default: the shortest exact representation of each value, \
+      which is slower to write).')
+  parser.add_argument('--rgm-grid-format', action='store',
+    dest='rgm_grid_format', type=str, choices=GRID_FORMATS, default='DSAA',
+    help='Surfer grid format of the bed DEM, surface DEM and mass balance \
+      grid files exchanged with the RGM: ASCII (DSAA, the default), or the \
+      Surfer 6 (DSBB, single precision) or Surfer 7 (DSRB, double precision) \
+      binary formats, if the RGM build supports them. RGM output grids are read in whichever format they are \
+      written in.')
+  parser.add_argument('--memmap-dems', action='store_true',
+    dest='memmap_dems', default=False, help='hold the bed and surface DEMs, \
+      glacier mask and mass balance grid in memory-mapped files in the \
+      hydrocon_temp/memmap subdirectory instead of in memory, for domains \
+      whose grids do not fit in memory.')
+  parser.add_argument('--state-complevel', action='store',
+    dest='state_complevel', type=int, default=0, choices=range(10),
+    help='zlib compression level (1-9) of the VIC state files written by the \
+      conductor (default: 0, no compression).')
+  parser.add_argument('--state-chunk-cells', action='store',
+    dest='state_chunk_cells', type=int, default=None, help='store the VIC \
+      state file variables in chunks spanning this many grid cells along \
+      each of lat and lon (default: netCDF library default chunking).')
+  parser.add_argument('--state-in-place', action='store_true',
+    dest='state_in_place', default=False, help='update the VIC state file \
+      saved by VIC in place (or a copy of it, when keeping trace files) \
+      instead of writing a new one, whenever the number of HRU slots it needs \
+      is unchanged. Its compression and chunking are then left as VIC wrote \
+      them, regardless of --state-complevel and --state-chunk-cells.')
+  parser.add_argument('--num-workers', action='store', dest='num_workers',
+    type=int, default=1, help='number of worker processes over which to shard \
+      the VIC cells for the yearly area fraction and state update (default: \
+      1, no worker processes). Results do not depend on this.')
+  parser.add_argument('--vic-timeout', action='store', dest='vic_timeout',
+    type=float, default=None, help='number of seconds after which a yearly \
+      VIC run is killed and the conductor exits (default: no limit).')
+  parser.add_argument('--rgm-timeout', action='store', dest='rgm_timeout',
+    type=float, default=None, help='number of seconds after which a yearly \
+      RGM run is killed and the conductor exits (default: no limit).')
+  parser.add_argument('--background-queue', action='store',
+    dest='background_queue', type=int, default=2, help='number of \
+      non-critical tasks (writing trace files, removing temporary files) that \
+      may be queued up for a background thread to do while the next model \
+      run goes ahead (default: 2; 0 does them in turn in the main loop).')
+  parser.add_argument('--no-input-cache', action='store_false',
+    dest='use_input_cache', default=True, help='always parse the pixel map, \
+      DEM and glacier mask text files instead of using (and refreshing) their \
+      binary cache in the hydrocon_temp/input_cache subdirectory.')
 
   if len(sys.argv) == 1:
     parser.print_help()
@@ -111,6 +169,17 @@ def parse_input_parms():
   band_size = options.band_size
   loglevel = options.loglevel
   output_plots = options.output_plots
+  use_input_cache = options.use_input_cache
+  gsa_precision = options.gsa_precision
+  rgm_grid_format = options.rgm_grid_format
+  memmap_dems = options.memmap_dems
+  state_complevel = options.state_complevel
+  state_chunk_cells = options.state_chunk_cells
+  state_in_place = options.state_in_place
+  num_workers = options.num_workers
+  background_queue = options.background_queue
+  vic_timeout = options.vic_timeout
+  rgm_timeout = options.rgm_timeout
 
   if open_ground_root_zone_file:
     with open(open_ground_root_zone_file, 'r') as f:
@@ -138,7 +207,9 @@ def parse_input_parms():
     surf_dem_in_file, bed_dem_file, pixel_cell_map_file, \
     init_glacier_mask_file, glacier_thickness_threshold, output_trace_files, \
     glacier_root_zone_parms, open_ground_root_zone_parms, band_size, loglevel,\
-    output_plots
+    output_plots, use_input_cache, gsa_precision, rgm_grid_format,\
+    memmap_dems, state_complevel, state_chunk_cells, state_in_place,\
+    num_workers, background_queue, vic_timeout, rgm_timeout
 
 def run_ranges(startdate, enddate, glacier_start):
   """Generator which yields date ranges (a 2-tuple) that represent times at
@@ -184,7 +255,9 @@ def main():
   surf_dem_in_file, bed_dem_file, pixel_cell_map_file, \
   init_glacier_mask_file, glacier_thickness_threshold, output_trace_files,\
   glacier_root_zone_parms, open_ground_root_zone_parms, band_size,\
-  loglevel, output_plots\
+  loglevel, output_plots, use_input_cache, gsa_precision, rgm_grid_format,\
+  memmap_dems, state_complevel, state_chunk_cells, state_in_place,\
+  num_workers, background_queue, vic_timeout, rgm_timeout\
     = parse_input_parms()
 
   # Set up logging
@@ -233,6 +306,30 @@ Assuming default value of {}.'.format(Band.glacier_id))
   os.makedirs(temp_files_path, exist_ok=True)
   logging.info('Temporary output files will be written to {}.'.format(temp_files_path))
 
+  # Loads the (large) pixel map, DEM and glacier mask text inputs, via their
+  # binary cache unless disabled
+  input_cache_path = temp_files_path + 'input_cache/'
+  def load_input(source_file, loader, name):
+    if use_input_cache:
+      return load_cached(source_file, loader, input_cache_path, name)
+    return loader(source_file)
+
+  # Large grids are optionally held in memory-mapped files
+  memmap_path = temp_files_path + 'memmap/'
+  def memmap_input(grid, name, dtype=None):
+    if memmap_dems:
+      logging.debug('Memory-mapping %s to %s', name, memmap_path + name)
+      return memmap_grid(grid, memmap_path + name, dtype)
+    return grid
+
+  # Input grids are read straight into their memory-mapped files (bypassing
+  # the input cache), so that they are never held in memory as a whole
+  def load_grid_input(source_file, name):
+    if memmap_dems:
+      logging.debug('Memory-mapping %s to %s', source_file, memmap_path + name)
+      return memmap_grid_file(source_file, memmap_path + name)
+    return load_input(source_file, read_grid_file, 'grid')
+
   # Load parameters from Snow Band Parameters File
   num_snow_bands, snb_file = global_parms.snow_band.split()
   num_snow_bands = int(num_snow_bands)
@@ -242,7 +339,9 @@ Assuming default value of {}.'.format(Band.glacier_id))
   # Load vegetation parameters from initial Vegetation Parameter File
   logging.info('Loading initial VIC vegetation parameters from %s',\
     global_parms.vegparam)
-  hru_cell_dict = load_veg_parms(global_parms.vegparam)
+  # One store holds the HRU states of the whole domain
+  hru_store = HruStateStore()
+  hru_cell_dict = load_veg_parms(global_parms.vegparam, hru_store)
 
   # Apply custom HRU root_zone_parms attributes, if provided
   if glacier_root_zone_parms or open_ground_root_zone_parms:
@@ -258,18 +357,21 @@ Assuming default value of {}.'.format(Band.glacier_id))
 
   # Create Ordered dictionary of Cell objects by merging info gathered from
   # Snow Band and Vegetation Parameter files and custom parameters
-  cells = merge_cell_input(hru_cell_dict, elevation_cell_dict)
+  cells = merge_cell_input(hru_cell_dict, elevation_cell_dict, hru_store)
 
   # Open and read VIC-grid-to-RGM-pixel mapping file.
   logging.info('Loading VIC-grid-to-RGM-pixel mapping from %s',\
     pixel_cell_map_file)
   vic_cell_mask, cell_areas, num_cols_dem, num_rows_dem\
-    = get_rgm_pixel_mapping(pixel_cell_map_file)
+    = load_input(pixel_cell_map_file, get_rgm_pixel_mapping, 'pixel_map')
+  # Index the pixels belonging to each VIC cell once, for reuse by binning,
+  # mass balance gridding and area fraction updates on every time step
+  pixel_index = CellPixelIndex.from_cell_mask(vic_cell_mask, list(cells.keys()))
 
   # Get DEM xmin, xmax, ymin, ymax metadata of Bed DEM and check file header
   # validity     
   dem_xmin, dem_xmax, dem_ymin, dem_ymax, num_rows, num_cols\
-    = read_gsa_headers(bed_dem_file)
+    = read_grid_headers(bed_dem_file)
   # Verify that number of columns & rows agree with what's stated in the
   # pixel_cell_map_file
   assert (num_cols == num_cols_dem) and (num_rows == num_rows_dem),\
@@ -281,10 +383,10 @@ Assuming default value of {}.'.format(Band.glacier_id))
   # Read in the provided Bed Digital Elevation Map (BDEM) file to 2D bed_dem
   # array
   logging.info('Loading Bed Digital Elevation Map (BDEM) from %s', bed_dem_file)
-  bed_dem = np.loadtxt(bed_dem_file, skiprows=5)
+  bed_dem = load_grid_input(bed_dem_file, 'bed_dem.dat')
 
   # Check header validity of Surface DEM file
-  _, _, _, _, num_rows, num_cols = read_gsa_headers(surf_dem_in_file)
+  _, _, _, _, num_rows, num_cols = read_grid_headers(surf_dem_in_file)
   # Verify number of columns & rows agree with what's stated in the
   # pixel_to_cell_map_file
   assert (num_cols == num_cols_dem) and (num_rows == num_rows_dem),\
@@ -296,7 +398,8 @@ Assuming default value of {}.'.format(Band.glacier_id))
   # surf_dem array
   logging.info('Loading Surface Digital Elevation Map (SDEM) from %s',\
     surf_dem_in_file)
-  current_surf_dem = np.loadtxt(surf_dem_in_file, skiprows=5)
+  surf_dem_memmap_name = 'surf_dem.dat'
+  current_surf_dem = load_grid_input(surf_dem_in_file, surf_dem_memmap_name)
 
   # Check if Bed DEM has any points that are higher than the Surface DEM
   # in the same location. If so, set these Bed DEM points to equal the
@@ -304,11 +407,9 @@ Assuming default value of {}.'.format(Band.glacier_id))
   # two are subtracted during glacier mask update. This reconciliation is
   # necessary because the two DEMs come from different sources, and could
   # have some overlapping elevation points.
-  dem_diffs = current_surf_dem - bed_dem
-  neg_val_inds = np.where(dem_diffs < 0)
-  num_neg_vals = len(neg_val_inds[0])
+  num_neg_vals = reconcile_bed_dem(current_surf_dem, bed_dem, num_rows_dem,
+    num_cols_dem)
   if num_neg_vals > 0:
-    bed_dem[neg_val_inds] = current_surf_dem[neg_val_inds]
     new_bed_dem_file = bed_dem_file[0:-4] + '_adjusted.gsa'
     logging.warning('The provided Bed DEM (%s) has %s elevation points \
 (out of a total of %s elevation points in the domain) higher than those \
@@ -317,11 +418,22 @@ data sources. The Bed DEM has been adjusted to equal the Surface DEM elevation \
 at these points and written out to the file %s.',\
     bed_dem_file, num_neg_vals, len(bed_dem), surf_dem_in_file, new_bed_dem_file)
     bed_dem_file = new_bed_dem_file
-    write_grid_to_gsa_file(bed_dem, bed_dem_file, num_cols_dem, num_rows_dem,\
-      dem_xmin, dem_xmax, dem_ymin, dem_ymax)
+    write_grid_file(bed_dem, bed_dem_file, 'DSAA', num_cols_dem,\
+      num_rows_dem, dem_xmin, dem_xmax, dem_ymin, dem_ymax)
+
+  # Grid files exchanged with the RGM
+  rgm_grid_ext = '.gsa' if rgm_grid_format == 'DSAA' else '.grd'
+  if rgm_grid_format != 'DSAA':
+    rgm_bed_dem_file = temp_files_path + 'rgm_bed_dem' + rgm_grid_ext
+    logging.info('Writing Bed DEM in %s format for the RGM to %s',\
+      rgm_grid_format, rgm_bed_dem_file)
+    write_grid_file(bed_dem, rgm_bed_dem_file, rgm_grid_format, num_cols_dem,\
+      num_rows_dem, dem_xmin, dem_xmax, dem_ymin, dem_ymax)
+  else:
+    rgm_bed_dem_file = bed_dem_file
 
   # Check header validity of initial Glacier Mask file
-  _, _, _, _, num_rows, num_cols = read_gsa_headers(init_glacier_mask_file)
+  _, _, _, _, num_rows, num_cols = read_grid_headers(init_glacier_mask_file)
   # Verify number of columns & rows agree with what's stated in the 
   # pixel_to_cell_map_file
   assert (num_cols == num_cols_dem) and (num_rows == num_rows_dem),\
@@ -331,14 +443,18 @@ at these points and written out to the file %s.',\
     pixel_cell_map_file, num_rows_dem, num_cols_dem)
   # Read in the provided initial glacier mask file to 2D glacier_mask array
   logging.info('Loading initial Glacier Mask from %s', init_glacier_mask_file)
-  glacier_mask = np.loadtxt(init_glacier_mask_file, skiprows=5)
+  glacier_mask = load_grid_input(init_glacier_mask_file, 'glacier_mask.dat')
+  mass_balance_grid = new_grid((num_rows_dem, num_cols_dem),
+    filename=memmap_path + 'mass_balance_grid.dat') if memmap_dems else None
 
   # Apply the initial glacier mask and modify the band and HRU area
   # fractions according to their digitized fractions of the DEM
   logging.debug('Applying initial band and HRU area fraction digitization.')
-  band_areas, glacier_areas = bin_bands_and_glaciers(cells, cell_areas,
-                                vic_cell_mask, num_snow_bands, current_surf_dem,
-                                glacier_mask)
+  # (the binning is kept up to date with each new Surface DEM and Glacier
+  # Mask, checked against a full rebin when debugging)
+  binning = IncrementalBinning(cells, num_snow_bands, current_surf_dem,
+    glacier_mask, pixel_index, check=numeric_loglevel <= logging.DEBUG)
+  band_areas, glacier_areas = binning.bin(cells)
   digitize_domain(cells, cell_areas, band_areas, glacier_areas)
 
   # Set the VIC output state file name prefix (to be written to STATENAME
@@ -361,9 +477,34 @@ at these points and written out to the file %s.',\
       global_parms.startdate.isoformat(), output_trace_files, temp_files_path,
       glacier_thickness_threshold)
 
+  # Worker processes for the yearly area fraction and state update
+  if num_workers > 1:
+    logging.info('Sharding the VIC cell state update over %s worker processes.',
+      num_workers)
+    executor = ProcessPoolExecutor(max_workers=num_workers)
+    # (also on the sys.exit() calls and exceptions of the main loop)
+    atexit.register(executor.shutdown)
+  else:
+    executor = None
+
+  # Background thread for the tasks the next model run needn't wait for
+  background = BackgroundWorker(background_queue)
+  atexit.register(background.shutdown)
+
 #### Run the coupled VIC-RGM model for the time range specified in the VIC
   # global parameters file
   time_step = 0
+  # Formatted parameter file lines of each cell, reused while its DEM pixels
+  # don't change; dirty_cells are the cells whose pixels changed in the last
+  # update (None meaning all cells)
+  snb_line_cache = {}
+  vpf_line_cache = {}
+  dirty_cells = None
+  # Parameter files whose contents don't change from one year to the next are
+  # reused rather than written out again (hard-linked to the new year's file
+  # name when keeping trace files, so that there is one per year)
+  snb_writer = ReusingTextWriter(link=output_trace_files)
+  vpf_writer = ReusingTextWriter(link=output_trace_files)
   time_iterator = run_ranges(global_parms.startdate,
                  global_parms.enddate,
                  global_parms.glacier_accum_startdate)
@@ -372,10 +513,12 @@ at these points and written out to the file %s.',\
     # Write temporary VIC parameter files
     temp_snb = temp_files_path + 'snb_temp_' + start.isoformat() + '.txt'
     logging.debug('Writing temporary snow band parameter file %s', temp_snb)
-    save_snb_parms(cells, temp_snb)
+    temp_snb = snb_writer.write(format_snb_parms(cells, snb_line_cache,\
+      dirty_cells), temp_snb)
     temp_vpf = temp_files_path + 'vpf_temp_' + start.isoformat() + '.txt'
     logging.debug('Writing temporary vegetation parameter file %s', temp_vpf)
-    save_veg_parms(cells, temp_vpf)
+    temp_vpf = vpf_writer.write(format_veg_parms(cells, vpf_line_cache,\
+      dirty_cells), temp_vpf)
     temp_gpf = temp_files_path + 'gpf_temp_{}.txt'.format(start.isoformat())
     logging.debug('Writing temporary global parameter file %s', temp_gpf)
     global_parms.vegparam = temp_vpf
@@ -392,17 +535,30 @@ at these points and written out to the file %s.',\
       global_parms.glacier_accum_start_day = start.day
     global_parms.write(temp_gpf)
 
+    # Write modified surface DEM with all pixels lying outside of VIC
+    # domain set equal to the bed DEM (for the RGM run after VIC's, while
+    # VIC runs; mass_balances_to_rgm_grid() below resets these pixels too, and
+    # leaves the DEM otherwise unchanged)
+    reset_out_of_domain_elevations(vic_cell_mask, current_surf_dem, bed_dem,\
+      num_rows_dem, num_cols_dem)
+    rgm_surf_dem_in_file = temp_files_path + 'rgm_surf_dem_in_'\
+      + end.isoformat() + rgm_grid_ext
+    def write_rgm_surf_dem_in():
+      write_grid_file(current_surf_dem, rgm_surf_dem_in_file, rgm_grid_format,\
+        num_cols_dem, num_rows_dem, dem_xmin, dem_xmax, dem_ymin, dem_ymax,\
+        gsa_precision)
+
     # Run VIC for a year, saving model state at the end
     print('\nRunning VIC from {} to {}'.format(start, end))
     logging.info('\nRunning VIC from %s to %s using global parameter file %s',\
       start, end, temp_gpf)
     try:
-      subprocess.check_call([vic_path, "-g", temp_gpf], shell=False,\
-        stderr=subprocess.STDOUT)
-    except subprocess.CalledProcessError as e:
-      logging.error('Subprocess invocation of VIC failed with the following \
-error: %s', e)
-      sys.exit(0)
+      run_model('VIC', [vic_path, '-g', temp_gpf], vic_timeout,\
+        [write_rgm_surf_dem_in])
+    except ModelRunError as e:
+      print('VIC run failed: {}. Exiting.'.format(e))
+      logging.error('VIC run failed: %s', e)
+      sys.exit(1)
 
     # Open VIC NetCDF state file and load the most recent set of state
     # variable values for all grid cells being modeled
@@ -419,23 +575,25 @@ error: %s', e)
     state = state_dataset.variables
     # read new states of all cells
     read_state(state, cells)
-    # optionally leave the last VIC state file on disk 
-    if not output_trace_files:
-      os.remove(state_file)
+    # optionally leave the last VIC state file on disk (if it may be updated
+    # in place, it is only moved out of the way once it has been)
+    if not output_trace_files and not state_in_place:
+      background.submit(os.remove, state_file)
 
     gmb_polys = {}
     cell_ids = []
     for cell_id in cells:
       # Make sure VIC cell IDs in the state file agree with those in the
       # vic_cell_mask, which is derived from the pixel_cell_map_file
-      if int(cell_id) not in vic_cell_mask:
+      if pixel_index.num_cell_pixels(cell_id) == 0:
         print('Cell ID {} read from the VIC state file {} was not found in '
           'the VIC cell mask derived from the given RGM-Pixel-to-VIC-Cell map '
           'file (option --pixel_map) {}. Exiting.'
           .format(cell_id, state_file, pixel_cell_map_file))
-        logging.error('Cell ID {} read from the VIC state file {} was not '
+        logging.error('Cell ID %s read from the VIC state file %s was not '
           'found in the VIC cell mask derived from the given '
-          'RGM-Pixel-to-VIC-Cell map file (option --pixel_map) {}')
+          'RGM-Pixel-to-VIC-Cell map file (option --pixel_map) %s',
+          cell_id, state_file, pixel_cell_map_file)
         sys.exit(0)
       cell_ids.append(cell_id)
       # Read Glacier Mass Balance polynomial terms from cell states;
@@ -447,84 +605,135 @@ error: %s', e)
     # surface DEM into a 2D RGM mass balance grid (MBG) and write the 
     # MBG to an ASCII file to give as input to the RGM
     mbg_file = temp_files_path + 'mass_balance_grid_' + end.isoformat()\
-      + '.gsa'
+      + rgm_grid_ext
     logging.debug('Converting glacier mass balance polynomials to 2D grid \
 and writing to file %s', mbg_file)
     mass_balance_grid = mass_balances_to_rgm_grid(gmb_polys, vic_cell_mask,\
-      current_surf_dem, bed_dem, num_rows_dem, num_cols_dem)
-    write_grid_to_gsa_file(mass_balance_grid, mbg_file, num_cols_dem,\
-      num_rows_dem, dem_xmin, dem_xmax, dem_ymin, dem_ymax)
-    # Write modified surface DEM with all pixels lying outside of VIC
-    # domain set equal to the bed DEM
-    rgm_surf_dem_in_file = temp_files_path + 'rgm_surf_dem_in_'\
-      + end.isoformat() + '.gsa'
-    write_grid_to_gsa_file(current_surf_dem, rgm_surf_dem_in_file, num_cols_dem,\
-      num_rows_dem, dem_xmin, dem_xmax, dem_ymin, dem_ymax)
+      current_surf_dem, bed_dem, num_rows_dem, num_cols_dem, pixel_index,\
+      mass_balance_grid)
+    write_grid_file(mass_balance_grid, mbg_file, rgm_grid_format,\
+      num_cols_dem, num_rows_dem, dem_xmin, dem_xmax, dem_ymin, dem_ymax,\
+      gsa_precision)
 
     # Run RGM for one year, passing it the MBG, BDEM, SDEM
     logging.info('Running RGM for current year with parameter file %s, \
 Bed DEM file %s, Surface DEM file %s, Mass Balance Grid file %s',\
-      rgm_params_file, bed_dem_file, rgm_surf_dem_in_file, mbg_file)
+      rgm_params_file, rgm_bed_dem_file, rgm_surf_dem_in_file, mbg_file)
     try:
-      subprocess.check_call([rgm_path, "-p", rgm_params_file, "-b",\
-        bed_dem_file, "-d", rgm_surf_dem_in_file, "-m", mbg_file, "-o",\
-        temp_files_path, "-s", "0", "-e", "0" ], shell=False,\
-        stderr=subprocess.STDOUT)
-    except subprocess.CalledProcessError as e:
-      logging.error('Subprocess invocation of RGM failed with the following \
-error: %s', e)
-      sys.exit(0)
+      run_model('RGM', [rgm_path, "-p", rgm_params_file, "-b",\
+        rgm_bed_dem_file, "-d", rgm_surf_dem_in_file, "-m", mbg_file, "-o",\
+        temp_files_path, "-s", "0", "-e", "0" ], rgm_timeout)
+    except ModelRunError as e:
+      print('RGM run failed: {}. Exiting.'.format(e))
+      logging.error('RGM run failed: %s', e)
+      sys.exit(1)
 
     # Read in new Surface DEM file from RGM output
     logging.debug('Reading Surface DEM file from RGM output %s',\
       rgm_surf_dem_out_file)
-    current_surf_dem = np.loadtxt(rgm_surf_dem_out_file, skiprows=5)
+    # (binary output is memory-mapped copy-on-write, as the file is renamed
+    # below and the RGM writes a new one next year)
+    current_surf_dem = read_grid_file(rgm_surf_dem_out_file, mmap_mode='c')
+    # (DSBB output is mapped as float32, and is widened to float64 by a copy)
+    is_float64_memmap = isinstance(current_surf_dem, np.memmap)\
+      and current_surf_dem.dtype == np.float64
+    if memmap_dems:
+      old_surf_dem_memmap_name = surf_dem_memmap_name
+      if is_float64_memmap:
+        # (binary output is mapped from the renamed RGM output file itself)
+        surf_dem_memmap_name = None
+      else:
+        # (a new file for each year, as last year's may still be mapped)
+        surf_dem_memmap_name = 'surf_dem_' + end.isoformat() + '.dat'
+        current_surf_dem = memmap_input(current_surf_dem, surf_dem_memmap_name,
+          np.float64)
+      if old_surf_dem_memmap_name is not None:
+        background.submit(os.remove, memmap_path + old_surf_dem_memmap_name)
+    elif current_surf_dem.dtype != np.float64:
+      current_surf_dem = np.asarray(current_surf_dem, dtype=np.float64)
     temp_surf_dem_file = temp_files_path + 'rgm_surf_dem_out_'\
-      + end.isoformat() + '.gsa'
+      + end.isoformat() + rgm_grid_ext
     os.rename(rgm_surf_dem_out_file, temp_surf_dem_file)
-    # this will be fed back into RGM on next time step:
-    rgm_surf_dem_in_file = temp_surf_dem_file
 
-    # remove temporary files if not saving for offline inspection
+    # remove temporary files if not saving for offline inspection (the RGM
+    # output was renamed above)
     if not output_trace_files:
-      os.remove(mbg_file)
-      os.remove(rgm_surf_dem_in_file)
-      os.remove(rgm_surf_dem_out_file)
+      for temp_file in [mbg_file, rgm_surf_dem_in_file, temp_surf_dem_file]:
+        background.submit(os.remove, temp_file)
 
     # Update glacier mask
     logging.debug('Updating Glacier Mask')
     glacier_mask = update_glacier_mask(current_surf_dem, bed_dem,
-      num_rows_dem, num_cols_dem, glacier_thickness_threshold)
-    if output_trace_files:
-      glacier_mask_file = temp_files_path + 'glacier_mask_'\
-        + end.isoformat() + '.gsa'
-      logging.debug('Writing Glacier Mask to file %s', glacier_mask_file)
-      write_grid_to_gsa_file(glacier_mask, glacier_mask_file, num_cols_dem,
-      num_rows_dem, dem_xmin, dem_xmax, dem_ymin, dem_ymax)
+      num_rows_dem, num_cols_dem, glacier_thickness_threshold,
+      glacier_mask if memmap_dems else None)
 
     if output_plots:
       figure.update_plots(current_surf_dem, glacier_mask,
                           glacier_thickness_threshold, bed_dem, end.isoformat())
 
-    # Update HRU and band area fractions and state for all VIC grid cells
-    logging.debug('Updating VIC grid cell area fractions and states')
+    # Update HRU and band area fractions and state for the VIC grid cells
+    # whose DEM pixels changed since the last update (all cells in the first
+    # one, as the initial digitization is not a state update)
+    dirty_cells = binning.update(cells, current_surf_dem, glacier_mask)
+    if time_step == 0:
+      dirty_cells = list(cells.keys())
+    logging.debug('Updating VIC grid cell area fractions and states for %s '
+      'out of %s cells', len(dirty_cells), len(cells))
+    if executor is not None:
+      # (worker processes may be forked in the update, which is only safe
+      # while the background thread is idle)
+      background.flush()
     update_area_fracs(cells, cell_areas, vic_cell_mask, num_snow_bands,
-      current_surf_dem, glacier_mask)
+      current_surf_dem, glacier_mask, pixel_index, executor, num_workers,
+      dirty_cells, binning)
+
+    if output_trace_files:
+      glacier_mask_file = temp_files_path + 'glacier_mask_'\
+        + end.isoformat() + '.gsa'
+      logging.debug('Writing Glacier Mask to file %s', glacier_mask_file)
+      # (a copy if memory-mapped, as that is updated in place next year)
+      background.submit(write_grid_file, np.array(glacier_mask)\
+        if memmap_dems else glacier_mask, glacier_mask_file, 'DSAA',\
+        num_cols_dem, num_rows_dem, dem_xmin, dem_xmax, dem_ymin, dem_ymax)
 
     # Update the VIC state file with new state information
     new_state_date = end + one_day
     new_state_file = state_filename_prefix + '_' + new_state_date.isoformat()
-    logging.debug('Writing updated VIC state file %s', new_state_file)
     # Set the new state file name VIC will have to read in on next iteration
     global_parms.init_state = new_state_file
-    new_state_dataset = netCDF4.Dataset(new_state_file, 'w')
-    write_state(cells, state_dataset, new_state_dataset, new_state_date)
-    logging.debug('Closing old and updated NetCDF state files.')
-    state_dataset.close()
-    new_state_dataset.close()
+    if state_in_place\
+        and max_num_hrus(cells) == len(state_dataset.dimensions['hru']):
+      # Only the state variables and date need changing, so save rewriting
+      # all of the file by updating it (or a copy of it) in place
+      logging.debug('Updating VIC state file %s in place as %s', state_file,
+        new_state_file)
+      state_dataset.close()
+      if output_trace_files:
+        shutil.copyfile(state_file, new_state_file)
+      else:
+        os.rename(state_file, new_state_file)
+      new_state_dataset = netCDF4.Dataset(new_state_file, 'r+')
+      update_state(cells, new_state_dataset, new_state_date)
+      new_state_dataset.close()
+    else:
+      logging.debug('Writing updated VIC state file %s', new_state_file)
+      new_state_dataset = netCDF4.Dataset(new_state_file, 'w')
+      write_state(cells, state_dataset, new_state_dataset, new_state_date,\
+        zlib=state_complevel > 0, complevel=state_complevel,\
+        chunksizes=state_chunk_cells and \
+          {'lat': state_chunk_cells, 'lon': state_chunk_cells})
+      logging.debug('Closing old and updated NetCDF state files.')
+      state_dataset.close()
+      new_state_dataset.close()
+      if state_in_place and not output_trace_files:
+        background.submit(os.remove, state_file)
 
     time_step = time_step + 1
 
+  if executor is not None:
+    executor.shutdown()
+  background.shutdown()
+
 # Main program invocation.
 if __name__ == '__main__':
   main()